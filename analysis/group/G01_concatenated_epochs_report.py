@@ -73,13 +73,22 @@ import numpy as np
 
 from group_utils import (
     add_analysis_notes_section,
+    add_ci_bands,
     add_subject_summary,
+    bootstrap_ci,
+    compute_tfr,
+    condition_colors,
     ensure_dir,
+    filter_inst,
     make_report,
     plot_compare_evokeds_by_channel,
     read_interpolation_summary,
     read_subject_epochs,
+    save_derivative,
     save_subject_list,
+    TFRVariants,
+    tfr_contrast,
+    window_trials,
 )
 
 
@@ -133,6 +142,17 @@ SESSION = "01"
 TASK = "SpAtt"
 RUN = "01"
 
+# On-disk precision of the concatenated epochs: "single" (float32) or "double".
+# The policy and its error against double are recorded in a JSON sidecar.
+STORAGE_POLICY = "single"
+
+# Cue-locked ERP window (as cropped below), used for the bootstrap bands.
+ERP_WINDOW = {"cue": dict(tmin=-0.1, tmax=1.0, baseline=(-0.1, 0))}
+
+# Plot label -> stim label; the CI bands use the same colours as the lines.
+ERP_CONDITIONS = {"No stimulation": "no-stim", "Stimulation": "stim"}
+ERP_COLORS = condition_colors(ERP_CONDITIONS)
+
 
 # ==============================================================
 # TFR parameters
@@ -153,6 +173,8 @@ N_CYCLES = FREQS / 2.0
 
 TIME_BANDWIDTH = 2.0
 
+# Passed to tfr_engine.compute_tfr, which caches the DPSS kernel FFTs
+# across channels and runs.
 TFR_PARAMS = dict(
     method="multitaper",
     freqs=FREQS,
@@ -464,6 +486,7 @@ def build_concat_epoch_report(subjects):
         subject_epochs[subject] = read_subject_epochs(
             BIDS_ROOT,
             subject,
+            channels=OCCIPITAL_CHANNELS,
         )
 
     # ----------------------------------------------------------
@@ -625,11 +648,12 @@ def build_concat_epoch_report(subjects):
                 f"group_{stim_label}_{ch}_concat-epo.fif",
             )
 
-            concat_epochs_by_channel[
-                stim_label
-            ][ch].save(
+            save_derivative(
+                concat_epochs_by_channel[
+                    stim_label
+                ][ch],
                 concat_fname,
-                overwrite=True,
+                policy=STORAGE_POLICY,
             )
 
             print(
@@ -647,6 +671,11 @@ def build_concat_epoch_report(subjects):
         "stim": {},
     }
 
+    erp_ci_by_channel = {
+        "no-stim": {},
+        "stim": {},
+    }
+
     for stim_label in [
         "no-stim",
         "stim",
@@ -655,11 +684,11 @@ def build_concat_epoch_report(subjects):
         for ch in OCCIPITAL_CHANNELS:
 
             evoked = (
-                concat_epochs_by_channel[
-                    stim_label
-                ][ch]
-                .average()
-                .filter(
+                filter_inst(
+                    concat_epochs_by_channel[
+                        stim_label
+                    ][ch]
+                    .average(),
                     l_freq=None,
                     h_freq=30,
                 )
@@ -677,6 +706,20 @@ def build_concat_epoch_report(subjects):
                 stim_label
             ][ch] = evoked
 
+            # Bootstrap over the concatenated trials of this channel.
+            erp_trials = window_trials(
+                concat_epochs_by_channel[stim_label][ch],
+                ERP_WINDOW,
+                picks=[ch],
+                h_freq=30,
+            )["cue"]
+
+            erp_ci_by_channel[
+                stim_label
+            ][ch] = bootstrap_ci(
+                erp_trials[:, 0],
+            )
+
             evoked_fname = op.join(
                 GROUP_DERIV_DIR,
                 f"group_{stim_label}_{ch}_concat-ave.fif",
@@ -711,14 +754,11 @@ def build_concat_epoch_report(subjects):
 
         mne.viz.plot_compare_evokeds(
             {
-                "No stimulation": evoked_by_channel[
-                    "no-stim"
-                ][ch],
-                "Stimulation": evoked_by_channel[
-                    "stim"
-                ][ch],
+                condition: evoked_by_channel[stim_label][ch]
+                for condition, stim_label in ERP_CONDITIONS.items()
             },
             picks=[ch],
+            colors=ERP_COLORS,
             axes=ax,
             show=False,
             ci=False,
@@ -726,6 +766,19 @@ def build_concat_epoch_report(subjects):
             truncate_yaxis=False,
         )
 
+        add_ci_bands(
+            ax,
+            {
+                condition: evoked_by_channel[stim_label][ch]
+                for condition, stim_label in ERP_CONDITIONS.items()
+            },
+            {
+                condition: erp_ci_by_channel[stim_label][ch]
+                for condition, stim_label in ERP_CONDITIONS.items()
+            },
+            ERP_COLORS,
+        )
+
         ax.set_title(
             f"{ch} (n={subject_counts[ch]} subjects)\n"
             f"Cue onset = 0 s"
@@ -761,7 +814,8 @@ def build_concat_epoch_report(subjects):
         (
             "Cue-locked ERP; cue onset = 0 s. "
             "ERP is calculated separately for PO3, PO4 and POz, "
-            "using only subjects with that channel available."
+            "using only subjects with that channel available. "
+            "Shaded: 95% bootstrap CI across the concatenated trials."
         ),
         "ERP",
     )
@@ -789,13 +843,11 @@ def build_concat_epoch_report(subjects):
 
             tfr_by_channel[
                 stim_label
-            ][ch] = (
+            ][ch] = compute_tfr(
                 concat_epochs_by_channel[
                     stim_label
-                ][ch]
-                .compute_tfr(
-                    **TFR_PARAMS
-                )
+                ][ch],
+                **TFR_PARAMS,
             )
 
             tfr_fname = op.join(
@@ -813,35 +865,31 @@ def build_concat_epoch_report(subjects):
     # ----------------------------------------------------------
     # Baseline-corrected condition TFRs
     #
-    # These are ONLY used for the separate stimulation and
-    # no-stimulation plots.
+    # The percent-change variants are built once per channel and
+    # condition, and shared by the separate stimulation and
+    # no-stimulation plots and the baselined difference below.
     #
     # The original tfr_by_channel objects remain unchanged and
     # are used for the contrast calculations below.
     # ----------------------------------------------------------
 
-    tfr_stim_baselined = {}
-    tfr_no_stim_baselined = {}
-
-    for ch in OCCIPITAL_CHANNELS:
-
-        tfr_stim_baselined[ch] = (
-            tfr_by_channel["stim"][ch].copy()
-        )
-
-        tfr_no_stim_baselined[ch] = (
-            tfr_by_channel["no-stim"][ch].copy()
-        )
+    tfr_variants = {
+        stim_label: {
+            ch: TFRVariants(tfr_by_channel[stim_label][ch])
+            for ch in OCCIPITAL_CHANNELS
+        }
+        for stim_label in tfr_by_channel
+    }
 
-        tfr_stim_baselined[ch].apply_baseline(
-            baseline=BASELINE,
-            mode="percent",
-        )
+    tfr_stim_baselined = {
+        ch: tfr_variants["stim"][ch].normalized(BASELINE, "percent")
+        for ch in OCCIPITAL_CHANNELS
+    }
 
-        tfr_no_stim_baselined[ch].apply_baseline(
-            baseline=BASELINE,
-            mode="percent",
-        )
+    tfr_no_stim_baselined = {
+        ch: tfr_variants["no-stim"][ch].normalized(BASELINE, "percent")
+        for ch in OCCIPITAL_CHANNELS
+    }
 
     # ----------------------------------------------------------
     # Difference and ratio
@@ -858,13 +906,9 @@ def build_concat_epoch_report(subjects):
 
     for ch in OCCIPITAL_CHANNELS:
 
-        stim_raw = tfr_by_channel[
-            "stim"
-        ][ch].copy()
+        stim_raw = tfr_variants["stim"][ch].raw
 
-        no_stim_raw = tfr_by_channel[
-            "no-stim"
-        ][ch].copy()
+        no_stim_raw = tfr_variants["no-stim"][ch].raw
 
         # ------------------------------------------------------
         # Difference
@@ -872,29 +916,18 @@ def build_concat_epoch_report(subjects):
 
         if apply_baseline_to_diff:
 
-            stim_diff = stim_raw.copy()
-            no_stim_diff = no_stim_raw.copy()
-
-            stim_diff.apply_baseline(
-                baseline=BASELINE,
-                mode="percent",
-            )
-
-            no_stim_diff.apply_baseline(
-                baseline=BASELINE,
-                mode="percent",
-            )
+            stim_diff = tfr_stim_baselined[ch]
+            no_stim_diff = tfr_no_stim_baselined[ch]
 
         else:
 
             stim_diff = stim_raw
             no_stim_diff = no_stim_raw
 
-        diff = stim_diff.copy()
-
-        diff.data = (
-            stim_diff.data
-            - no_stim_diff.data
+        diff = tfr_contrast(
+            stim_diff,
+            no_stim_diff,
+            "difference",
         )
 
         tfr_diff[ch] = diff
@@ -905,15 +938,10 @@ def build_concat_epoch_report(subjects):
         # ALWAYS calculated from RAW TFRs.
         # ------------------------------------------------------
 
-        ratio = stim_raw.copy()
-
-        ratio.data = (
-            stim_raw.data
-            - no_stim_raw.data
-        ) / (
-            stim_raw.data
-            + no_stim_raw.data
-            + np.finfo(float).eps
+        ratio = tfr_contrast(
+            stim_raw,
+            no_stim_raw,
+            "ratio",
         )
 
         tfr_ratio[ch] = ratio
@@ -1244,11 +1272,12 @@ def build_concat_epoch_report(subjects):
             f"group_{stim_label}_posterior-ROI_concat-epo.fif",
         )
 
-        roi_concat[
-            stim_label
-        ].save(
+        save_derivative(
+            roi_concat[
+                stim_label
+            ],
             fname,
-            overwrite=True,
+            policy=STORAGE_POLICY,
         )
 
 
@@ -1275,10 +1304,11 @@ def build_concat_epoch_report(subjects):
 
         roi_tfr[
             stim_label
-        ] = roi_concat[
-            stim_label
-        ].compute_tfr(
-            **TFR_PARAMS
+        ] = compute_tfr(
+            roi_concat[
+                stim_label
+            ],
+            **TFR_PARAMS,
         )
 
         fname = op.join(
@@ -1306,13 +1336,14 @@ def build_concat_epoch_report(subjects):
     #     stim - no-stim
     # ==========================================================
 
-    roi_stim_raw = roi_tfr[
-        "stim"
-    ].copy()
+    roi_variants = {
+        stim_label: TFRVariants(tfr)
+        for stim_label, tfr in roi_tfr.items()
+    }
+
+    roi_stim_raw = roi_variants["stim"].raw
 
-    roi_no_stim_raw = roi_tfr[
-        "no-stim"
-    ].copy()
+    roi_no_stim_raw = roi_variants["no-stim"].raw
 
     # ----------------------------------------------------------
     # ROI difference
@@ -1320,29 +1351,18 @@ def build_concat_epoch_report(subjects):
 
     if apply_baseline_to_diff:
 
-        roi_stim_diff = roi_stim_raw.copy()
-        roi_no_stim_diff = roi_no_stim_raw.copy()
-
-        roi_stim_diff.apply_baseline(
-            baseline=BASELINE,
-            mode="percent",
-        )
-
-        roi_no_stim_diff.apply_baseline(
-            baseline=BASELINE,
-            mode="percent",
-        )
+        roi_stim_diff = roi_variants["stim"].normalized(BASELINE, "percent")
+        roi_no_stim_diff = roi_variants["no-stim"].normalized(BASELINE, "percent")
 
     else:
 
         roi_stim_diff = roi_stim_raw
         roi_no_stim_diff = roi_no_stim_raw
 
-    roi_diff = roi_stim_diff.copy()
-
-    roi_diff.data = (
-        roi_stim_diff.data
-        - roi_no_stim_diff.data
+    roi_diff = tfr_contrast(
+        roi_stim_diff,
+        roi_no_stim_diff,
+        "difference",
     )
 
     # ----------------------------------------------------------
@@ -1351,15 +1371,10 @@ def build_concat_epoch_report(subjects):
     # ALWAYS calculated from RAW TFRs.
     # ----------------------------------------------------------
 
-    roi_ratio = roi_stim_raw.copy()
-
-    roi_ratio.data = (
-        roi_stim_raw.data
-        - roi_no_stim_raw.data
-    ) / (
-        roi_stim_raw.data
-        + roi_no_stim_raw.data
-        + np.finfo(float).eps
+    roi_ratio = tfr_contrast(
+        roi_stim_raw,
+        roi_no_stim_raw,
+        "ratio",
     )
 
     # ==========================================================
@@ -1367,13 +1382,13 @@ def build_concat_epoch_report(subjects):
     # ==========================================================
 
     fig_roi_no = plot_single_roi_tfr(
-        roi_tfr["no-stim"],
+        roi_variants["no-stim"].normalized(BASELINE, "percent"),
         (
             "Cue-locked posterior ROI TFR - "
             "no stimulation (combined attention)"
         ),
-        baseline=BASELINE,
-        mode="percent",
+        baseline=None,
+        mode=None,
         vlim=(-0.75, 0.75),
     )
 
@@ -1409,13 +1424,13 @@ def build_concat_epoch_report(subjects):
     # ==========================================================
 
     fig_roi_stim = plot_single_roi_tfr(
-        roi_tfr["stim"],
+        roi_variants["stim"].normalized(BASELINE, "percent"),
         (
             "Cue-locked posterior ROI TFR - "
             "stimulation (combined attention)"
         ),
-        baseline=BASELINE,
-        mode="percent",
+        baseline=None,
+        mode=None,
         vlim=(-0.75, 0.75),
     )
 
@@ -32,6 +32,9 @@ The report contains:
     - subjects contributing to each channel
     - analysis notes
 
+The single-trial P1/N1 tables written by A01 are also stacked into one
+long cohort table, group_erp-features.tsv, for mixed-effects modelling.
+
 TFR settings match G01:
     2-31.5 Hz, 0.5-Hz steps, multitaper,
     n_cycles = frequency / 2, time-bandwidth = 2,
@@ -69,11 +72,20 @@ import numpy as np
 
 from group_utils import (
     add_analysis_notes_section,
+    add_ci_bands,
     add_subject_summary,
+    compute_tfr,
+    condition_colors,
     ensure_dir,
+    evoked_windows,
     make_report,
+    read_cohort_erp_features,
     read_subject_epochs,
     read_subject_evokeds,
+    subject_ci,
+    TFRVariants,
+    tfr_contrast,
+    write_features,
 )
 
 # -----------------------
@@ -88,6 +100,14 @@ GROUP_DERIV_DIR = op.join(BIDS_ROOT, "derivatives", "group", "grand_average")
 REPORT_TITLE = "Grand average across subjects"
 
 OCCIPITAL_CHANNELS = ["PO3", "PO4", "POz"]
+
+# Cue-locked ERP window, cut from one 30 Hz low-passed average per subject.
+CUE_WINDOW = {"cue": dict(tmin=-0.1, tmax=1.0, baseline=(-0.1, 0))}
+
+# Plot label -> stim label; the CI bands use the same colours as the lines.
+ERP_CONDITIONS = {"No stimulation": "no-stim", "Stimulation": "stim"}
+ERP_COLORS = condition_colors(ERP_CONDITIONS)
+
 SESSION = "01"
 TASK = "SpAtt"
 RUN = "01"
@@ -96,6 +116,8 @@ BASELINE = (-0.3, -0.1)
 FREQS = np.arange(2, 32, 0.5)
 N_CYCLES = FREQS / 2.0
 TIME_BANDWIDTH = 2.0
+# Passed to tfr_engine.compute_tfr, which caches the DPSS kernel FFTs
+# across subjects, channels and runs.
 TFR_PARAMS = dict(
     method="multitaper",
     freqs=FREQS,
@@ -303,6 +325,7 @@ def build_grand_average_report(subjects):
         subject_epochs[subject] = read_subject_epochs(
             BIDS_ROOT,
             subject,
+            channels=OCCIPITAL_CHANNELS,
         )
 
     # ----------------------------------------------------------
@@ -429,41 +452,34 @@ def build_grand_average_report(subjects):
         # Cue-locked ERP from cleaned epochs
         # ------------------------------------------------------
 
+        subject_channels = [
+            ch
+            for ch in OCCIPITAL_CHANNELS
+            if subject in subjects_by_channel[ch]
+        ]
+
         for stim_label in ["no-stim", "stim"]:
 
-            epochs = (
-                subject_epochs[subject][stim_label]
-                .copy()
-            )
+            if not subject_channels:
+                break
 
-            for ch in OCCIPITAL_CHANNELS:
+            # Channels are named explicitly, so a channel marked bad is
+            # averaged exactly as the single-channel picks did before.
+            cue_window = evoked_windows(
+                subject_epochs[subject][stim_label],
+                CUE_WINDOW,
+                picks=subject_channels,
+                h_freq=30,
+            )["cue"]
 
-                if subject not in subjects_by_channel[ch]:
-                    continue
+            for ch in subject_channels:
 
-                subject_channel_epochs = (
-                    epochs
+                cue_evoked = (
+                    cue_window
                     .copy()
                     .pick([ch])
                 )
 
-                cue_evoked = (
-                    subject_channel_epochs
-                    .average()
-                    .filter(
-                        l_freq=None,
-                        h_freq=30,
-                    )
-                    .crop(
-                        tmin=-0.1,
-                        tmax=1.0,
-                    )
-                )
-
-                cue_evoked.apply_baseline(
-                    baseline=(-0.1, 0),
-                )
-
                 cue_evoked.comment = (
                     f"sub-{subject}, {stim_label}, "
                     f"{ch}, cue-locked"
@@ -556,6 +572,28 @@ def build_grand_average_report(subjects):
                     ][ch]
                 )
 
+    # ----------------------------------------------------------
+    # Single-trial P1/N1 features across the cohort
+    # ----------------------------------------------------------
+
+    cohort_features = read_cohort_erp_features(
+        BIDS_ROOT,
+        subjects,
+    )
+
+    features_fname = write_features(
+        op.join(
+            GROUP_DERIV_DIR,
+            "group_erp-features.tsv",
+        ),
+        cohort_features,
+    )
+
+    print(
+        f"Wrote cohort single-trial ERP features "
+        f"({len(cohort_features)} rows): {features_fname}"
+    )
+
     # ----------------------------------------------------------
     # Cue-locked grand-average ERP
     # ----------------------------------------------------------
@@ -586,14 +624,11 @@ def build_grand_average_report(subjects):
 
         mne.viz.plot_compare_evokeds(
             {
-                "No stimulation": grand_cue_evoked[
-                    "no-stim"
-                ][ch],
-                "Stimulation": grand_cue_evoked[
-                    "stim"
-                ][ch],
+                condition: grand_cue_evoked[stim_label][ch]
+                for condition, stim_label in ERP_CONDITIONS.items()
             },
             picks=[ch],
+            colors=ERP_COLORS,
             axes=ax,
             show=False,
             ci=False,
@@ -601,6 +636,23 @@ def build_grand_average_report(subjects):
             truncate_yaxis=False,
         )
 
+        # Bootstrap over subjects: each subject average is one observation.
+        add_ci_bands(
+            ax,
+            {
+                condition: grand_cue_evoked[stim_label][ch]
+                for condition, stim_label in ERP_CONDITIONS.items()
+            },
+            {
+                condition: subject_ci(
+                    cue_evoked_by_channel[stim_label][ch],
+                    ch,
+                )
+                for condition, stim_label in ERP_CONDITIONS.items()
+            },
+            ERP_COLORS,
+        )
+
         ax.axvline(
             0,
             linestyle="--",
@@ -637,7 +689,8 @@ def build_grand_average_report(subjects):
         (
             "Each subject is averaged first, then subject averages are "
             "grand-averaged. Cue onset = 0 s. "
-            "Only subjects with the relevant posterior channel contribute."
+            "Only subjects with the relevant posterior channel contribute. "
+            "Shaded: 95% bootstrap CI across subjects."
         ),
         "ERP",
     )
@@ -672,14 +725,11 @@ def build_grand_average_report(subjects):
 
         mne.viz.plot_compare_evokeds(
             {
-                "No stimulation": grand_grating_evoked[
-                    "no-stim"
-                ][ch],
-                "Stimulation": grand_grating_evoked[
-                    "stim"
-                ][ch],
+                condition: grand_grating_evoked[stim_label][ch]
+                for condition, stim_label in ERP_CONDITIONS.items()
             },
             picks=[ch],
+            colors=ERP_COLORS,
             axes=ax,
             show=False,
             ci=False,
@@ -687,6 +737,23 @@ def build_grand_average_report(subjects):
             truncate_yaxis=False,
         )
 
+        # Bootstrap over subjects: each subject average is one observation.
+        add_ci_bands(
+            ax,
+            {
+                condition: grand_grating_evoked[stim_label][ch]
+                for condition, stim_label in ERP_CONDITIONS.items()
+            },
+            {
+                condition: subject_ci(
+                    grating_evoked_by_channel[stim_label][ch],
+                    ch,
+                )
+                for condition, stim_label in ERP_CONDITIONS.items()
+            },
+            ERP_COLORS,
+        )
+
         ax.axvline(
             0,
             linestyle="--",
@@ -722,7 +789,8 @@ def build_grand_average_report(subjects):
         "Grand-average grating-locked ERP",
         (
             "Each subject is averaged first, then subject averages are "
-            "grand-averaged. Grating onset = 0 s."
+            "grand-averaged. Grating onset = 0 s. "
+            "Shaded: 95% bootstrap CI across subjects."
         ),
         "ERP",
     )
@@ -802,11 +870,9 @@ def build_grand_average_report(subjects):
                     f"sub-{subject}, {stim_label}, {ch}"
                 )
 
-                subject_tfr = (
-                    channel_epochs
-                    .compute_tfr(
-                        **TFR_PARAMS
-                    )
+                subject_tfr = compute_tfr(
+                    channel_epochs,
+                    **TFR_PARAMS,
                 )
 
                 # Keep the subject identity in the comment.
@@ -877,18 +943,32 @@ def build_grand_average_report(subjects):
     #   ALWAYS uses the original, non-baseline-corrected TFRs
     # ----------------------------------------------------------
 
+    # Percent-change variants are built once and shared by the
+    # stim / no-stim plots and the baselined difference.
+    grand_tfr_variants = {
+        stim_label: {
+            ch: TFRVariants(tfr)
+            for ch, tfr in by_channel.items()
+        }
+        for stim_label, by_channel in grand_tfr_by_channel.items()
+    }
+
+    grand_tfr_baselined = {
+        stim_label: {
+            ch: variants.normalized(BASELINE, "percent")
+            for ch, variants in by_channel.items()
+        }
+        for stim_label, by_channel in grand_tfr_variants.items()
+    }
+
     grand_tfr_diff = {}
     grand_tfr_ratio = {}
 
     for ch in OCCIPITAL_CHANNELS:
 
-        stim_raw = grand_tfr_by_channel[
-            "stim"
-        ][ch].copy()
+        stim_raw = grand_tfr_variants["stim"][ch].raw
 
-        no_stim_raw = grand_tfr_by_channel[
-            "no-stim"
-        ][ch].copy()
+        no_stim_raw = grand_tfr_variants["no-stim"][ch].raw
 
         # ------------------------------------------------------
         # Difference
@@ -896,29 +976,18 @@ def build_grand_average_report(subjects):
 
         if apply_baseline_to_diff:
 
-            stim_diff = stim_raw.copy()
-            no_stim_diff = no_stim_raw.copy()
-
-            stim_diff.apply_baseline(
-                baseline=BASELINE,
-                mode="percent",
-            )
-
-            no_stim_diff.apply_baseline(
-                baseline=BASELINE,
-                mode="percent",
-            )
+            stim_diff = grand_tfr_baselined["stim"][ch]
+            no_stim_diff = grand_tfr_baselined["no-stim"][ch]
 
         else:
 
             stim_diff = stim_raw
             no_stim_diff = no_stim_raw
 
-        diff = stim_diff.copy()
-
-        diff.data = (
-            stim_diff.data
-            - no_stim_diff.data
+        diff = tfr_contrast(
+            stim_diff,
+            no_stim_diff,
+            "difference",
         )
 
         grand_tfr_diff[ch] = diff
@@ -929,15 +998,10 @@ def build_grand_average_report(subjects):
         # ALWAYS calculated from RAW TFRs
         # ------------------------------------------------------
 
-        ratio = stim_raw.copy()
-
-        ratio.data = (
-            stim_raw.data
-            - no_stim_raw.data
-        ) / (
-            stim_raw.data
-            + no_stim_raw.data
-            + np.finfo(float).eps
+        ratio = tfr_contrast(
+            stim_raw,
+            no_stim_raw,
+            "ratio",
         )
 
         grand_tfr_ratio[ch] = ratio
@@ -956,15 +1020,15 @@ def build_grand_average_report(subjects):
     # ----------------------------------------------------------
 
     fig_tfr_no = plot_three_channel_tfrs(
-        grand_tfr_by_channel["no-stim"],
+        grand_tfr_baselined["no-stim"],
         OCCIPITAL_CHANNELS,
         subject_counts,
         (
             "Grand-average cue-locked TFR - "
             "no stimulation - combined attention"
         ),
-        baseline=BASELINE,
-        mode="percent",
+        baseline=None,
+        mode=None,
         vlim=(-0.75, 0.75),
     )
 
@@ -999,15 +1063,15 @@ def build_grand_average_report(subjects):
     # ----------------------------------------------------------
 
     fig_tfr_stim = plot_three_channel_tfrs(
-        grand_tfr_by_channel["stim"],
+        grand_tfr_baselined["stim"],
         OCCIPITAL_CHANNELS,
         subject_counts,
         (
             "Grand-average cue-locked TFR - "
             "stimulation - combined attention"
         ),
-        baseline=BASELINE,
-        mode="percent",
+        baseline=None,
+        mode=None,
         vlim=(-0.75, 0.75),
     )
 
@@ -1203,10 +1267,9 @@ def build_grand_average_report(subjects):
             )
 
             # Calculate the subject-level ROI TFR.
-            subject_roi_tfr = (
-                roi_epochs.compute_tfr(
-                    **TFR_PARAMS
-                )
+            subject_roi_tfr = compute_tfr(
+                roi_epochs,
+                **TFR_PARAMS,
             )
 
             subject_roi_tfr.comment = (
@@ -1274,13 +1337,14 @@ def build_grand_average_report(subjects):
     # ROI difference and ratio
     # ----------------------------------------------------------
 
-    roi_stim_raw = roi_grand_tfr[
-        "stim"
-    ].copy()
+    roi_variants = {
+        stim_label: TFRVariants(tfr)
+        for stim_label, tfr in roi_grand_tfr.items()
+    }
+
+    roi_stim_raw = roi_variants["stim"].raw
 
-    roi_no_stim_raw = roi_grand_tfr[
-        "no-stim"
-    ].copy()
+    roi_no_stim_raw = roi_variants["no-stim"].raw
 
     # ----------------------------------------------------------
     # ROI difference
@@ -1288,29 +1352,18 @@ def build_grand_average_report(subjects):
 
     if apply_baseline_to_diff:
 
-        roi_stim_diff = roi_stim_raw.copy()
-        roi_no_stim_diff = roi_no_stim_raw.copy()
-
-        roi_stim_diff.apply_baseline(
-            baseline=BASELINE,
-            mode="percent",
-        )
-
-        roi_no_stim_diff.apply_baseline(
-            baseline=BASELINE,
-            mode="percent",
-        )
+        roi_stim_diff = roi_variants["stim"].normalized(BASELINE, "percent")
+        roi_no_stim_diff = roi_variants["no-stim"].normalized(BASELINE, "percent")
 
     else:
 
         roi_stim_diff = roi_stim_raw
         roi_no_stim_diff = roi_no_stim_raw
 
-    roi_grand_diff = roi_stim_diff.copy()
-
-    roi_grand_diff.data = (
-        roi_stim_diff.data
-        - roi_no_stim_diff.data
+    roi_grand_diff = tfr_contrast(
+        roi_stim_diff,
+        roi_no_stim_diff,
+        "difference",
     )
 
     # ----------------------------------------------------------
@@ -1319,15 +1372,10 @@ def build_grand_average_report(subjects):
     # ALWAYS calculated from RAW TFRs
     # ----------------------------------------------------------
 
-    roi_grand_ratio = roi_stim_raw.copy()
-
-    roi_grand_ratio.data = (
-        roi_stim_raw.data
-        - roi_no_stim_raw.data
-    ) / (
-        roi_stim_raw.data
-        + roi_no_stim_raw.data
-        + np.finfo(float).eps
+    roi_grand_ratio = tfr_contrast(
+        roi_stim_raw,
+        roi_no_stim_raw,
+        "ratio",
     )
 
     # ==========================================================
@@ -1335,13 +1383,13 @@ def build_grand_average_report(subjects):
     # ==========================================================
 
     fig_roi_no = plot_single_roi_tfr(
-        roi_grand_tfr["no-stim"],
+        roi_variants["no-stim"].normalized(BASELINE, "percent"),
         (
             "Grand-average cue-locked posterior ROI TFR - "
             "no stimulation"
         ),
-        baseline=BASELINE,
-        mode="percent",
+        baseline=None,
+        mode=None,
         vlim=(-0.75, 0.75),
     )
 
@@ -1372,13 +1420,13 @@ def build_grand_average_report(subjects):
 
 
     fig_roi_stim = plot_single_roi_tfr(
-        roi_grand_tfr["stim"],
+        roi_variants["stim"].normalized(BASELINE, "percent"),
         (
             "Grand-average cue-locked posterior ROI TFR - "
             "stimulation"
         ),
-        baseline=BASELINE,
-        mode="percent",
+        baseline=None,
+        mode=None,
         vlim=(-0.75, 0.75),
     )
 
@@ -0,0 +1,340 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+==============================================================
+G03. Peak alpha frequency across subjects
+==============================================================
+
+This script estimates the peak alpha frequency (PAF) of every subject,
+stimulation condition and posterior channel from the cue-epoch spectra
+written by P03 (*_psd-cue.npz). No epochs are read and no TFR is
+calculated.
+
+PAF estimation
+--------------
+    - the aperiodic 1/f component, log10 P = offset - exponent *
+      log10 f, is fitted over 2-40 Hz with 7-14 Hz left out
+    - it is subtracted from the spectrum
+    - the PAF is the maximum of the remaining (periodic) spectrum
+      within 7-14 Hz, refined between frequency bins
+
+All spectra of the cohort are fitted together in one least-squares
+computation (analysis/utils/paf.py). Channels that a subject does not
+have are left empty. Spectra without a clear alpha peak get no PAF.
+
+Outputs
+-------
+    - group_paf.tsv: one row per subject, condition and channel with
+      the PAF, the peak height and the aperiodic offset / exponent
+    - flattened spectra per channel, stim vs no-stim
+    - PAF per subject, stim vs no-stim
+
+With --paf-bands yes, the subject runner centres the alpha band of A02
+and the MI band of A03 on each subject's PAF (+/- 2 Hz) from
+group_paf.tsv.
+
+written by Tara Ghafari
+tara.ghafari@gmail.com
+==============================================================
+"""
+
+
+from __future__ import annotations
+import argparse
+
+import os.path as op
+import matplotlib.pyplot as plt
+
+import numpy as np
+
+from group_utils import (
+    PAF_FNAME,
+    PAF_RANGE,
+    add_analysis_notes_section,
+    add_subject_summary,
+    ensure_dir,
+    flattened_spectrum,
+    make_report,
+    paf_table,
+    peak_alpha,
+    read_cohort_psds,
+    write_paf,
+)
+
+# -----------------------
+# Config
+# -----------------------
+PROJECT_ROOT = "/Users/taraghafari/Desktop/Desktop - Tara’s MacBook Pro/BEAR_outage/STN-in-PD"
+BIDS_ROOT = op.join(PROJECT_ROOT, "data", "BIDS")
+
+GROUP_REPORT_DIR = op.join(PROJECT_ROOT, "derivatives", "reports", "group", "paf")
+GROUP_DERIV_DIR = op.join(BIDS_ROOT, "derivatives", "group", "paf")
+
+REPORT_TITLE = "Peak alpha frequency across subjects"
+
+OCCIPITAL_CHANNELS = ["PO3", "PO4", "POz"]
+LABELS = ["no-stim", "stim"]
+PLOT_FMAX = 40.0
+
+
+def parse_args():
+    """Get the subjects to include in the group analysis."""
+
+    parser = argparse.ArgumentParser(
+        description=(
+            "Run G03 peak alpha frequency estimation "
+            "for selected subjects."
+        )
+    )
+
+    parser.add_argument(
+        "--subjects",
+        nargs="+",
+        required=True,
+        help=(
+            "Subject numbers to include, e.g. "
+            "--subjects 115 116 118 119"
+        ),
+    )
+
+    return parser.parse_args()
+
+
+def plot_flattened_spectra(freqs, flat, paf):
+    """Mean periodic spectrum per channel, stim vs no-stim, with the PAFs."""
+
+    keep = freqs <= PLOT_FMAX
+
+    fig, axes = plt.subplots(
+        1,
+        len(OCCIPITAL_CHANNELS),
+        figsize=(18, 5),
+        constrained_layout=True,
+    )
+
+    for ci, (ax, ch) in enumerate(zip(axes, OCCIPITAL_CHANNELS)):
+
+        for li, stim_label in enumerate(LABELS):
+
+            spectra = flat[:, li, ci, keep]
+            n_subjects = int(np.isfinite(spectra).all(axis=-1).sum())
+            line, = ax.plot(
+                freqs[keep],
+                np.nanmean(spectra, axis=0),
+                linewidth=2,
+                label=f"{stim_label} (n={n_subjects})",
+            )
+
+            for spectrum in spectra:
+                ax.plot(freqs[keep], spectrum, color=line.get_color(),
+                        linewidth=0.5, alpha=0.3)
+
+            mean_paf = np.nanmean(paf[:, li, ci])
+            if np.isfinite(mean_paf):
+                ax.axvline(mean_paf, color=line.get_color(), linestyle="--",
+                           linewidth=1)
+
+        ax.axvspan(*PAF_RANGE, color="0.9", zorder=0)
+        ax.axhline(0, color="k", linewidth=1)
+        ax.set_xlabel("Frequency (Hz)")
+        ax.set_ylabel("log10 power above 1/f fit")
+        ax.set_title(ch)
+        ax.legend()
+
+    fig.suptitle(
+        "Periodic spectrum after removing the aperiodic component",
+        fontsize=14,
+    )
+
+    return fig
+
+
+def plot_subject_paf(subjects, paf):
+    """PAF of every subject, no-stim vs stim, per channel."""
+
+    fig, axes = plt.subplots(
+        1,
+        len(OCCIPITAL_CHANNELS),
+        figsize=(18, 5),
+        sharey=True,
+        constrained_layout=True,
+    )
+
+    x = np.arange(len(LABELS))
+
+    for ci, (ax, ch) in enumerate(zip(axes, OCCIPITAL_CHANNELS)):
+
+        for si, subject in enumerate(subjects):
+            ax.plot(x, paf[si, :, ci], marker="o", color="0.5", linewidth=1)
+
+        ax.plot(x, np.nanmean(paf[:, :, ci], axis=0), marker="o",
+                color="k", linewidth=2, label="mean")
+        ax.set_xticks(x, LABELS)
+        ax.set_xlim(-0.5, len(LABELS) - 0.5)
+        ax.set_ylabel("PAF (Hz)")
+        ax.set_title(ch)
+        ax.legend()
+
+    fig.suptitle(
+        "Peak alpha frequency per subject",
+        fontsize=14,
+    )
+
+    return fig
+
+
+def build_paf_report(subjects):
+
+    ensure_dir(GROUP_REPORT_DIR)
+    ensure_dir(GROUP_DERIV_DIR)
+
+    REPORT_NAME = "group_paf_" + "_".join(subjects)
+
+    report = make_report(GROUP_REPORT_DIR, REPORT_NAME)
+    report.add_text(
+        "Group analysis summary",
+        (
+            f"Report: {REPORT_TITLE}\n"
+            f"Subjects analysed: "
+            f"{', '.join('sub-' + s for s in subjects)}\n"
+            f"Number of subjects: {len(subjects)}"
+        ),
+        "Group analysis",
+    )
+    add_subject_summary(report, subjects)
+
+    # ----------------------------------------------------------
+    # Fit the whole cohort at once
+    #
+    # psds: (n_subjects, no-stim/stim, n_channels, n_freqs)
+    # ----------------------------------------------------------
+
+    freqs, psds = read_cohort_psds(
+        BIDS_ROOT,
+        subjects,
+        OCCIPITAL_CHANNELS,
+    )
+
+    result = peak_alpha(freqs, psds)
+
+    table = paf_table(
+        subjects,
+        LABELS,
+        OCCIPITAL_CHANNELS,
+        result,
+    )
+
+    paf_fname = write_paf(
+        op.join(GROUP_DERIV_DIR, PAF_FNAME),
+        table,
+    )
+
+    print(
+        f"Wrote cohort PAF table "
+        f"({len(table)} rows): {paf_fname}"
+    )
+
+    summary = table.groupby(["stim", "channel"])["paf"].agg(
+        ["mean", "std", "count"]
+    )
+    lines = [
+        f"{stim_label}, {ch}: {row['mean']:.2f} +/- {row['std']:.2f} Hz "
+        f"(n={int(row['count'])})"
+        for (stim_label, ch), row in summary.iterrows()
+    ]
+    n_missing = int(table["paf"].isna().sum())
+    report.add_text(
+        "Peak alpha frequency",
+        "\n".join(lines)
+        + f"\n\nSpectra without an alpha peak or channel: {n_missing}",
+        "PAF",
+    )
+
+    # ----------------------------------------------------------
+    # Figures
+    # ----------------------------------------------------------
+
+    flat = flattened_spectrum(
+        freqs,
+        psds,
+        result["offset"],
+        result["exponent"],
+    )
+
+    fig_flat = plot_flattened_spectra(freqs, flat, result["paf"])
+
+    fname = op.join(
+        GROUP_REPORT_DIR,
+        "group_paf_flattened_spectra.png",
+    )
+
+    fig_flat.savefig(
+        fname,
+        dpi=180,
+        bbox_inches="tight",
+    )
+
+    report.add_figure(
+        fig_flat,
+        fname,
+        "Periodic spectra",
+        (
+            "P03 cue-epoch spectra minus the aperiodic fit (2-40 Hz, "
+            "7-14 Hz excluded). Thin lines: subjects; thick lines: mean; "
+            "dashed lines: mean PAF; shaded: PAF search range."
+        ),
+        "PAF",
+    )
+
+    fig_paf = plot_subject_paf(subjects, result["paf"])
+
+    fname = op.join(
+        GROUP_REPORT_DIR,
+        "group_paf_by_subject.png",
+    )
+
+    fig_paf.savefig(
+        fname,
+        dpi=180,
+        bbox_inches="tight",
+    )
+
+    report.add_figure(
+        fig_paf,
+        fname,
+        "Peak alpha frequency per subject",
+        (
+            "Grey: one subject; black: mean across subjects. "
+            "Subjects without a peak or channel are not shown."
+        ),
+        "PAF",
+    )
+
+    add_analysis_notes_section(
+        report,
+        prompt_text="Analysis notes",
+    )
+
+    print(
+        f"\nGroup report completed:\n"
+        f"{report.pdf_fname}"
+    )
+
+
+if __name__ == "__main__":
+
+    args = parse_args()
+
+    subjects = [
+        str(s).removeprefix("sub-")
+        for s in args.subjects
+    ]
+
+    print(
+        "\nSubjects included in G03:"
+        f"\n  {', '.join('sub-' + s for s in subjects)}\n"
+    )
+
+    build_paf_report(
+        subjects
+    )
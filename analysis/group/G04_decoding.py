@@ -0,0 +1,408 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+==============================================================
+G04. Time-resolved decoding across subjects
+==============================================================
+
+This script decodes, separately for every subject, from the cleaned
+cue epochs (*_epo-cue.fif):
+
+    - stimulation vs no stimulation
+    - attend right vs attend left, within no-stim
+    - attend right vs attend left, within stim
+
+at every time point, from the pattern over all good EEG channels that
+both stimulation conditions share.
+
+Features
+--------
+    erp     the signal low-passed at 20 Hz (default)
+    alpha   log alpha power (8-14 Hz) from the Hilbert filter bank
+            of A02 (analysis/utils/band_power.py)
+
+Both are taken at 50 Hz.
+
+Classifier
+----------
+A linear discriminant with Ledoit-Wolf shrinkage, scored by the
+cross-validated area under the ROC curve (AUC; 0.5 = chance) with
+five stratified folds. The folds are drawn once per subject and
+contrast. Blocks of time points are fitted together and run in
+parallel threads (analysis/utils/decoding.py), so the whole cohort
+takes minutes on a CPU.
+
+Outputs
+-------
+    - group_decoding-<features>.npz: AUC per subject, contrast and
+      time point
+    - group AUC time courses (mean +/- SEM across subjects)
+
+No statistical testing is performed here.
+
+written by Tara Ghafari
+tara.ghafari@gmail.com
+==============================================================
+"""
+
+
+from __future__ import annotations
+import argparse
+import time
+
+import os.path as op
+import matplotlib.pyplot as plt
+
+import numpy as np
+
+from group_utils import (
+    BANDS,
+    add_analysis_notes_section,
+    add_subject_summary,
+    decimation,
+    decode_over_time,
+    ensure_dir,
+    epochs_band_power,
+    filter_inst,
+    make_report,
+    read_subject_epochs,
+    stratified_folds,
+    write_decoding,
+)
+
+# -----------------------
+# Config
+# -----------------------
+PROJECT_ROOT = "/Users/taraghafari/Desktop/Desktop - Tara’s MacBook Pro/BEAR_outage/STN-in-PD"
+BIDS_ROOT = op.join(PROJECT_ROOT, "data", "BIDS")
+
+GROUP_REPORT_DIR = op.join(PROJECT_ROOT, "derivatives", "reports", "group", "decoding")
+GROUP_DERIV_DIR = op.join(BIDS_ROOT, "derivatives", "group", "decoding")
+
+REPORT_TITLE = "Time-resolved decoding across subjects"
+
+LABELS = ["no-stim", "stim"]
+CUE_CONDITIONS = {"right": "cue_onset_right", "left": "cue_onset_left"}
+CONTRASTS = {
+    "stim vs no-stim": None,
+    "right vs left (no-stim)": "no-stim",
+    "right vs left (stim)": "stim",
+}
+
+ERP_H_FREQ = 20.0
+DECODE_SFREQ = 50.0
+N_FOLDS = 5
+RANDOM_STATE = 0
+
+
+def parse_args():
+    """Get the subjects and settings for the decoding analysis."""
+
+    parser = argparse.ArgumentParser(
+        description=(
+            "Run G04 time-resolved decoding "
+            "for selected subjects."
+        )
+    )
+
+    parser.add_argument(
+        "--subjects",
+        nargs="+",
+        required=True,
+        help=(
+            "Subject numbers to include, e.g. "
+            "--subjects 115 116 118 119"
+        ),
+    )
+
+    parser.add_argument(
+        "--features",
+        choices=["erp", "alpha"],
+        default="erp",
+        help="Low-passed signal or log alpha power (default: erp).",
+    )
+
+    parser.add_argument(
+        "--jobs",
+        type=int,
+        default=None,
+        help="Threads for the time points (default: all CPU cores).",
+    )
+
+    return parser.parse_args()
+
+
+def common_channels(epochs_by_label):
+    """Good EEG channels present in both stimulation conditions."""
+
+    picks = {
+        stim_label: set(
+            epochs.copy().pick("eeg", exclude="bads").ch_names
+        )
+        for stim_label, epochs in epochs_by_label.items()
+    }
+
+    return [
+        ch
+        for ch in epochs_by_label[LABELS[0]].ch_names
+        if all(ch in chs for chs in picks.values())
+    ]
+
+
+def subject_features(epochs_by_label, features):
+    """
+    Decoding features of one subject.
+
+    Returns ``stim_label -> (data (n_trials, n_channels, n_times),
+    attend-right mask)`` and the times, at DECODE_SFREQ.
+    """
+
+    channels = common_channels(epochs_by_label)
+
+    out = {}
+    times = None
+
+    for stim_label in LABELS:
+
+        epochs = (
+            epochs_by_label[stim_label][list(CUE_CONDITIONS.values())]
+            .copy()
+            .pick(channels)
+        )
+
+        if features == "erp":
+            filter_inst(epochs, None, ERP_H_FREQ)
+            data = epochs.get_data()
+            label_times = epochs.times
+            sfreq = epochs.info["sfreq"]
+        else:
+            power, label_times = epochs_band_power(
+                epochs,
+                {"alpha": BANDS["alpha"]},
+            )["alpha"]
+            data = np.log10(power)
+            sfreq = 1.0 / (label_times[1] - label_times[0])
+
+        decim = decimation(sfreq, DECODE_SFREQ)
+
+        codes = epochs.events[:, 2]
+        right = codes == epochs.event_id[CUE_CONDITIONS["right"]]
+
+        out[stim_label] = (
+            data[..., ::decim],
+            right,
+        )
+
+        if times is None:
+            times = label_times[::decim]
+
+    return out, times
+
+
+def decode_subject(by_label, n_jobs):
+    """AUC time course of every contrast for one subject."""
+
+    auc = []
+
+    for stim_label in CONTRASTS.values():
+
+        if stim_label is None:
+            data = np.concatenate(
+                [by_label[label][0] for label in LABELS]
+            )
+            y = np.concatenate([
+                np.full(len(by_label[label][0]), li)
+                for li, label in enumerate(LABELS)
+            ])
+        else:
+            data, y = by_label[stim_label]
+            y = y.astype(int)
+
+        folds = stratified_folds(
+            y,
+            n_folds=N_FOLDS,
+            random_state=RANDOM_STATE,
+        )
+
+        auc.append(
+            decode_over_time(
+                data,
+                y,
+                folds=folds,
+                n_jobs=n_jobs,
+            )
+        )
+
+    return np.stack(auc)
+
+
+def plot_group_auc(times, auc, features):
+    """Mean +/- SEM AUC across subjects for every contrast."""
+
+    fig, axes = plt.subplots(
+        1,
+        len(CONTRASTS),
+        figsize=(18, 5),
+        sharey=True,
+        constrained_layout=True,
+    )
+
+    n_subjects = len(auc)
+
+    for ci, (ax, contrast) in enumerate(zip(axes, CONTRASTS)):
+
+        mean = auc[:, ci].mean(axis=0)
+        sem = (
+            auc[:, ci].std(axis=0, ddof=1) / np.sqrt(n_subjects)
+            if n_subjects > 1
+            else np.zeros_like(mean)
+        )
+
+        ax.plot(times, mean, color="k", linewidth=2)
+        ax.fill_between(times, mean - sem, mean + sem,
+                        color="k", alpha=0.2, linewidth=0)
+        ax.axhline(0.5, color="0.5", linestyle="--", linewidth=1)
+        ax.axvline(0, color="k", linestyle="--", linewidth=1)
+        ax.set_xlabel("Time (s)")
+        ax.set_ylabel("AUC")
+        ax.set_title(contrast)
+
+    fig.suptitle(
+        f"Decoding ({features} features), n={n_subjects} subjects",
+        fontsize=14,
+    )
+
+    return fig
+
+
+def build_decoding_report(subjects, features, n_jobs=None):
+
+    ensure_dir(GROUP_REPORT_DIR)
+    ensure_dir(GROUP_DERIV_DIR)
+
+    REPORT_NAME = f"group_decoding_{features}_" + "_".join(subjects)
+
+    report = make_report(GROUP_REPORT_DIR, REPORT_NAME)
+    report.add_text(
+        "Group analysis summary",
+        (
+            f"Report: {REPORT_TITLE}\n"
+            f"Features: {features}\n"
+            f"Subjects analysed: "
+            f"{', '.join('sub-' + s for s in subjects)}\n"
+            f"Number of subjects: {len(subjects)}"
+        ),
+        "Group analysis",
+    )
+    add_subject_summary(report, subjects)
+
+    # ----------------------------------------------------------
+    # Decode every subject separately
+    # ----------------------------------------------------------
+
+    times = None
+    auc = []
+
+    for subject in subjects:
+
+        start = time.perf_counter()
+
+        by_label, subject_times = subject_features(
+            read_subject_epochs(BIDS_ROOT, subject),
+            features,
+        )
+
+        if times is None:
+            times = subject_times
+        elif not np.allclose(subject_times, times):
+            raise ValueError(
+                f"sub-{subject} epoch times differ from the cohort."
+            )
+
+        auc.append(decode_subject(by_label, n_jobs))
+
+        print(
+            f"sub-{subject}: decoded {len(CONTRASTS)} contrasts at "
+            f"{len(times)} time points in "
+            f"{time.perf_counter() - start:.1f} s"
+        )
+
+    auc = np.stack(auc)
+
+    fname = write_decoding(
+        op.join(GROUP_DERIV_DIR, f"group_decoding-{features}.npz"),
+        subjects,
+        list(CONTRASTS),
+        times,
+        auc,
+    )
+
+    print(f"Wrote cohort decoding results: {fname}")
+
+    # ----------------------------------------------------------
+    # Group AUC time courses
+    # ----------------------------------------------------------
+
+    fig_auc = plot_group_auc(times, auc, features)
+
+    fname = op.join(
+        GROUP_REPORT_DIR,
+        f"group_decoding_{features}_auc.png",
+    )
+
+    fig_auc.savefig(
+        fname,
+        dpi=180,
+        bbox_inches="tight",
+    )
+
+    feature_caption = (
+        f"signal low-passed at {ERP_H_FREQ:g} Hz"
+        if features == "erp"
+        else "log alpha power (Hilbert, 8-14 Hz)"
+    )
+
+    report.add_figure(
+        fig_auc,
+        fname,
+        "Time-resolved decoding",
+        (
+            "Cue onset = 0 s. Shrinkage LDA over all good EEG channels "
+            f"shared by both conditions; {feature_caption}, "
+            f"{DECODE_SFREQ:g} Hz; {N_FOLDS}-fold stratified "
+            "cross-validation. Mean +/- SEM AUC across subjects; "
+            "dashed line: chance."
+        ),
+        "Decoding",
+    )
+
+    add_analysis_notes_section(
+        report,
+        prompt_text="Analysis notes",
+    )
+
+    print(
+        f"\nGroup report completed:\n"
+        f"{report.pdf_fname}"
+    )
+
+
+if __name__ == "__main__":
+
+    args = parse_args()
+
+    subjects = [
+        str(s).removeprefix("sub-")
+        for s in args.subjects
+    ]
+
+    print(
+        "\nSubjects included in G04:"
+        f"\n  {', '.join('sub-' + s for s in subjects)}\n"
+    )
+
+    build_decoding_report(
+        subjects,
+        args.features,
+        n_jobs=args.jobs,
+    )
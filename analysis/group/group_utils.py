@@ -13,10 +13,20 @@ Shared helper functions for the group-level EEG analyses:
         Calculates subject-level averages first and then
         combines subjects using mne.grand_average().
 
+    G03_peak_alpha_frequency.py
+        Estimates the peak alpha frequency of every subject,
+        condition and channel from the P03 spectra.
+
+    G04_decoding.py
+        Decodes stim vs no-stim and attend right vs left at
+        every time point for every subject.
+
 This module provides functions to:
     - load and save the group subject list
     - locate subject derivative folders
-    - load cleaned epochs, evoked responses, and TFRs
+    - load cleaned epochs (and their group-analysis interpolated
+      version), evoked responses, TFRs, the P03 epoch spectra and the
+      A01 single-trial ERP features and the A03 modulation indices
     - handle missing posterior channels
     - create standard ERP and TFR figures
     - create persistent PDF reports
@@ -31,7 +41,7 @@ Group analyses currently focus on posterior channels PO3, PO4, and POz.
 A channel may be absent if it was rejected during subject-level cleaning.
 
 This module contains shared utilities only; the actual group analyses
-are performed by G01 and G02.
+are performed by G01-G04.
 
 written by Tara Ghafari
 tara.ghafari@gmail.com
@@ -50,6 +60,7 @@ from typing import Dict, List, Sequence, Tuple
 import matplotlib.pyplot as plt
 import mne
 import numpy as np
+import pandas as pd
 from mne.time_frequency import read_tfrs
 
 import sys
@@ -62,6 +73,24 @@ UTILS_DIR = REPO_ROOT / "analysis" / "utils"
 if str(UTILS_DIR) not in sys.path:
     sys.path.insert(0, str(UTILS_DIR))
 
+# Shared with the subject-level scripts; the FIR kernels are designed once.
+from filter_cache import filter_inst
+from evoked_engine import evoked_windows, window_trials
+from bootstrap_ci import add_ci_bands, bootstrap_ci, condition_colors
+from derivative_storage import save_derivative
+from epochs_io import read_epochs_for_channels, read_group_epochs
+from psd_engine import read_psd
+from erp_features import read_features, write_features
+from tfr_engine import compute_tfr
+from tfr_variants import TFRVariants
+from tfr_contrast import tfr_contrast
+from tfr_store import STORE_SUFFIX, TFRStore
+from band_power import BANDS, decimation, epochs_band_power, read_band_power
+from decoding import decode_over_time, stratified_folds, write_decoding
+from lateralization import read_mi
+from paf import (PAF_FNAME, PAF_RANGE, flattened_spectrum, paf_table, peak_alpha,
+                 read_paf, write_paf)
+
 
 def ensure_dir(path: str | Path) -> str:
     path = str(path)
@@ -93,6 +122,7 @@ def subject_deriv_folder(bids_root: str, subject: str) -> str:
 def read_subject_epochs(
     bids_root: str,
     subject: str,
+    channels: Sequence[str] | None = None,
 ) -> dict:
     """
     Load the standard subject-level cleaned epochs for group analysis.
@@ -100,6 +130,9 @@ def read_subject_epochs(
     The group analysis uses the original cleaned epochs and does not use
     interpolated group-analysis epochs. Missing channels are handled later
     in G01 by including only subjects that have the channel available.
+
+    When `channels` is given, the compact posterior-ROI epochs written by
+    P03 (*_epo-cue-roi.fif) are read instead if they contain those channels.
     """
 
     deriv_folder = subject_deriv_folder(
@@ -133,9 +166,61 @@ def read_subject_epochs(
             "using standard cleaned epochs"
         )
 
-        out[stim_label] = mne.read_epochs(
+        out[stim_label] = read_epochs_for_channels(
+            fname,
+            channels,
+            verbose=True,
+        )
+
+    return out
+
+def read_subject_group_epochs(
+    bids_root: str,
+    subject: str,
+) -> dict:
+    """
+    Load the group-analysis epochs, with rejected posterior channels
+    interpolated.
+
+    P03 stores these as a small delta next to the cleaned epochs
+    (*_epo-cue-group.npz); they are rebuilt here from both files. A full
+    *_epo-cue-group.fif written after P03 (e.g. the sub-119 POz fix) is
+    read instead.
+    """
+
+    deriv_folder = subject_deriv_folder(
+        bids_root,
+        subject,
+    )
+
+    base = (
+        f"sub-{subject}"
+        "_ses-01_task-SpAtt_run-01_eeg"
+    )
+
+    out = {}
+
+    for stim_label in ["no-stim", "stim"]:
+
+        fname = op.join(
+            deriv_folder,
+            f"{base}_{stim_label}_epo-cue.fif",
+        )
+
+        if not op.exists(fname):
+            raise FileNotFoundError(
+                f"Missing cleaned epochs for "
+                f"sub-{subject} {stim_label}:\n"
+                f"{fname}"
+            )
+
+        print(
+            f"sub-{subject} {stim_label}: "
+            "using group-analysis (interpolated) epochs"
+        )
+
+        out[stim_label] = read_group_epochs(
             fname,
-            preload=True,
             verbose=True,
         )
 
@@ -169,6 +254,133 @@ def read_subject_tfrs(bids_root: str, subject: str) -> dict:
             out[(stim_label, cue)] = read_tfrs(fname)[0]
     return out
 
+def read_subject_tfr_store(bids_root: str, subject: str, stim_label: str) -> TFRStore:
+    """Open the A02 single-trial TFR store (written with single_trial_tfr = 'yes')."""
+    deriv_folder = subject_deriv_folder(bids_root, subject)
+    base = f"sub-{subject}_ses-01_task-SpAtt_run-01_eeg"
+    path = op.join(deriv_folder, f"{base}_{stim_label}{STORE_SUFFIX}")
+    if not op.exists(path):
+        raise FileNotFoundError(f"Missing single-trial TFR store: {path}")
+    return TFRStore(path)
+
+def read_subject_band_power(bids_root: str, subject: str) -> dict:
+    """A02 alpha/gamma time courses: ``stim_label -> band -> (side -> power, times)``."""
+    deriv_folder = subject_deriv_folder(bids_root, subject)
+    base = f"sub-{subject}_ses-01_task-SpAtt_run-01_eeg"
+    out = {}
+    for stim_label in ["no-stim", "stim"]:
+        fname = op.join(deriv_folder, f"{base}_{stim_label}_band-power.npz")
+        if not op.exists(fname):
+            raise FileNotFoundError(f"Missing band-power file: {fname}")
+        out[stim_label] = read_band_power(fname)
+    return out
+
+def read_subject_mi(bids_root: str, subject: str) -> dict:
+    """A03 modulation index and single-trial lateralization of one subject."""
+    deriv_folder = subject_deriv_folder(bids_root, subject)
+    base = f"sub-{subject}_ses-01_task-SpAtt_run-01_eeg"
+    fname = op.join(deriv_folder, f"{base}_mi.npz")
+    if not op.exists(fname):
+        raise FileNotFoundError(f"Missing MI file: {fname}")
+    return read_mi(fname)
+
+
+def read_cohort_mi(
+    bids_root: str,
+    subjects: Sequence[str],
+    channels: Sequence[str],
+) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Stack the A03 modulation indices of several subjects.
+
+    Returns the frequencies, the times and an array of shape
+    (n_subjects, 2, n_channels, n_freqs, n_times) ordered as no-stim, stim.
+    Channels that a subject does not have (e.g. rejected) are NaN.
+    """
+    freqs = times = None
+    stacked = []
+    for subject in subjects:
+        mi = read_subject_mi(bids_root, subject)
+        if freqs is None:
+            freqs, times = mi["freqs"], mi["times"]
+        elif not (np.allclose(mi["freqs"], freqs) and np.allclose(mi["times"], times)):
+            raise ValueError(f"sub-{subject} MI frequencies or times differ from the cohort.")
+        out = np.full((2, len(channels), len(freqs), len(times)), np.nan)
+        for li, stim_label in enumerate(["no-stim", "stim"]):
+            for ci, ch in enumerate(channels):
+                if ch in mi["ch_names"]:
+                    out[li, ci] = mi["mi"][stim_label][mi["ch_names"].index(ch)]
+        stacked.append(out)
+    return freqs, times, np.stack(stacked)
+
+
+def read_subject_psd(bids_root: str, subject: str) -> dict:
+    """Epoch-averaged cue-epoch spectra of both labels, written by P03."""
+    deriv_folder = subject_deriv_folder(bids_root, subject)
+    base = f"sub-{subject}_ses-01_task-SpAtt_run-01_eeg"
+    fname = op.join(deriv_folder, f"{base}_psd-cue.npz")
+    if not op.exists(fname):
+        raise FileNotFoundError(f"Missing PSD file: {fname}")
+    return read_psd(fname)
+
+
+def read_cohort_psds(
+    bids_root: str,
+    subjects: Sequence[str],
+    channels: Sequence[str],
+) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Stack the P03 spectra of several subjects for cohort-level QC.
+
+    Returns the frequencies and an array of shape
+    (n_subjects, 2, n_channels, n_freqs) ordered as no-stim, stim.
+    Channels that a subject does not have (e.g. rejected) are NaN.
+    """
+    freqs = None
+    stacked = []
+    for subject in subjects:
+        psd = read_subject_psd(bids_root, subject)
+        if freqs is None:
+            freqs = psd["freqs"]
+        elif not np.allclose(psd["freqs"], freqs):
+            raise ValueError(f"sub-{subject} PSD frequencies differ from the cohort.")
+        out = np.full((2, len(channels), len(freqs)), np.nan)
+        for li, stim_label in enumerate(["no-stim", "stim"]):
+            label_idx = psd["labels"].index(stim_label)
+            for ci, ch in enumerate(channels):
+                if ch in psd["ch_names"]:
+                    out[li, ci] = psd["psd"][label_idx, psd["ch_names"].index(ch)]
+        stacked.append(out)
+    return freqs, np.stack(stacked)
+
+def read_subject_erp_features(bids_root: str, subject: str) -> pd.DataFrame:
+    """Single-trial P1/N1 features of both labels, written by A01."""
+    deriv_folder = subject_deriv_folder(bids_root, subject)
+    base = f"sub-{subject}_ses-01_task-SpAtt_run-01_eeg"
+    fname = op.join(deriv_folder, f"{base}_erp-features.tsv")
+    if not op.exists(fname):
+        raise FileNotFoundError(f"Missing ERP feature file: {fname}")
+    return read_features(fname)
+
+
+def read_cohort_erp_features(bids_root: str, subjects: Sequence[str]) -> pd.DataFrame:
+    """
+    Stack the A01 single-trial feature tables into one long cohort table.
+
+    A ``subject`` column is added in front; there is one row per subject,
+    label, window, component, channel and trial.
+    """
+    tables = []
+    for subject in subjects:
+        table = read_subject_erp_features(bids_root, subject)
+        table.insert(0, "subject", str(subject))
+        tables.append(table)
+    cohort = pd.concat(tables, ignore_index=True)
+    for column in cohort.columns:
+        if cohort[column].dtype == object:
+            cohort[column] = cohort[column].astype("category")
+    return cohort
+
 def read_interpolation_summary(bids_root: str, subject: str) -> list[str]:
     """
     Read the list of posterior channels interpolated for group analysis.
@@ -226,7 +438,16 @@ def subset_present_channels(ch_names: Sequence[str], wanted: Sequence[str]) -> L
     return [ch for ch in wanted if ch in ch_names]
 
 
-def plot_compare_evokeds_by_channel(evoked_dict: dict, channels: Sequence[str], title: str):
+def subject_ci(evokeds: Sequence[mne.Evoked], ch: str) -> np.ndarray:
+    """Bootstrap CI of the grand average of ``ch``, resampling subjects."""
+    data = np.stack([evoked.get_data(picks=[ch])[0] for evoked in evokeds])
+    return bootstrap_ci(data)
+
+
+def plot_compare_evokeds_by_channel(evoked_dict: dict, channels: Sequence[str], title: str,
+                                    ci_bands: dict | None = None):
+    """One axis per channel; ``ci_bands`` maps condition -> channel -> (2, n_times)."""
+    colors = condition_colors(evoked_dict)
     fig, axes = plt.subplots(len(channels), 1, figsize=(10, 4 * len(channels)), constrained_layout=True)
     if len(channels) == 1:
         axes = [axes]
@@ -234,12 +455,20 @@ def plot_compare_evokeds_by_channel(evoked_dict: dict, channels: Sequence[str],
         mne.viz.plot_compare_evokeds(
             evoked_dict,
             picks=ch,
+            colors=colors,
             axes=ax,
             show=False,
             ci=False,
             truncate_xaxis=False,
             truncate_yaxis=False,
         )
+        if ci_bands is not None:
+            add_ci_bands(
+                ax,
+                evoked_dict,
+                {cond: bands[ch] for cond, bands in ci_bands.items() if ch in bands},
+                colors,
+            )
         ax.axvline(0, color="k", linestyle="--", linewidth=1)
         ax.set_title(f"{title} - {ch}")
     return fig
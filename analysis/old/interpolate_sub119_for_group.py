@@ -8,15 +8,28 @@ already-segmented raw data, recreates the cue epochs, interpolates POz,
 and saves group-analysis-ready epochs.
 
 No P01 or P02 rerun is required.
+
+The output is a full *_epo-cue-group.fif rather than the delta P03 writes,
+because POz is not in the cleaned epochs. read_group_epochs uses it while
+it is newer than the P03 delta; run this script again after re-running P03
+for sub-119.
 """
 
 import json
 import os
 import os.path as op
+import sys
 
 import mne
 from mne_bids import BIDSPath
 
+UTILS_DIR = op.join(op.dirname(op.dirname(op.abspath(__file__))), "utils")
+
+if UTILS_DIR not in sys.path:
+    sys.path.insert(0, UTILS_DIR)
+
+from interpolation import interpolate_bads
+
 
 # ------------------------------------------------------------
 # Settings
@@ -158,9 +171,9 @@ for label in ["no-stim", "stim"]:
     # Interpolate POz
     # --------------------------------------------------------
 
-    epochs.interpolate_bads(
+    interpolate_bads(
+        epochs,
         reset_bads=True,
-        mode="accurate",
     )
 
     print(
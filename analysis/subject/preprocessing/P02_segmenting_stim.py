@@ -38,6 +38,9 @@ if UTILS_DIR not in sys.path:
     sys.path.insert(0, UTILS_DIR)
 
 from pdf_report import ParticipantPDF
+from filter_cache import filter_inst
+from label_parallel import run_by_label
+from derivative_storage import format_storage_record, save_derivative
 
 subject = '120'
 session = '01'
@@ -45,6 +48,8 @@ task = 'SpAtt'
 run = '01'
 eeg_suffix = 'eeg'
 extension = '.fif'
+label_parallel = 'serial'  # 'serial' or 'thread': process no-stim and stim concurrently
+storage_policy = 'single'  # 'single' (float32) or 'double' on-disk precision of the segments
 project_root = '/Users/taraghafari/Desktop/Desktop - Tara’s MacBook Pro/BEAR_outage/STN-in-PD'  # local folder
 bids_root = op.join(project_root, 'data', 'BIDS')
 bids_path = BIDSPath(subject=subject, session=session, task=task, run=run,
@@ -89,23 +94,33 @@ def make_segment(label):
     segment = pieces[0] if len(pieces) == 1 else mne.concatenate_raws(pieces)
     return segment, times
 
-for label in ['no-stim', 'stim']:
-    suffix = label
+def process_segment(label, buffer):
     segment, times = make_segment(label)
     # PSD before the 100-Hz low-pass, so the 130-Hz stimulation peak remains visible.
     fmax = min(200, segment.info['sfreq'] / 2 - 0.1)
-    fig_psd = segment.compute_psd(fmin=0.1, fmax=fmax).plot(show=False)
+    psd = segment.compute_psd(fmin=0.1, fmax=fmax)
+
+    # Apply the requested analysis filter only after the 130-Hz QC PSD.
+    # The FIR kernel is cached, so it is designed once per sampling rate.
+    filter_inst(segment, l_freq=0.1, h_freq=100.0)
+    output = op.join(deriv_folder, bids_path.basename + f'_{label}_raw.fif')
+    storage = save_derivative(segment, output, policy=storage_policy)
+    buffer.add_text(f'{label} segment saved',
+                    f'Kept ranges: {times}\nFiltered 0.1-100 Hz\nOutput: {output}\n'
+                    f'{format_storage_record(storage)}',
+                    'Stimulation segmentation')
+    return times, psd
+
+# The two labels are independent; figures and report entries are added
+# afterwards in label order, so the report is the same in every mode.
+segment_results = run_by_label(process_segment, mode=label_parallel)
+
+for label, ((times, psd), buffer) in segment_results.items():
+    fig_psd = psd.plot(show=False)
     report.add_figure(fig_psd, op.join(fig_folder, f'P04_{label}_PSD_before_filter.png'),
                       f'{label} PSD before filtering or any other processing.',
                       f'Used to check whether a peak near 130 Hz is present. Kept ranges: {times}',
                       'Stimulation segmentation')
-
-    # Apply the requested analysis filter only after the 130-Hz QC PSD.
-    segment.filter(l_freq=0.1, h_freq=100.0)
-    output = op.join(deriv_folder, bids_path.basename + f'_{suffix}_raw.fif')
-    segment.save(output, overwrite=True)
-    report.add_text(f'{label} segment saved',
-                    f'Kept ranges: {times}\nFiltered 0.1-100 Hz\nOutput: {output}',
-                    'Stimulation segmentation')
+    buffer.flush(report)
 
 print(f'Updated PDF: {report.pdf_fname}')
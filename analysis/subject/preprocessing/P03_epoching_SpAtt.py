@@ -8,13 +8,18 @@
     2. filters the data between 0.1 and 100 Hz
     3. epochs the cue onsets from -0.5 to 1.6 sec
     4. computes the PSD of the epochs
-    5. finds bad channels using pyprep and
-    writes the reasons into the PDF report
+    5. finds bad channels (fast numpy detectors or
+    pyprep) and writes the reasons into the PDF report
     6. opens a plot that shows only three posterior
     channels ('PO3', 'PO4', 'POz') so the user can manually 
     reject bad trials
     7. saves the cleaned epochs for later analysis
 
+    8. writes every manual decision to
+    qc/sub-XXX_p03_decisions.json; with
+    qc_mode = 'replay' the decisions are read from
+    that file and the script runs without questions
+
     note that the manual rejection should be based
     only on the three posterior channels chosen for
     this step, while the rejected trial is removed
@@ -46,6 +51,18 @@ if UTILS_DIR not in sys.path:
     sys.path.insert(0, UTILS_DIR)
 
 from pdf_report import ParticipantPDF
+from label_parallel import run_by_label
+from derivative_storage import format_storage_record, save_derivative
+from epochs_io import save_group_delta, save_roi_epochs
+from interpolation import interpolate_bads
+from psd_engine import (LINE_FREQS, aperiodic_slope, compute_label_psds,
+                        line_ratio_db, spectrum_for_plot, write_psd)
+from bad_channels import find_bad_channels
+from epoch_prescreen import find_candidate_epochs, plot_with_candidates
+from qc_decisions import (decisions_fname, drop_by_event_sample,
+                          dropped_event_samples, event_samples,
+                          label_decisions, new_decisions, read_decisions,
+                          write_decisions)
 
 # PyPREP is used only to suggest noisy channels and reasons.
 from pyprep.find_noisy_channels import NoisyChannels
@@ -56,10 +73,18 @@ task = 'SpAtt'
 run = '01'
 eeg_suffix = 'eeg'
 extension = '.fif'
+label_parallel = 'serial'  # 'serial' or 'thread': run the non-interactive steps for both labels concurrently
+storage_policy = 'single'  # 'single' (float32) or 'double' on-disk precision of the epochs
+bad_channel_method = 'fast'  # 'fast' (numpy detectors in bad_channels.py) or 'pyprep'
+bad_channel_ransac = 'yes'  # 'yes' or 'no': include RANSAC in the bad-channel suggestions
+ransac_parallel = 'thread'  # 'serial', 'thread' or 'process' ('process' only via run_subject_pipeline.py)
+qc_mode = 'interactive'  # 'interactive' or 'replay' (re-apply the decisions in qc/sub-XXX_p03_decisions.json)
+epoch_prescreen = 'yes'  # 'yes': open the epoch browser with automatically flagged epochs already marked
 project_root = '/Users/taraghafari/Desktop/Desktop - Tara’s MacBook Pro/BEAR_outage/STN-in-PD'  # local folder
 bids_root = op.join(project_root, 'data', 'BIDS')
 posterior_channels = ['PO3', 'PO4', 'POz']  # These are the ones we agreed with Ole
 GROUP_POSTERIOR_CHANNELS = ['PO3', 'PO4', 'POz']
+roi_channels = ['PO3', 'PO4', 'POz']  # written to the compact _epo-cue-roi.fif read by A01, A02, G01 and G02
 
 event_dict = {'cue_onset_right': 1, 'cue_onset_left': 2, 'trial_onset': 3,
               'stim_onset': 4, 'catch_onset': 5, 'dot_onset_right': 6,
@@ -80,7 +105,18 @@ interpolation_summary = {
     "interpolated_channels": [],
 }
 
+# Every manual decision is logged so that P03 can be replayed without questions.
+qc_fname = decisions_fname(bids_root, subject)
+qc_log = read_decisions(qc_fname) if qc_mode == 'replay' else new_decisions(subject)
+
 def get_bad_channel_reasons(raw):
+    """Suggest noisy channels and return channel -> reason list."""
+    if bad_channel_method == 'fast':
+        return find_bad_channels(raw, ransac=bad_channel_ransac == 'yes',
+                                 random_state=42, ransac_parallel=ransac_parallel)
+    return get_pyprep_bad_channel_reasons(raw)
+
+def get_pyprep_bad_channel_reasons(raw):
     """Run PyPREP detectors and return channel -> reason list."""
     eeg = raw.copy().pick('eeg')
     if eeg.get_montage() is None:
@@ -94,6 +130,8 @@ def get_bad_channel_reasons(raw):
                                                # in a data set and estimating the desired model using data that does not 
                                                # contain outliers
     ]
+    if bad_channel_ransac != 'yes':
+        detectors = detectors[:-1]
     reasons = {}
     for reason, detector in detectors:
         try:
@@ -124,14 +162,26 @@ def format_channel_list(channels):
 segment_data = {}
 all_bad_channels = set()
 
-for label in ['no-stim', 'stim']:
+def detect_bad_channels(label, buffer):
     input_fname = op.join(deriv_folder, bids_path.basename + f'_{label}_raw.fif')
     raw = mne.io.read_raw_fif(input_fname, preload=True)
-
-    reasons = get_bad_channel_reasons(raw)
+    if qc_mode == 'replay':
+        if label not in qc_log['labels']:
+            raise RuntimeError(f'{qc_fname} has no decisions for {label}; run P03 interactively.')
+        # Replay the suggestions that were reviewed, not a fresh detection.
+        logged = qc_log['labels'][label]['suggested_bad_channels']
+        return raw, {ch: list(vals) for ch, vals in logged.items()}
+    return raw, get_bad_channel_reasons(raw)
+
+# Reading and bad-channel detection do not need the user, so both labels can run
+# concurrently; the questions below are still asked one label at a time.
+detections = run_by_label(detect_bad_channels, mode=label_parallel)
+
+for label, ((raw, reasons), buffer) in detections.items():
     suggested = sorted(reasons)
+    decisions = label_decisions(qc_log, label)
 
-    print(f'PyPREP suggested bad channels for {label}: {suggested}')
+    print(f'Suggested bad channels for {label} ({bad_channel_method}): {suggested}')
     print(json.dumps(reasons, indent=2))
 
 
@@ -139,28 +189,33 @@ for label in ['no-stim', 'stim']:
     # This makes them visible as already-bad channels during inspection.
     raw.info["bads"] = sorted(set(raw.info["bads"]) | set(suggested))
 
-    # Plot PSD with the PyPREP bad channels already flagged.
-    raw.compute_psd(fmin=0.1, fmax=150).plot()  # to look at all channels and remove obvious bad ones
-    user = input(
-        'Additional bad channels, separated by spaces, or press return: '
-    ).strip().split()
-
-    # Prevent the user from re-entering channels PyPREP already found.
-    user = [ch for ch in user if ch not in suggested]
-    
-    for ch in user:
-        manual_reason = input(
-            f"Reason for manually rejecting {ch}: "
-        ).strip()
-
-        reasons.setdefault(str(ch), []).append(
-            manual_reason or "manually identified during QC"
-        )
-
-    for ch in user:
-        reasons.setdefault(str(ch), []).append(
-            manual_reason or 'manually identified during QC'
-        )
+    if qc_mode == 'replay':
+        added = decisions['added_bad_channels']
+        print(f'Replayed additional bad channels for {label}: {sorted(added)}')
+    else:
+        decisions['suggested_bad_channels'] = {
+            ch: list(vals) for ch, vals in reasons.items()
+        }
+
+        # Plot PSD with the PyPREP bad channels already flagged.
+        raw.compute_psd(fmin=0.1, fmax=150).plot()  # to look at all channels and remove obvious bad ones
+        user = input(
+            'Additional bad channels, separated by spaces, or press return: '
+        ).strip().split()
+
+        # Prevent the user from re-entering channels PyPREP already found.
+        user = [ch for ch in user if ch not in suggested]
+
+        added = {}
+        for ch in user:
+            manual_reason = input(
+                f"Reason for manually rejecting {ch}: "
+            ).strip()
+            added[str(ch)] = manual_reason or "manually identified during QC"
+        decisions['added_bad_channels'] = added
+
+    for ch, manual_reason in added.items():
+        reasons.setdefault(ch, []).append(manual_reason)
 
     # collect bad channels from this segment
     segment_bad_channels = set(str(ch) for ch in raw.info['bads'])
@@ -172,12 +227,14 @@ for label in ['no-stim', 'stim']:
         'reasons': reasons,
     }
 
+if qc_mode == 'interactive':
+    write_decisions(qc_fname, qc_log)
+
 # make the bad-channel set common to both segments
 common_bads = sorted(all_bad_channels)
 
-for label in ['no-stim', 'stim']:
+def make_cue_epochs(label, buffer):
     raw = segment_data[label]['raw']
-    reasons = segment_data[label]['reasons']
 
     bads_to_remove = [ch for ch in common_bads if ch in raw.ch_names]
 
@@ -185,19 +242,6 @@ for label in ['no-stim', 'stim']:
     raw.info['bads'] = bads_to_remove
     # raw.drop_channels(bads_to_remove)  # we need to interpolate bad posterior channels for group analysis, so don't drop.
 
-    bad_text = "\n".join(sorted(set(str(ch) for ch in bads_to_remove))) or "None"
-
-    reason_text = "\n".join(
-    f"{str(ch)}: {', '.join(map(str, reason_list))}"
-    for ch, reason_list in sorted(reasons.items())
-    ) or "No additional noisy channels detected."
-
-    report.add_text(
-        f'{label}: bad-channel reasons',
-        f'Epochs -0.5 to 1.6 s; \nReasons: {reason_text}',
-        'Epoching and channel quality'
-    )
-
     events, events_id = mne.events_from_annotations(raw, event_id=event_dict)
     cue_id = {
         k: events_id[k]
@@ -220,14 +264,43 @@ for label in ['no-stim', 'stim']:
         preload=True,
         event_repeated='merge',
     )
+    return epochs
 
-    n_fft = min(int(2 * epochs.info['sfreq']), len(epochs.times))
-    fig_psd = epochs.compute_psd(
-        fmin=0.1,
-        fmax=100,
-        method='welch',
-        n_fft=n_fft
-    ).plot(show=False)
+# Epoching runs for both labels before any manual step.
+epoch_results = run_by_label(make_cue_epochs, mode=label_parallel)
+
+# One Welch call for the epochs of both labels; the epoch-averaged spectra
+# (up to 150 Hz) are kept for cohort-level spectral QC.
+psd_freqs, psd_ch_names, epoch_psds = compute_label_psds(
+    {label: epochs for label, (epochs, _) in epoch_results.items()}
+)
+psd_fname = write_psd(
+    op.join(deriv_folder, bids_path.basename + '_psd-cue.npz'),
+    psd_freqs,
+    psd_ch_names,
+    epoch_psds,
+)
+
+for label, (epochs, buffer) in epoch_results.items():
+    reasons = segment_data[label]['reasons']
+    decisions = label_decisions(qc_log, label)
+    bads_to_remove = epochs.info['bads']
+
+    bad_text = "\n".join(sorted(set(str(ch) for ch in bads_to_remove))) or "None"
+
+    reason_text = "\n".join(
+    f"{str(ch)}: {', '.join(map(str, reason_list))}"
+    for ch, reason_list in sorted(reasons.items())
+    ) or "No additional noisy channels detected."
+
+    report.add_text(
+        f'{label}: bad-channel reasons',
+        f'Epochs -0.5 to 1.6 s; \nReasons: {reason_text}',
+        'Epoching and channel quality'
+    )
+
+    psd = spectrum_for_plot(epochs, psd_freqs, epoch_psds[label])
+    fig_psd = psd.plot(show=False)
 
     report.add_figure(
         fig_psd,
@@ -237,6 +310,22 @@ for label in ['no-stim', 'stim']:
         'Epoching and channel quality'
     )
 
+    mean_psd = epoch_psds[label].mean(axis=0)
+    spectral_qc = {
+        'Aperiodic slope (2-40 Hz, median over channels)':
+            f'{np.median(aperiodic_slope(psd_freqs, mean_psd)):.2f}',
+    }
+    for name, line_freq in LINE_FREQS.items():
+        if line_freq < psd_freqs[-1]:
+            ratios = line_ratio_db(psd_freqs, mean_psd, line_freq)
+            spectral_qc[f'{line_freq:g} Hz {name} peak (dB over flanks, max channel)'] = (
+                f'{ratios.max():.1f} ({psd_ch_names[int(np.argmax(ratios))]})'
+            )
+    spectral_qc['Stored spectra'] = psd_fname
+    report.add_key_values(f'{label}: spectral QC', spectral_qc,
+                          'Epoching and channel quality')
+    buffer.flush(report)
+
     posterior_channels = ['PO3', 'PO4', 'POz']
 
     # channels that are going to be removed and are also part of the downstream
@@ -252,9 +341,18 @@ for label in ['no-stim', 'stim']:
             f"Do you want to continue using only the remaining posterior channels?",
             RuntimeWarning,
         )
-        answer = input("Continue with remaining posterior channels only? [y/N]: ").strip().lower()
-
-        if answer not in {"y", "yes"}:
+        if qc_mode == 'replay':
+            if decisions['posterior_continue'] is None:
+                raise RuntimeError(
+                    f"{qc_fname} has no answer for the rejected posterior "
+                    f"channel(s) {rejected_posterior}; run P03 interactively."
+                )
+        else:
+            answer = input("Continue with remaining posterior channels only? [y/N]: ").strip().lower()
+            decisions['posterior_continue'] = answer in {"y", "yes"}
+            write_decisions(qc_fname, qc_log)
+
+        if not decisions['posterior_continue']:
             raise RuntimeError("Stopped because a posterior channel was rejected.")
 
         posterior_channels_for_analysis = [
@@ -299,12 +397,35 @@ for label in ['no-stim', 'stim']:
 
     # keep only the channels that remain
     n_before = len(epochs)
-    epochs.plot(
-        picks=posterior_channels_for_analysis,
-        n_channels=len(posterior_channels_for_analysis),
-        block=True,
-        title=f"{label}: manually reject trials using only {posterior_channels_for_analysis}",
-    )
+    candidates = []
+    if qc_mode == 'replay':
+        # Decision logs written before the prescreen have no candidates.
+        candidates = decisions.get('prescreen_event_samples', [])
+        drop_by_event_sample(epochs, decisions['dropped_event_samples'])
+    else:
+        samples_before = event_samples(epochs)
+        browser_kwargs = dict(
+            n_channels=len(posterior_channels_for_analysis),
+            title=f"{label}: manually reject trials using only {posterior_channels_for_analysis}",
+        )
+        if epoch_prescreen == 'yes':
+            # Candidates come from the same posterior channels the user reviews.
+            candidates, candidate_reasons = find_candidate_epochs(
+                epochs, picks=posterior_channels_for_analysis
+            )
+            print(f'{label}: {len(candidates)} candidate bad epochs pre-marked:')
+            print(json.dumps(candidate_reasons, indent=2))
+            decisions['prescreen_event_samples'] = [samples_before[idx] for idx in candidates]
+            plot_with_candidates(epochs, candidates,
+                                 posterior_channels_for_analysis, **browser_kwargs)
+        else:
+            epochs.plot(
+                picks=posterior_channels_for_analysis,
+                block=True,
+                **browser_kwargs,
+            )
+        decisions['dropped_event_samples'] = dropped_event_samples(samples_before, epochs)
+        write_decisions(qc_fname, qc_log)
     n_after = len(epochs)
 
     # ------------------------------------------------------------------
@@ -336,9 +457,11 @@ for label in ['no-stim', 'stim']:
 
         group_epochs.info["bads"] = posterior_bads_to_interpolate
 
-        group_epochs.interpolate_bads(
+        # Cached spherical-spline matrix, shared across subjects with the
+        # same montage and bad set.
+        interpolate_bads(
+            group_epochs,
             reset_bads=True,
-            mode="accurate",
         )
 
         print(
@@ -351,16 +474,18 @@ for label in ['no-stim', 'stim']:
     )
 
     output_fname = op.join(deriv_folder, bids_path.basename + f'_{label}_epo-cue.fif')
-    epochs.save(output_fname, overwrite=True)
-
-    group_output_fname = op.join(
-    deriv_folder,
-    bids_path.basename + f'_{label}_epo-cue-group.fif'
+    storage = save_derivative(epochs, output_fname, policy=storage_policy)
+    roi_output_fname, _ = save_roi_epochs(
+        epochs, output_fname, roi_channels, policy=storage_policy
     )
 
-    group_epochs.save(
-        group_output_fname,
-        overwrite=True,
+    # Only the interpolated channels differ from the cleaned epochs, so the
+    # group version is stored as a delta (read with group_utils).
+    group_output_fname = save_group_delta(
+        output_fname,
+        group_epochs,
+        posterior_bads_to_interpolate,
+        policy=storage_policy,
     )
 
     report.add_text(
@@ -369,7 +494,12 @@ for label in ['no-stim', 'stim']:
         f'Epochs before: {n_before}\n'
         f'Epochs retained: {n_after}\n'
         f'Epochs rejected: {n_before - n_after}\n'
-        f'Output: {output_fname}',
+        f'Epochs pre-marked by the automatic pre-screen: {len(candidates)}\n'
+        f'QC decisions ({qc_mode}): {qc_fname}\n'
+        f'Output: {output_fname}\n'
+        f'Group-analysis delta: {group_output_fname}\n'
+        f'ROI epochs ({", ".join(roi_channels)}): {roi_output_fname}\n'
+        f'{format_storage_record(storage)}',
         'Epoching and channel quality'
     )
 
@@ -1,7 +1,7 @@
 # -*- coding: utf-8 -*-
 """
 ==============================================
-Run the five active single-subject EEG scripts in sequence.
+Run the six active single-subject EEG scripts in sequence.
 
 Pipeline order
 --------------
@@ -10,6 +10,7 @@ Pipeline order
 3. preprocessing/P03_epoching_SpAtt.py
 4. sensor/A01_ERP.py
 5. sensor/A02_three_channel_TFR.py
+6. sensor/A03_modulation_index.py
 
 The original scripts are executed from source, but their subject/path variables are
 patched in memory. The original files are not rewritten. This keeps this runner
@@ -24,6 +25,9 @@ before P02 is run.
 
 P03 remains interactive. Its existing MNE epoch browser opens with PO3, PO4 and
 POz only; bad epochs marked there are saved by P03 before ERP and TFR continue.
+Every P03 decision is logged in ``qc/sub-XXX_p03_decisions.json``; with
+``--replay-qc`` the logged decisions are re-applied without questions, and
+``--jobs N`` then runs N subjects at a time in separate processes.
 ==============================================
 """
 
@@ -34,6 +38,7 @@ import json
 import re
 import sys
 import traceback
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from pathlib import Path
 from typing import Dict, Iterable, List
 
@@ -71,8 +76,47 @@ SCRIPT_ORDER = [
     HERE / "preprocessing" / "P03_epoching_SpAtt.py",
     HERE / "sensor" / "A01_ERP.py",
     HERE / "sensor" / "A02_three_channel_TFR.py",
+    HERE / "sensor" / "A03_modulation_index.py",
 ]
 
+# Optional script settings controlled from the command line, and the scripts
+# that define them. A setting is only patched into the scripts listed here.
+SCRIPT_SETTINGS = {
+    # no-stim/stim loop: 'serial' or 'thread'
+    "label_parallel": {
+        "P02_segmenting_stim.py",
+        "P03_epoching_SpAtt.py",
+        "A01_ERP.py",
+        "A02_three_channel_TFR.py",
+        "A03_modulation_index.py",
+    },
+    # on-disk precision of segmented raw and epochs: 'single' or 'double'
+    "storage_policy": {
+        "P02_segmenting_stim.py",
+        "P03_epoching_SpAtt.py",
+    },
+    # bad-channel suggestions in P03: 'fast' or 'pyprep', with or without RANSAC
+    "bad_channel_method": {"P03_epoching_SpAtt.py"},
+    "bad_channel_ransac": {"P03_epoching_SpAtt.py"},
+    "ransac_parallel": {"P03_epoching_SpAtt.py"},
+    # 'interactive' or 'replay' the logged P03 decisions (also skips A02's notes)
+    "qc_mode": {
+        "P03_epoching_SpAtt.py",
+        "A02_three_channel_TFR.py",
+    },
+    # 'yes' also writes the chunked single-trial TFR store in A02
+    "single_trial_tfr": {"A02_three_channel_TFR.py"},
+    # 'yes' adds the 2-100 Hz multi-resolution TFR in A02
+    "multires_tfr": {"A02_three_channel_TFR.py"},
+    # 'yes' centres the alpha band of A02 and A03 on the G03 PAF of the subject
+    "paf_bands": {
+        "A02_three_channel_TFR.py",
+        "A03_modulation_index.py",
+    },
+    # 'yes' keeps A02's TFR sums on disk and transforms only changed trials
+    "incremental_tfr": {"A02_three_channel_TFR.py", "A03_modulation_index.py"},
+}
+
 def _choose_platform():
     """Ask whether the pipeline is running on Bluebear or Mac."""
 
@@ -127,6 +171,102 @@ def _parse_args() -> argparse.Namespace:
     parser.add_argument(
         "--run", default="01", help="BIDS run label without run- (default: 01)."
     )
+    parser.add_argument(
+        "--label-parallel",
+        choices=["serial", "thread"],
+        default="serial",
+        help=(
+            "Run the independent no-stim/stim steps of P02, P03, A01, A02 "
+            "and A03 serially (default) or concurrently in a thread pool."
+        ),
+    )
+    parser.add_argument(
+        "--storage-policy",
+        choices=["single", "double"],
+        default="single",
+        help=(
+            "Precision of the segmented raw and epochs derivatives written by "
+            "P02 and P03 (default: single, i.e. float32)."
+        ),
+    )
+    parser.add_argument(
+        "--bad-channel-method",
+        choices=["fast", "pyprep"],
+        default="fast",
+        help=(
+            "Detector used for the P03 bad-channel suggestions: the NumPy "
+            "detectors in utils/bad_channels.py (default) or PyPREP."
+        ),
+    )
+    parser.add_argument(
+        "--bad-channel-ransac",
+        choices=["yes", "no"],
+        default="yes",
+        help="Include RANSAC in the P03 bad-channel suggestions (default: yes).",
+    )
+    parser.add_argument(
+        "--ransac-parallel",
+        choices=["serial", "thread", "process"],
+        default="process",
+        help=(
+            "How the fast detector spreads RANSAC windows over CPU cores "
+            "(default: process pool)."
+        ),
+    )
+    parser.add_argument(
+        "--single-trial-tfr",
+        choices=["yes", "no"],
+        default="no",
+        help=(
+            "Also write the single-trial power of A02 to a chunked, "
+            "memory-mappable *_tfr-trials store (default: no)."
+        ),
+    )
+    parser.add_argument(
+        "--multires-tfr",
+        choices=["yes", "no"],
+        default="no",
+        help="Add the 2-100 Hz multi-resolution TFR to A02 (default: no).",
+    )
+    parser.add_argument(
+        "--paf-bands",
+        choices=["yes", "no"],
+        default="no",
+        help=(
+            "Centre the A02 alpha power and A03 MI band on the subject's "
+            "peak alpha frequency from G03; needs group_paf.tsv "
+            "(default: no, fixed 8-14 Hz)."
+        ),
+    )
+    parser.add_argument(
+        "--incremental-tfr",
+        choices=["yes", "no"],
+        default="yes",
+        help=(
+            "Keep the A02/A03 TFR sums and single-trial power per event sample, "
+            "so a re-run only transforms added or changed trials (default: yes)."
+        ),
+    )
+    parser.add_argument(
+        "--replay-qc",
+        dest="qc_mode",
+        action="store_const",
+        const="replay",
+        default="interactive",
+        help=(
+            "Re-apply the bad channels, posterior answer and dropped epochs "
+            "logged by an earlier interactive P03 run, without any questions."
+        ),
+    )
+    parser.add_argument(
+        "--jobs",
+        type=int,
+        default=1,
+        help=(
+            "Number of subjects to run at the same time in separate processes "
+            "(default: 1). Values above 1 require --replay-qc."
+        ),
+    )
     parser.add_argument(
         "--continue-on-error",
         action="store_true",
@@ -134,6 +274,9 @@ def _parse_args() -> argparse.Namespace:
     )
     return parser.parse_args()
 
+def _script_settings(args: argparse.Namespace) -> Dict[str, str]:
+    return {name: getattr(args, name) for name in SCRIPT_SETTINGS}
+
 def _subjects_from_args(args: argparse.Namespace) -> List[str]:
     if args.subjects:
         subjects = [str(s).removeprefix("sub-") for s in args.subjects]
@@ -192,6 +335,19 @@ def _ask_crop_times(label: str) -> List[float]:
             print(f"Invalid input: {exc}")
 
 
+def _subjects_without_crop_times(subjects: List[str]) -> List[str]:
+    """Subjects whose no-stim and stim crop times are not both saved."""
+    table = _load_crop_table()
+    return [
+        subject
+        for subject in subjects
+        if not (
+            _valid_crop_times(table.get(f"sub-{subject}", {}).get("no-stim"))
+            and _valid_crop_times(table.get(f"sub-{subject}", {}).get("stim"))
+        )
+    ]
+
+
 def _get_or_collect_crop_times(
     subject: str,
     project_root: Path,
@@ -290,6 +446,7 @@ def _patch_script_source(
     run: str,
     brainvision_basename: str | None,
     crop_times=None,
+    settings: Dict[str, str] | None = None,
 ) -> str:
 
     values = {
@@ -303,6 +460,9 @@ def _patch_script_source(
         "GITHUB_ROOT": str(REPO_ROOT),
         "brainVision_basename": brainvision_basename,
     }
+    for name, value in (settings or {}).items():
+        if script_path.name in SCRIPT_SETTINGS.get(name, ()):
+            values[name] = value
 
     for name, value in values.items():
         if value is None:
@@ -575,6 +735,7 @@ def _run_script(
     run: str,
     brainvision_basename: str | None = None,
     crop_times=None,
+    settings: Dict[str, str] | None = None,
 ) -> None:
     if not script_path.exists():
         raise FileNotFoundError(f"Required analysis script not found: {script_path}")
@@ -592,6 +753,7 @@ def _run_script(
         run=run,
         brainvision_basename=brainvision_basename,
         crop_times=crop_times,
+        settings=settings,
     )
     globals_dict = {
         "__name__": "__main__",
@@ -710,7 +872,7 @@ def _run_subject(subject: str, args: argparse.Namespace) -> None:
         # --------------------------------------------------------------
 
         print(
-            f"\n[{key}] BLUEBEAR 1/2 ERP: "
+            f"\n[{key}] BLUEBEAR 1/3 ERP: "
             f"{SCRIPT_ORDER[3].name}"
         )
 
@@ -723,6 +885,7 @@ def _run_subject(subject: str, args: argparse.Namespace) -> None:
             args.session,
             args.task,
             args.run,
+            settings=_script_settings(args),
         )
 
         # --------------------------------------------------------------
@@ -730,7 +893,7 @@ def _run_subject(subject: str, args: argparse.Namespace) -> None:
         # --------------------------------------------------------------
 
         print(
-            f"\n[{key}] BLUEBEAR 2/2 TFR: "
+            f"\n[{key}] BLUEBEAR 2/3 TFR: "
             f"{SCRIPT_ORDER[4].name}"
         )
 
@@ -743,6 +906,28 @@ def _run_subject(subject: str, args: argparse.Namespace) -> None:
             args.session,
             args.task,
             args.run,
+            settings=_script_settings(args),
+        )
+
+        # --------------------------------------------------------------
+        # Modulation index
+        # --------------------------------------------------------------
+
+        print(
+            f"\n[{key}] BLUEBEAR 3/3 MI: "
+            f"{SCRIPT_ORDER[5].name}"
+        )
+
+        _run_script(
+            SCRIPT_ORDER[5],
+            subject,
+            project_root,
+            data_root,
+            bids_root,
+            args.session,
+            args.task,
+            args.run,
+            settings=_script_settings(args),
         )
 
         print(
@@ -775,7 +960,7 @@ def _run_subject(subject: str, args: argparse.Namespace) -> None:
         args.session,
     )
     print(
-        f"\n[{key}] 1/5 BIDS conversion: "
+        f"\n[{key}] 1/6 BIDS conversion: "
         f"{p01.name}"
     )
 
@@ -817,7 +1002,7 @@ def _run_subject(subject: str, args: argparse.Namespace) -> None:
     # --------------------------------------------------------------
 
     print(
-        f"\n[{key}] 2/5 stimulation segmentation: "
+        f"\n[{key}] 2/6 stimulation segmentation: "
         f"{SCRIPT_ORDER[1].name}"
     )
 
@@ -831,6 +1016,7 @@ def _run_subject(subject: str, args: argparse.Namespace) -> None:
         args.task,
         args.run,
         crop_times=crop_times,
+        settings=_script_settings(args),
     )
 
     # --------------------------------------------------------------
@@ -838,7 +1024,7 @@ def _run_subject(subject: str, args: argparse.Namespace) -> None:
     # --------------------------------------------------------------
 
     print(
-        f"\n[{key}] 3/5 epoching: {SCRIPT_ORDER[2].name}\n"
+        f"\n[{key}] 3/6 epoching: {SCRIPT_ORDER[2].name}\n"
         "The epoch browser is interactive.\n"
         "Reject bad trials using the available posterior channels,\n"
         "then close the browser to save the cleaned epochs and continue."
@@ -853,6 +1039,7 @@ def _run_subject(subject: str, args: argparse.Namespace) -> None:
         args.session,
         args.task,
         args.run,
+        settings=_script_settings(args),
     )
 
     # --------------------------------------------------------------
@@ -860,7 +1047,7 @@ def _run_subject(subject: str, args: argparse.Namespace) -> None:
     # --------------------------------------------------------------
 
     print(
-        f"\n[{key}] 4/5 ERP: "
+        f"\n[{key}] 4/6 ERP: "
         f"{SCRIPT_ORDER[3].name}"
     )
 
@@ -873,6 +1060,7 @@ def _run_subject(subject: str, args: argparse.Namespace) -> None:
         args.session,
         args.task,
         args.run,
+        settings=_script_settings(args),
     )
 
     # --------------------------------------------------------------
@@ -880,7 +1068,7 @@ def _run_subject(subject: str, args: argparse.Namespace) -> None:
     # --------------------------------------------------------------
 
     print(
-        f"\n[{key}] 5/5 TFR: "
+        f"\n[{key}] 5/6 TFR: "
         f"{SCRIPT_ORDER[4].name}"
     )
 
@@ -893,6 +1081,28 @@ def _run_subject(subject: str, args: argparse.Namespace) -> None:
         args.session,
         args.task,
         args.run,
+        settings=_script_settings(args),
+    )
+
+    # --------------------------------------------------------------
+    # Modulation index
+    # --------------------------------------------------------------
+
+    print(
+        f"\n[{key}] 6/6 MI: "
+        f"{SCRIPT_ORDER[5].name}"
+    )
+
+    _run_script(
+        SCRIPT_ORDER[5],
+        subject,
+        project_root,
+        data_root,
+        bids_root,
+        args.session,
+        args.task,
+        args.run,
+        settings=_script_settings(args),
     )
 
     print(
@@ -901,6 +1111,41 @@ def _run_subject(subject: str, args: argparse.Namespace) -> None:
     )
 
 
+def _init_headless_worker() -> None:
+    """Subjects run in worker processes must never open a window."""
+    import matplotlib
+
+    matplotlib.use("Agg")
+    mne.viz.set_browser_backend("matplotlib")
+
+
+def _run_subjects_parallel(subjects: List[str], args: argparse.Namespace) -> List[tuple]:
+    """Run subjects in a process pool; return (subject, error) failures."""
+    failures = []
+    with ProcessPoolExecutor(
+        max_workers=args.jobs,
+        initializer=_init_headless_worker,
+    ) as executor:
+        futures = {
+            executor.submit(_run_subject, subject, args): subject
+            for subject in subjects
+        }
+        for future in as_completed(futures):
+            subject = futures[future]
+            try:
+                future.result()
+            except Exception as exc:
+                failures.append((subject, str(exc)))
+                print(f"\nFAILED sub-{subject}: {exc}", file=sys.stderr)
+                if not args.continue_on_error:
+                    for pending in futures:
+                        pending.cancel()
+                    raise
+            else:
+                print(f"\nFINISHED sub-{subject} (worker process)")
+    return failures
+
+
 def main() -> None:
     args = _parse_args()
     paths = _choose_platform()
@@ -911,6 +1156,24 @@ def main() -> None:
 
     subjects = _subjects_from_args(args)
 
+    if args.jobs > 1 and args.qc_mode != "replay":
+        raise SystemExit(
+            "--jobs above 1 needs --replay-qc: interactive P03 cannot run "
+            "for several subjects at once."
+        )
+
+    # Missing crop times are asked for interactively, which worker
+    # processes cannot do; check them all before starting the pool.
+    if args.jobs > 1 and args.platform != "bluebear":
+        missing = _subjects_without_crop_times(subjects)
+        if missing:
+            raise SystemExit(
+                "--jobs above 1 needs saved crop times for every subject. "
+                f"Missing in {CROP_TABLE_PATH}: "
+                + ", ".join(f"sub-{s}" for s in missing)
+                + "\nRun these subjects once with --jobs 1 to enter them."
+            )
+
     print("\n" + "=" * 78)
     print("PIPELINE CONFIGURATION")
     print("=" * 78)
@@ -922,6 +1185,8 @@ def main() -> None:
     print(f"BIDS root:      {args.bids_root}")
     print(f"Repository root: {REPO_ROOT}")
     print(f"Crop-time table: {CROP_TABLE_PATH}")
+    print(f"QC mode:        {args.qc_mode}")
+    print(f"Parallel jobs:  {args.jobs}")
 
     if args.platform == "bluebear":
         print("\n" + "!" * 78)
@@ -933,29 +1198,33 @@ def main() -> None:
             "or manual epoch rejection will occur on Bluebear.\n\n"
             "The runner will start from the cleaned epoch files and run:\n"
             "  A01 - ERP\n"
-            "  A02 - TFR\n\n"
+            "  A02 - TFR\n"
+            "  A03 - modulation index\n\n"
             "Use the Mac version of this runner for preprocessing."
         )
         print("!" * 78 + "\n")
     else:
         print(
             "\nMac selected: the complete P01 -> P02 -> P03 -> ERP -> TFR "
-            "pipeline will run.\n"
+            "-> MI pipeline will run.\n"
         )
 
     failures = []
-    for subject in subjects:
-        try:
-            _run_subject(subject, args)
-        except KeyboardInterrupt:
-            print("\nPipeline stopped by user.")
-            raise
-        except Exception as exc:
-            failures.append((subject, str(exc)))
-            print(f"\nFAILED sub-{subject}: {exc}", file=sys.stderr)
-            traceback.print_exc()
-            if not args.continue_on_error:
+    if args.jobs > 1:
+        failures = _run_subjects_parallel(subjects, args)
+    else:
+        for subject in subjects:
+            try:
+                _run_subject(subject, args)
+            except KeyboardInterrupt:
+                print("\nPipeline stopped by user.")
                 raise
+            except Exception as exc:
+                failures.append((subject, str(exc)))
+                print(f"\nFAILED sub-{subject}: {exc}", file=sys.stderr)
+                traceback.print_exc()
+                if not args.continue_on_error:
+                    raise
 
     if failures:
         print("\nCompleted with failures:")
@@ -7,13 +7,16 @@ A01_ERP
     2. combines attention right and attention left
     epochs together
     3. makes evoked responses for stim on and stim off
-    separately
+    separately, for both sides together and for
+    attention right and left
     4. plots the comparison between stim on and stim
     off in one figure with different colours
     5. plots evoked responses for the posterior
     channels separately
     6. saves the evoked files and adds all figures to
     the participant PDF report
+    7. writes the single-trial P1/N1 peak amplitude and
+    latency of every posterior channel to a table
 
     note that this script keeps the comparison focused
     on the cue-locked epochs that survived manual
@@ -31,6 +34,8 @@ import os.path as op
 import sys
 import matplotlib.pyplot as plt
 import mne
+import numpy as np
+import pandas as pd
 from mne_bids import BIDSPath
 
 GITHUB_ROOT = r'/Users/taraghafari/Desktop/Desktop - Tara’s MacBook Pro/BEAR_outage/GitHub/STN-stimulation-oscillation'
@@ -42,12 +47,17 @@ if UTILS_DIR not in sys.path:
     sys.path.insert(0, UTILS_DIR)
 
 from pdf_report import ParticipantPDF, impedance_text
+from evoked_engine import condition_windows, window_trials
+from bootstrap_ci import add_ci_bands, bootstrap_ci, condition_colors
+from erp_features import ERP_COMPONENTS, trial_features, write_features
+from label_parallel import run_by_label
 
 subject = '115'
 session = '01'
 task = 'SpAtt'
 run = '01'
 eeg_suffix = 'eeg'
+label_parallel = 'serial'  # 'serial' or 'thread': process no-stim and stim concurrently
 project_root = '/Users/taraghafari/Desktop/Desktop - Tara’s MacBook Pro/BEAR_outage/STN-in-PD'  # local folder
 bids_root = op.join(project_root, 'data', 'BIDS')
 posterior_file = op.join(
@@ -73,21 +83,32 @@ os.makedirs(fig_folder, exist_ok=True)
 report = ParticipantPDF(report_folder, subject)
 
 evokeds = {'cue': {}, 'grating': {}}
+ci_bands = {'cue': {}, 'grating': {}}
+conditions = {'no stimulation': 'no-stim', 'stimulation': 'stim'}
+colors = condition_colors(conditions)
 
-def make_evoked(epochs, tmin, tmax, baseline, shift=None):
-    evoked = epochs.average(method='mean').filter(l_freq=None, h_freq=30)
-    evoked = evoked.copy().crop(tmin=tmin, tmax=tmax)
-    evoked.apply_baseline(baseline)
-    if shift is not None:
-        evoked = evoked.copy().shift_time(shift, relative=True)
-    return evoked
+# Both windows are cut from one 30 Hz low-passed average per label.
+EVOKED_WINDOWS = {
+    'cue': dict(tmin=-0.1, tmax=0.5, baseline=(-0.1, 0)),
+    'grating': dict(tmin=1.1, tmax=1.6, baseline=(1.1, 1.2), shift=-1.2),
+}
 
+# Attention sides; 'both' is combined from them and is written first.
+cue_conditions = {'right': 'cue_onset_right', 'left': 'cue_onset_left'}
 
-def add_compare_fig(evoked_dict, fname, title, caption, picks, xlim):
+
+def by_condition(window, key=None):
+    if key is None:
+        return {cond: evokeds[window][label] for cond, label in conditions.items()}
+    return {cond: ci_bands[window][label][key] for cond, label in conditions.items()}
+
+
+def add_compare_fig(evoked_dict, bands, fname, title, caption, picks, xlim):
     fig = mne.viz.plot_compare_evokeds(
         evoked_dict,
         picks=picks,
         combine='mean',
+        colors=colors,
         show=False,
         ci=False,
         truncate_xaxis=False,
@@ -95,50 +116,85 @@ def add_compare_fig(evoked_dict, fname, title, caption, picks, xlim):
     )
     if isinstance(fig, list):
         fig = fig[0]
+    add_ci_bands(fig.axes[0], evoked_dict, bands, colors)
     fig.axes[0].axvline(0, color='k', linestyle='--', linewidth=1)
     fig.axes[0].set_xlim(*xlim)
     report.add_figure(fig, fname, title, caption, 'Evoked responses')
 
 
-for label in ['no-stim', 'stim']:
+def process_label(label, buffer):
     input_fname = op.join(deriv_folder, bids_path.basename + f'_{label}_epo-cue.fif')
+    # The written evokeds are shared derivatives, so they keep every channel.
     epochs = mne.read_epochs(input_fname, preload=True)
-    epochs = epochs[['cue_onset_right', 'cue_onset_left']]
-
-    evokeds['cue'][label] = make_evoked(
-        epochs, tmin=-0.1, tmax=0.5, baseline=(-0.1, 0)
-    )
-    evokeds['grating'][label] = make_evoked(
-        epochs, tmin=1.1, tmax=1.6, baseline=(1.1, 1.2), shift=-1.2
+    epochs = epochs[list(cue_conditions.values())]
+
+    by_side = condition_windows(epochs, EVOKED_WINDOWS, cue_conditions, h_freq=30)
+    windows = by_side['both']
+    cue, grating = windows['cue'], windows['grating']
+
+    # Single trials behind the evokeds, for the CI bands and the P1/N1 table.
+    channels = [ch for ch in posterior_channels if ch in cue.ch_names]
+    trials = window_trials(epochs, EVOKED_WINDOWS, picks=channels, h_freq=30)
+    features = trial_features(
+        trials,
+        {window: windows[window].times for window in trials},
+        channels,
+        epochs.events,
+        epochs.event_id,
+        stim=label,
+        components=ERP_COMPONENTS,
     )
 
-    mne.write_evokeds(
-        op.join(deriv_folder, bids_path.basename + f'_{label}_evo-cue.fif'),
-        evokeds['cue'][label],
-        overwrite=True
-    )
-    mne.write_evokeds(
-        op.join(deriv_folder, bids_path.basename + f'_{label}_evo-grating.fif'),
-        evokeds['grating'][label],
-        overwrite=True
-    )
+    # Bootstrap bands over trials, per channel and for the channel mean.
+    bands = {}
+    for window, data in trials.items():
+        data = np.concatenate([data, data.mean(axis=1, keepdims=True)], axis=1)
+        ci = bootstrap_ci(data)
+        bands[window] = dict(zip(channels + ['mean'], ci.transpose(1, 0, 2)))
+
+    # both, right, left in one file per window; readers taking condition=0 get 'both'.
+    for window in EVOKED_WINDOWS:
+        mne.write_evokeds(
+            op.join(deriv_folder, bids_path.basename + f'_{label}_evo-{window}.fif'),
+            [evokeds_by_side[window] for evokeds_by_side in by_side.values()],
+            overwrite=True
+        )
+    return cue, grating, bands, features
+
+
+feature_tables = []
+for label, ((cue, grating, bands, features), buffer) in run_by_label(process_label, mode=label_parallel).items():
+    feature_tables.append(features)
+    evokeds['cue'][label] = cue
+    evokeds['grating'][label] = grating
+    ci_bands['cue'][label] = bands['cue']
+    ci_bands['grating'][label] = bands['grating']
+    buffer.flush(report)
+
+features_fname = write_features(
+    op.join(deriv_folder, bids_path.basename + '_erp-features.tsv'),
+    pd.concat(feature_tables, ignore_index=True),
+)
+print(f'Wrote single-trial P1/N1 features: {features_fname}')
 
 # Cue comparison, averaged across the 3 posterior channels
 add_compare_fig(
-    {'no stimulation': evokeds['cue']['no-stim'], 'stimulation': evokeds['cue']['stim']},
+    by_condition('cue'),
+    by_condition('cue', 'mean'),
     op.join(fig_folder, 'A01_stim_no_stim_evoked_cue_comparison.png'),
     'Cue-locked evoked comparison: stimulation vs no stimulation',
-    'Cue onset at 0 s; window -0.1 to 0.5 s; baseline -0.1 to 0 s; three posterior channels averaged.',
+    'Cue onset at 0 s; window -0.1 to 0.5 s; baseline -0.1 to 0 s; three posterior channels averaged. Shaded: 95% bootstrap CI across trials.',
     posterior_channels,
     (-0.1, 0.5)
 )
 
 # Grating comparison, averaged across the 3 posterior channels
 add_compare_fig(
-    {'no stimulation': evokeds['grating']['no-stim'], 'stimulation': evokeds['grating']['stim']},
+    by_condition('grating'),
+    by_condition('grating', 'mean'),
     op.join(fig_folder, 'A01_stim_no_stim_evoked_grating_comparison.png'),
     'Grating-locked evoked comparison: stimulation vs no stimulation',
-    'Grating onset at 0 s; original window 1.1 to 1.6 s shifted by -1.2 s; baseline 1.1 to 1.2 s; three posterior channels averaged.',
+    'Grating onset at 0 s; original window 1.1 to 1.6 s shifted by -1.2 s; baseline 1.1 to 1.2 s; three posterior channels averaged. Shaded: 95% bootstrap CI across trials.',
     posterior_channels,
     (-0.1, 0.4)
 )
@@ -147,15 +203,17 @@ add_compare_fig(
 fig_cue_channels, axes = plt.subplots(1, 3, figsize=(15, 4), constrained_layout=True)
 for ax, ch in zip(axes, posterior_channels):
     mne.viz.plot_compare_evokeds(
-        {'no stimulation': evokeds['cue']['no-stim'], 'stimulation': evokeds['cue']['stim']},
+        by_condition('cue'),
         picks=ch,
         combine=None,
+        colors=colors,
         axes=ax,
         show=False,
         ci=False,
         truncate_xaxis=False,
         truncate_yaxis=False
     )
+    add_ci_bands(ax, by_condition('cue'), by_condition('cue', ch), colors)
     ax.set_title(f'Cue-locked: {ch}')
     ax.axvline(0, color='k', linestyle='--', linewidth=1)
     ax.set_xlim(-0.1, 0.5)
@@ -164,7 +222,7 @@ report.add_figure(
     fig_cue_channels,
     op.join(fig_folder, 'A01_stim_no_stim_evoked_cue_by_channel.png'),
     'Cue-locked evoked responses by posterior channel',
-    'Cue onset at 0 s; window -0.1 to 0.5 s; baseline -0.1 to 0 s; stimulation and no stimulation compared separately for each channel.',
+    'Cue onset at 0 s; window -0.1 to 0.5 s; baseline -0.1 to 0 s; stimulation and no stimulation compared separately for each channel. Shaded: 95% bootstrap CI across trials.',
     'Evoked responses'
 )
 
@@ -172,15 +230,17 @@ report.add_figure(
 fig_grating_channels, axes = plt.subplots(1, 3, figsize=(15, 4), constrained_layout=True)
 for ax, ch in zip(axes, posterior_channels):
     mne.viz.plot_compare_evokeds(
-        {'no stimulation': evokeds['grating']['no-stim'], 'stimulation': evokeds['grating']['stim']},
+        by_condition('grating'),
         picks=ch,
         combine=None,
+        colors=colors,
         axes=ax,
         show=False,
         ci=False,
         truncate_xaxis=False,
         truncate_yaxis=False
     )
+    add_ci_bands(ax, by_condition('grating'), by_condition('grating', ch), colors)
     ax.set_title(f'Grating-locked: {ch}')
     ax.axvline(0, color='k', linestyle='--', linewidth=1)
     ax.set_xlim(-0.1, 0.4)
@@ -189,7 +249,7 @@ report.add_figure(
     fig_grating_channels,
     op.join(fig_folder, 'A01_stim_no_stim_evoked_grating_by_channel.png'),
     'Grating-locked evoked responses by posterior channel',
-    'Grating onset at 0 s; original window 1.1 to 1.6 s shifted by -1.2 s; baseline 1.1 to 1.2 s; stimulation and no stimulation compared separately for each channel.',
+    'Grating onset at 0 s; original window 1.1 to 1.6 s shifted by -1.2 s; baseline 1.1 to 1.2 s; stimulation and no stimulation compared separately for each channel. Shaded: 95% bootstrap CI across trials.',
     'Evoked responses'
 )
 print(f'Updated PDF: {report.pdf_fname}')
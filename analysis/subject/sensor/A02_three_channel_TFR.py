@@ -7,10 +7,13 @@ A02_three_channel_TFR
     2. combines attention right and attention left
     epochs together for each stimulation condition
     3. calculates the TFR separately for stim on and
-    stim off
+    stim off, for both sides together and for attention
+    right and left (saved for the group analyses)
     4. compares stim on minus stim off for the three
     posterior channels
-    5. adds the TFR figures and saved outputs to the
+    5. computes alpha and gamma power time courses with
+    a Hilbert filter bank
+    6. adds the TFR figures and saved outputs to the
     participant PDF report
 
     note that the analysis is restricted to the same
@@ -43,12 +46,28 @@ if UTILS_DIR not in sys.path:
     sys.path.insert(0, UTILS_DIR)
 
 from pdf_report import ParticipantPDF
+from label_parallel import run_by_label
+from epochs_io import read_epochs_for_channels
+from tfr_engine import SUBJECT_TFR_PARAMS, iter_power
+from tfr_store import STORE_SUFFIX, TFRStore
+from tfr_accumulator import ACCUM_SUFFIX, TFRAccumulator
+from tfr_variants import TFRVariants
+from tfr_contrast import tfr_contrast
+from band_power import BANDS, epochs_band_power, percent_change, side_means, write_band_power
+from multires_tfr import compute_multires_tfr, write_multires_tfr
+from paf import PAF_FNAME, read_paf, subject_alpha_band
 
 subject = '115'
 session = '01'
 task = 'SpAtt'
 run = '01'
 eeg_suffix = 'eeg'
+label_parallel = 'serial'  # 'serial' or 'thread': process no-stim and stim concurrently
+qc_mode = 'interactive'  # 'replay' skips the question for subject notes below
+single_trial_tfr = 'no'  # 'yes' also writes single-trial power to *_{label}_tfr-trials
+multires_tfr = 'no'  # 'yes' adds the 2-100 Hz multi-resolution TFR (gamma included)
+paf_bands = 'no'  # 'yes' centres the alpha band on the subject's PAF from G03 (group_paf.tsv)
+incremental_tfr = 'yes'  # 'yes' keeps TFR sums in *_{label}_tfr-accum; re-runs transform only changed trials
 project_root = '/Users/taraghafari/Desktop/Desktop - Tara’s MacBook Pro/BEAR_outage/STN-in-PD'  # local folder
 bids_root = op.join(project_root, 'data', 'BIDS')
 posterior_file = op.join(
@@ -76,43 +95,168 @@ report_folder = op.join(project_root, 'derivatives', 'reports', f'sub-{subject}'
 os.makedirs(fig_folder, exist_ok=True)
 report = ParticipantPDF(report_folder, subject)
 
-freqs = np.arange(2, 31, 1)
-n_cycles = freqs / 2
+# Shared with A03 (tfr_engine.SUBJECT_TFR_PARAMS); the DPSS kernel FFTs are
+# cached by tfr_engine across labels and subjects.
+tfr_params = dict(SUBJECT_TFR_PARAMS)
+freqs = tfr_params['freqs']
+# Attention sides; 'both' is derived from their sums.
+cue_conditions = {'right': 'cue_onset_right', 'left': 'cue_onset_left'}
+tfr_memory_mb = 256  # bounds the single-trial power held in memory at once
+
+# Alpha band of the power time courses: fixed, or the individual PAF +/- 2 Hz.
+bands = {band: dict(spec) for band, spec in BANDS.items()}
+paf_file = op.join(bids_root, 'derivatives', 'group', 'paf', PAF_FNAME)
+if paf_bands == 'yes':
+    if not op.exists(paf_file):
+        raise FileNotFoundError(f'paf_bands is yes but there is no PAF table; run G03 first:\n{paf_file}')
+    bands['alpha'].update(subject_alpha_band(read_paf(paf_file), subject,
+                                             channels=posterior_channels))
+    report.add_text('Individual alpha band',
+                    f"Alpha power band {bands['alpha']['fmin']:.2f}-{bands['alpha']['fmax']:.2f} Hz "
+                    f'from {paf_file} (8-14 Hz if this subject has no PAF).',
+                    'Time-frequency analysis')
 
 tfrs_raw = {}
 tfrs_plot = {}
-
-for label in ['no-stim', 'stim']:
+band_courses = {}
+multires = {}
+
+
+def code_sums(epochs, store=None):
+    """Power sum and trial count per event code from one transform of every trial.
+
+    With a ``store``, the single-trial power of each block is also written to it.
+    """
+    codes = epochs.events[:, 2]
+    sums = {}
+    for start, power in iter_power(epochs.get_data(), epochs.info['sfreq'],
+                                   max_memory_mb=tfr_memory_mb, **tfr_params):
+        if store is not None:
+            store.write(start, power)
+        block_codes = codes[start:start + len(power)]
+        for code in np.unique(block_codes):
+            block_sum = power[block_codes == code].sum(axis=0)
+            sums[code] = sums[code] + block_sum if code in sums else block_sum
+    counts = {code: int((codes == code).sum()) for code in sums}
+    return sums, counts
+
+
+def accumulated_sums(epochs, label, store=None):
+    """Power sums per event code, transforming only trials added since the last run.
+
+    Returns the sums, the counts and ``(n_added, n_removed)``. With a
+    ``store``, it is filled from the stored single-trial power.
+    """
+    accumulator = TFRAccumulator(
+        op.join(deriv_folder, bids_path.basename + f'_{label}{ACCUM_SUFFIX}'),
+        epochs.info['sfreq'], epochs.ch_names, len(epochs.times), **tfr_params
+    )
+    changes = accumulator.update(epochs, max_memory_mb=tfr_memory_mb)
+    if store is not None:
+        for start, power in accumulator.iter_power(epochs.events[:, 0]):
+            store.write(start, power)
+    return accumulator.sums, accumulator.counts(), changes
+
+
+def condition_tfrs(epochs, sums, counts):
+    """Average TFRs for both, right and left from the power sums per event code.
+
+    'both' is (right sum + left sum) / n, the same as
+    compute_tfr(average=True) on all trials.
+    """
+    side_codes = {side: epochs.event_id[event] for side, event in cue_conditions.items()}
+    empty = [side for side, code in side_codes.items() if counts.get(code, 0) == 0]
+    if empty:
+        raise RuntimeError(f'No epochs for attention side(s): {empty}')
+
+    side_sums = {side: sums[code] for side, code in side_codes.items()}
+    side_counts = {side: counts[code] for side, code in side_codes.items()}
+    side_sums = {'both': sum(side_sums.values()), **side_sums}
+    side_counts = {'both': sum(side_counts.values()), **side_counts}
+    times = epochs.times[::tfr_params['decim']]
+    return {
+        side: mne.time_frequency.AverageTFRArray(
+            epochs.info, side_sums[side] / side_counts[side], times, freqs,
+            nave=side_counts[side], comment=side, method='multitaper',
+        )
+        for side in side_sums
+    }
+
+
+def label_sums(epochs, label, store, buffer):
+    """Power sums per event code, incremental or from scratch."""
+    if incremental_tfr != 'yes':
+        return code_sums(epochs, store)
+    sums, counts, (n_added, n_removed) = accumulated_sums(epochs, label, store)
+    buffer.add_text('Incremental TFR',
+                    f'{label}: {n_added} trial(s) transformed, {n_removed} removed; '
+                    f'{len(epochs) - n_added} reused from the previous run.',
+                    'Time-frequency analysis')
+    return sums, counts
+
+
+def process_label(label, buffer):
     input_fname = op.join(deriv_folder, bids_path.basename + f'_{label}_epo-cue.fif')
-    epochs = mne.read_epochs(input_fname, preload=True)
+    # The compact ROI epochs from P03 are enough for the posterior channels.
+    epochs = read_epochs_for_channels(input_fname, posterior_channels)
 
     missing = [ch for ch in posterior_channels if ch not in epochs.ch_names]
     if missing:
         raise RuntimeError(f'Missing posterior channels: {missing}')
 
-    epochs = epochs[['cue_onset_right', 'cue_onset_left']].copy().pick(posterior_channels)
-
-    # Combined attention-right and attention-left trials, as requested.
-    tfr_raw = epochs.compute_tfr(
-        method='multitaper',
-        freqs=freqs,
-        n_cycles=n_cycles,
-        time_bandwidth=2.0,
-        use_fft=True,
-        return_itc=False,
-        average=True,
-        decim=2,
-        n_jobs=4,
+    epochs = epochs[list(cue_conditions.values())].copy().pick(posterior_channels)
+
+    # Right, left and the combined attention-right and attention-left trials.
+    if single_trial_tfr == 'yes':
+        store_path = op.join(deriv_folder, bids_path.basename + f'_{label}{STORE_SUFFIX}')
+        with TFRStore.create(store_path, epochs.ch_names, freqs,
+                             epochs.times[::tfr_params['decim']],
+                             epochs.events, epochs.event_id) as store:
+            sums, counts = label_sums(epochs, label, store, buffer)
+        buffer.add_text('Single-trial TFR',
+                        f'{label}: single-trial power written to {store_path}.',
+                        'Time-frequency analysis')
+    else:
+        sums, counts = label_sums(epochs, label, None, buffer)
+    tfrs = condition_tfrs(epochs, sums, counts)
+    for side, tfr in tfrs.items():
+        out = op.join(deriv_folder, bids_path.basename + f'_{side}_{label}_tfr.h5')
+        tfr.save(out, overwrite=True)
+    tfr_raw = tfrs['both']
+
+    # Percent-change variant for display only; tfr_raw is left untouched.
+    tfr_plot = TFRVariants(tfr_raw).normalized(baseline, 'percent')
+
+    # Alpha and gamma power time courses straight from the Hilbert filter bank.
+    courses = {
+        band: (side_means(power, epochs, cue_conditions), times)
+        for band, (power, times) in epochs_band_power(epochs, bands).items()
+    }
+    write_band_power(
+        op.join(deriv_folder, bids_path.basename + f'_{label}_band-power.npz'),
+        epochs.ch_names,
+        courses,
     )
-    tfrs_raw[label] = tfr_raw
 
-    # Separate copy for display only.
-    tfr_plot = tfr_raw.copy()
-    tfr_plot.apply_baseline(baseline=baseline, mode='percent')
+    # 2-100 Hz, each band at its own time resolution.
+    tfr_multires = None
+    if multires_tfr == 'yes':
+        tfr_multires = compute_multires_tfr(epochs, n_cycles_factor=0.5,
+                                            time_bandwidth=tfr_params['time_bandwidth'])
+        write_multires_tfr(
+            op.join(deriv_folder, bids_path.basename + f'_both_{label}_multires-tfr.h5'),
+            tfr_multires,
+        )
+    return tfr_raw, tfr_plot, courses, tfr_multires
+
+
+# TFRs for the two labels are computed concurrently when label_parallel is
+# 'thread'; the figures are drawn here, in label order.
+for label, ((tfr_raw, tfr_plot, courses, tfr_multires), buffer) in run_by_label(process_label, mode=label_parallel).items():
+    multires[label] = tfr_multires
+    tfrs_raw[label] = tfr_raw
     tfrs_plot[label] = tfr_plot
-
-    out = op.join(deriv_folder, bids_path.basename + f'_both_{label}_tfr.h5')
-    tfr_raw.save(out, overwrite=True)
+    band_courses[label] = courses
 
     fig, axes = plt.subplots(1, 3, figsize=(15, 4), constrained_layout=True)
     for ax, ch in zip(axes, posterior_channels):
@@ -127,10 +271,10 @@ for label in ['no-stim', 'stim']:
         f'Three posterior channels only; percent baseline {baseline}.',
         'Time-frequency analysis'
     )
+    buffer.flush(report)
 
 # Stim minus no-stim for each channel separately, using raw TFR data.
-difference = tfrs_raw['stim'].copy()
-difference.data = tfrs_raw['stim'].data - tfrs_raw['no-stim'].data
+difference = tfr_contrast(tfrs_raw['stim'], tfrs_raw['no-stim'], 'difference')
 
 fig_diff, axes = plt.subplots(1, 3, figsize=(15, 4), constrained_layout=True)
 for ax, ch in zip(axes, posterior_channels):
@@ -147,10 +291,7 @@ report.add_figure(
 )
 
 # Ratio: (stim on - stim off) / (stim on + stim off), using raw TFR data.
-ratio = tfrs_raw['stim'].copy()
-denom = tfrs_raw['stim'].data + tfrs_raw['no-stim'].data
-eps = np.finfo(float).eps
-ratio.data = (tfrs_raw['stim'].data - tfrs_raw['no-stim'].data) / (denom + eps)
+ratio = tfr_contrast(tfrs_raw['stim'], tfrs_raw['no-stim'], 'ratio')
 
 fig_ratio, axes = plt.subplots(1, 3, figsize=(15, 4), constrained_layout=True)
 for ax, ch in zip(axes, posterior_channels):
@@ -166,9 +307,57 @@ report.add_figure(
     'Time-frequency analysis'
 )
 
-subject_notes = input(                                                  # to add any notes to the PDF report for this subject, e.g. about data quality, artifacts, etc.
-    f"\nFinal notes for sub-{subject} (press Enter to skip): "
-).strip()
+# Alpha and gamma power time courses, stim vs no-stim, per channel.
+for band, spec in bands.items():
+    fig_band, axes = plt.subplots(1, 3, figsize=(15, 4), constrained_layout=True)
+    for ci, (ax, ch) in enumerate(zip(axes, posterior_channels)):
+        for label in ['no-stim', 'stim']:
+            by_side, times = band_courses[label][band]
+            ax.plot(times, percent_change(by_side['both'][ci], times, baseline), label=label)
+        ax.axvline(0, color='k', linestyle='--', linewidth=1)
+        ax.set_xlim(-0.3, 1.4)
+        ax.set_xlabel('Time (s)')
+        ax.set_ylabel('Power change (%)')
+        ax.set_title(f'{band}: {ch}')
+        ax.legend()
+
+    report.add_figure(
+        fig_band,
+        op.join(fig_folder, f'A02_{band}_power_stim_no_stim.png'),
+        f'{band.capitalize()} power time course: stimulation vs no stimulation',
+        f'Hilbert power averaged over {spec["width"]:g}-Hz sub-bands of '
+        f'{spec["fmin"]:g}-{spec["fmax"]:g} Hz; combined attention-left/right; '
+        f'percent baseline {baseline}.',
+        'Time-frequency analysis'
+    )
+
+# 2-100 Hz multi-resolution TFRs, stim and no-stim, per channel.
+if multires_tfr == 'yes':
+    fig_multires, axes = plt.subplots(2, 3, figsize=(15, 8), constrained_layout=True)
+    for row, label in zip(axes, ['no-stim', 'stim']):
+        for ax, ch in zip(row, posterior_channels):
+            multires[label].plot(ch, ax, baseline=baseline, mode='percent',
+                                 tmin=-0.3, tmax=1.4)
+            ax.set_title(f'{label}: {ch}')
+
+    resolutions = ' and '.join(
+        f'{band.freqs[0]:g}-{band.freqs[-1]:g} Hz at {band.info["sfreq"]:g} Hz'
+        for band in multires['no-stim'].bands
+    )
+    report.add_figure(
+        fig_multires,
+        op.join(fig_folder, 'A02_multires_TFR_2_100Hz.png'),
+        'TFR 2-100 Hz (multi-resolution)',
+        f'Combined attention-left/right; {resolutions} time resolution; '
+        f'percent baseline {baseline}.',
+        'Time-frequency analysis'
+    )
+
+subject_notes = ''
+if qc_mode != 'replay':
+    subject_notes = input(                                              # to add any notes to the PDF report for this subject, e.g. about data quality, artifacts, etc.
+        f"\nFinal notes for sub-{subject} (press Enter to skip): "
+    ).strip()
 
 if subject_notes:
     report.add_text(
@@ -0,0 +1,252 @@
+# -*- coding: utf-8 -*-
+"""
+===============================================
+A03_modulation_index
+    1. this code reads the cleaned cue epochs of the
+    three posterior channels
+    2. takes the single-trial power kept by A02 (only
+    trials A02 has not transformed are computed here)
+    3. computes the attention modulation index
+    MI = (right - left) / (right + left) over channels x
+    frequencies x time, separately for stim on and
+    stim off
+    4. computes the single-trial hemispheric
+    lateralization index (e.g. PO4 vs PO3) of alpha
+    power over time
+    5. saves both in one compact file per subject for
+    the group analyses and adds the figures to the
+    participant PDF report
+
+    note that the TFR settings are shared with A02
+    (tfr_engine.SUBJECT_TFR_PARAMS), so that the
+    single-trial power it kept can be reused. With
+    incremental_tfr = 'no', every trial is transformed
+    here and no single-trial power is written.
+
+written by Tara Ghafari
+tara.ghafari@gmail.com
+==============================================
+
+"""
+
+import json
+import os
+import os.path as op
+import sys
+
+import numpy as np
+import matplotlib.pyplot as plt
+from mne_bids import BIDSPath
+
+GITHUB_ROOT = r'/Users/taraghafari/Desktop/Desktop - Tara’s MacBook Pro/BEAR_outage/GitHub/STN-stimulation-oscillation'
+UTILS_DIR = os.path.join(GITHUB_ROOT, 'analysis', 'utils')
+
+if GITHUB_ROOT not in sys.path:
+    sys.path.insert(0, GITHUB_ROOT)
+if UTILS_DIR not in sys.path:
+    sys.path.insert(0, UTILS_DIR)
+
+from pdf_report import ParticipantPDF
+from label_parallel import run_by_label
+from epochs_io import read_epochs_for_channels
+from tfr_accumulator import ACCUM_SUFFIX, TFRAccumulator
+from tfr_engine import SUBJECT_TFR_PARAMS, iter_power
+from lateralization import (MI_BAND, band_mask, hemisphere_pairs, modulation_index,
+                            trial_lateralization, write_mi)
+from paf import PAF_FNAME, read_paf, subject_alpha_band
+
+subject = '115'
+session = '01'
+task = 'SpAtt'
+run = '01'
+eeg_suffix = 'eeg'
+label_parallel = 'serial'  # 'serial' or 'thread': process no-stim and stim concurrently
+paf_bands = 'no'  # 'yes' centres the MI band on the subject's PAF from G03 (group_paf.tsv)
+incremental_tfr = 'yes'  # 'yes' reuses A02's *_{label}_tfr-accum; 'no' transforms every trial and stores nothing
+project_root = '/Users/taraghafari/Desktop/Desktop - Tara’s MacBook Pro/BEAR_outage/STN-in-PD'  # local folder
+bids_root = op.join(project_root, 'data', 'BIDS')
+posterior_file = op.join(
+    bids_root,
+    "derivatives",
+    f"sub-{subject}",
+    "qc",
+    f"sub-{subject}_posterior_channels.json",
+)
+
+if op.exists(posterior_file):
+    with open(posterior_file, "r", encoding="utf-8") as f:
+        posterior_channels = json.load(f)
+else:
+    posterior_channels = ['PO3', 'PO4', 'POz']
+
+
+bids_path = BIDSPath(subject=subject, session=session, task=task, run=run,
+                     root=bids_root, datatype='eeg', suffix=eeg_suffix)
+deriv_folder = op.join(bids_root, 'derivatives', 'sub-' + subject)
+fig_folder = op.join(project_root, 'derivatives', 'figures', f'sub-{subject}')
+report_folder = op.join(project_root, 'derivatives', 'reports', f'sub-{subject}')
+os.makedirs(fig_folder, exist_ok=True)
+report = ParticipantPDF(report_folder, subject)
+
+# Same TFR settings as A02 (tfr_engine.SUBJECT_TFR_PARAMS), so its
+# single-trial power is reused.
+tfr_params = dict(SUBJECT_TFR_PARAMS)
+freqs = tfr_params['freqs']
+cue_conditions = {'right': 'cue_onset_right', 'left': 'cue_onset_left'}
+tfr_memory_mb = 256
+mi_band = dict(MI_BAND)  # 8-14 Hz for the band-mean MI and the trial LI
+paf_file = op.join(bids_root, 'derivatives', 'group', 'paf', PAF_FNAME)
+if paf_bands == 'yes':
+    if not op.exists(paf_file):
+        raise FileNotFoundError(f'paf_bands is yes but there is no PAF table; run G03 first:\n{paf_file}')
+    mi_band = subject_alpha_band(read_paf(paf_file), subject, channels=posterior_channels)
+    report.add_text('Individual alpha band',
+                    f"MI band {mi_band['fmin']:.2f}-{mi_band['fmax']:.2f} Hz from {paf_file} "
+                    '(8-14 Hz if this subject has no PAF).',
+                    'Lateralization')
+
+results = {}
+
+
+def transformed_blocks(epochs, sums):
+    """Yield power blocks of every trial, adding them to the per-code ``sums``."""
+    codes = epochs.events[:, 2]
+    for start, power in iter_power(epochs.get_data(), epochs.info['sfreq'],
+                                   max_memory_mb=tfr_memory_mb, **tfr_params):
+        block_codes = codes[start:start + len(power)]
+        for code in np.unique(block_codes):
+            block_sum = power[block_codes == code].sum(axis=0)
+            sums[code] = sums[code] + block_sum if code in sums else block_sum
+        yield start, power
+
+
+def process_label(label, buffer):
+    input_fname = op.join(deriv_folder, bids_path.basename + f'_{label}_epo-cue.fif')
+    epochs = read_epochs_for_channels(input_fname, posterior_channels)
+
+    missing = [ch for ch in posterior_channels if ch not in epochs.ch_names]
+    if missing:
+        raise RuntimeError(f'Missing posterior channels: {missing}')
+
+    epochs = epochs[list(cue_conditions.values())].copy().pick(posterior_channels)
+
+    pairs = hemisphere_pairs(epochs.ch_names)
+    if incremental_tfr == 'yes':
+        # The power sums and single-trial power are shared with A02.
+        accumulator = TFRAccumulator(
+            op.join(deriv_folder, bids_path.basename + f'_{label}{ACCUM_SUFFIX}'),
+            epochs.info['sfreq'], epochs.ch_names, len(epochs.times), **tfr_params
+        )
+        n_added, _ = accumulator.update(epochs, max_memory_mb=tfr_memory_mb)
+        buffer.add_text('Modulation index',
+                        f'{label}: single-trial power of {len(epochs) - n_added} trial(s) '
+                        f'reused from A02, {n_added} transformed here.',
+                        'Lateralization')
+        sums, counts = accumulator.sums, accumulator.counts()
+        li = trial_lateralization(accumulator.iter_power(epochs.events[:, 0]), freqs,
+                                  epochs.ch_names, pairs, **mi_band)
+    else:
+        # One pass over the trials gives both the sums and the trial LI.
+        sums = {}
+        li = trial_lateralization(transformed_blocks(epochs, sums), freqs,
+                                  epochs.ch_names, pairs, **mi_band)
+        counts = {code: int((epochs.events[:, 2] == code).sum()) for code in sums}
+        buffer.add_text('Modulation index',
+                        f'{label}: all {len(epochs)} trial(s) transformed here; '
+                        'no single-trial power stored.',
+                        'Lateralization')
+
+    means = {}
+    for side, event in cue_conditions.items():
+        code = epochs.event_id[event]
+        if counts.get(code, 0) == 0:
+            raise RuntimeError(f'No epochs for attention side: {side}')
+        means[side] = sums[code] / counts[code]
+
+    return dict(
+        mi=modulation_index(means['right'], means['left']),
+        li=li,
+        events=epochs.events,
+        ch_names=epochs.ch_names,
+        times=epochs.times[::tfr_params['decim']],
+        pairs=pairs,
+        side_codes={side: epochs.event_id[event] for side, event in cue_conditions.items()},
+    )
+
+
+for label, (result, buffer) in run_by_label(process_label, mode=label_parallel).items():
+    results[label] = result
+    buffer.flush(report)
+
+ch_names = results['no-stim']['ch_names']
+times = results['no-stim']['times']
+pairs = results['no-stim']['pairs']
+mi_fname = write_mi(
+    op.join(deriv_folder, bids_path.basename + '_mi.npz'),
+    ch_names, freqs, times, pairs, mi_band,
+    {label: {key: result[key] for key in ('mi', 'li', 'events')}
+     for label, result in results.items()},
+)
+
+# Band-mean MI over time, stim vs no-stim, per channel.
+in_band = band_mask(freqs, mi_band['fmin'], mi_band['fmax'])
+fig_mi, axes = plt.subplots(1, len(ch_names), figsize=(15, 4), constrained_layout=True)
+for ci, (ax, ch) in enumerate(zip(np.atleast_1d(axes), ch_names)):
+    for label in ['no-stim', 'stim']:
+        ax.plot(times, results[label]['mi'][ci, in_band].mean(axis=0), label=label)
+    ax.axhline(0, color='k', linewidth=1)
+    ax.axvline(0, color='k', linestyle='--', linewidth=1)
+    ax.set_xlim(-0.3, 1.4)
+    ax.set_xlabel('Time (s)')
+    ax.set_ylabel('MI')
+    ax.set_title(f'MI: {ch}')
+    ax.legend()
+
+report.add_figure(
+    fig_mi,
+    op.join(fig_folder, 'A03_MI_stim_no_stim.png'),
+    'Modulation index: (attend right - attend left) / (attend right + attend left)',
+    f'Average TFR power, {mi_band["fmin"]:g}-{mi_band["fmax"]:g} Hz mean of the '
+    'per-frequency MI; no baseline correction.',
+    'Lateralization'
+)
+
+# Single-trial hemispheric lateralization, attend right vs left.
+if pairs:
+    fig_li, axes = plt.subplots(1, len(pairs), figsize=(6 * len(pairs), 4),
+                                constrained_layout=True, squeeze=False)
+    for pi, (ax, (left_ch, right_ch)) in enumerate(zip(axes[0], pairs)):
+        for label, linestyle in [('no-stim', '--'), ('stim', '-')]:
+            li = results[label]['li'][:, pi]
+            codes = results[label]['events'][:, 2]
+            for side, code in results[label]['side_codes'].items():
+                trials = li[codes == code]
+                mean = trials.mean(axis=0)
+                sem = trials.std(axis=0, ddof=1) / np.sqrt(len(trials))
+                line, = ax.plot(times, mean, linestyle=linestyle,
+                                label=f'{label}, attend {side}')
+                ax.fill_between(times, mean - sem, mean + sem,
+                                color=line.get_color(), alpha=0.2, linewidth=0)
+        ax.axhline(0, color='k', linewidth=1)
+        ax.axvline(0, color='k', linestyle='--', linewidth=1)
+        ax.set_xlim(-0.3, 1.4)
+        ax.set_xlabel('Time (s)')
+        ax.set_ylabel('LI')
+        ax.set_title(f'({right_ch} - {left_ch}) / ({right_ch} + {left_ch})')
+        ax.legend(fontsize=8)
+
+    report.add_figure(
+        fig_li,
+        op.join(fig_folder, 'A03_trial_lateralization.png'),
+        'Single-trial hemispheric lateralization index',
+        f'{mi_band["fmin"]:g}-{mi_band["fmax"]:g} Hz power; mean +/- SEM across trials.',
+        'Lateralization'
+    )
+else:
+    report.add_text('Lateralization index',
+                    'No left/right channel pair among the posterior channels; '
+                    'the trial lateralization index was not computed.',
+                    'Lateralization')
+
+print(f'MI written to {mi_fname}')
+print(f'Updated PDF: {report.pdf_fname}')
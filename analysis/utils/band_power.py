@@ -0,0 +1,159 @@
+"""Alpha and gamma power time courses from a small Hilbert filter bank.
+
+A02's 2-30 Hz multitaper grid transforms every trial at 29 frequencies. The
+alpha analyses then only keep the 8-14 Hz rows (the old ``A04`` cropped the
+TFR to the PAF range), and gamma is not covered at all. ``band_power``
+computes the power time course of each band directly:
+
+    1. every signal is FFT'd once (reflect-padded, as ``filter()`` pads);
+    2. each sub-band of the band (2 Hz wide for alpha, 10 Hz for gamma) is
+       band-passed with the cached zero-phase FIR kernel of
+       ``filter_cache`` and made analytic in the same product, so one
+       inverse FFT per sub-band gives the Hilbert signal;
+    3. the power ``|analytic|**2`` is averaged over the sub-bands and
+       decimated to the band's output rate (100 Hz for alpha, 250 Hz for
+       gamma), which is well above the envelope bandwidth.
+
+Averaging over narrow sub-bands keeps the 1/f slope from letting the lowest
+frequencies of a band dominate. The frequency-domain kernels are cached per
+sampling rate, sub-band and FFT length.
+
+A02 writes the mean time courses for both, right and left attention per
+label to ``*_{label}_band-power.npz`` (``write_band_power``).
+"""
+from __future__ import annotations
+
+import threading
+from pathlib import Path
+
+import numpy as np
+from scipy import fft as sp_fft
+
+from filter_cache import filter_kernel
+from pipeline_state import save_npz
+
+
+BANDS = {
+    "alpha": dict(fmin=8.0, fmax=14.0, width=2.0, sfreq_out=100.0),
+    "gamma": dict(fmin=40.0, fmax=90.0, width=10.0, sfreq_out=250.0),
+}
+
+_RESPONSES: dict[tuple, np.ndarray] = {}
+_LOCK = threading.Lock()
+
+
+def sub_bands(fmin: float, fmax: float, width: float) -> list[tuple[float, float]]:
+    """Contiguous ``(l_freq, h_freq)`` sub-bands covering ``fmin``-``fmax``."""
+    edges = np.arange(fmin, fmax, width)
+    return [(float(low), float(min(low + width, fmax))) for low in edges]
+
+
+def decimation(sfreq: float, sfreq_out: float) -> int:
+    """Integer decimation factor that keeps at least ``sfreq_out``."""
+    return max(1, int(sfreq // sfreq_out))
+
+
+def _analytic_response(sfreq: float, l_freq: float, h_freq: float, n_fft: int):
+    """FFT of the band-pass kernel times the one-sided (analytic) mask."""
+    key = (float(sfreq), l_freq, h_freq, n_fft)
+    with _LOCK:
+        if key not in _RESPONSES:
+            kernel = filter_kernel(sfreq, l_freq, h_freq)
+            response = sp_fft.fft(kernel, n_fft)
+            mask = np.zeros(n_fft)
+            mask[0] = 1.0
+            mask[1:(n_fft + 1) // 2] = 2.0
+            if n_fft % 2 == 0:
+                mask[n_fft // 2] = 1.0
+            _RESPONSES[key] = response * mask
+        return _RESPONSES[key]
+
+
+def band_power(data, sfreq: float, fmin: float, fmax: float, width: float,
+               sfreq_out: float, max_memory_mb: float = 256):
+    """Band power ``(..., n_times_out)`` of ``data`` ``(..., n_times)``.
+
+    Returns the power and the decimation factor used, so the times are
+    ``times[::decim]``.
+    """
+    data = np.asarray(data, dtype=float)
+    n_times = data.shape[-1]
+    rows = data.reshape(-1, n_times)
+    bands = sub_bands(fmin, fmax, width)
+    n_taps = max(len(filter_kernel(sfreq, low, high)) for low, high in bands)
+    n_pad = min(n_taps, n_times - 1)
+    n_fft = sp_fft.next_fast_len(n_times + 2 * n_pad + n_taps - 1)
+    decim = decimation(sfreq, sfreq_out)
+    n_out = len(range(0, n_times, decim))
+
+    out = np.empty((len(rows), n_out))
+    block = max(1, int(max_memory_mb * 2 ** 20 // (n_fft * 16 * 2)))
+    for first in range(0, len(rows), block):
+        padded = np.pad(rows[first:first + block], ((0, 0), (n_pad, n_pad)), mode="reflect")
+        signal_fft = sp_fft.fft(padded, n_fft, axis=-1)
+        power = np.zeros((len(padded), n_out))
+        for low, high in bands:
+            n_h = len(filter_kernel(sfreq, low, high))
+            start = n_pad + (n_h - 1) // 2
+            analytic = sp_fft.ifft(signal_fft * _analytic_response(sfreq, low, high, n_fft),
+                                   axis=-1)[:, start:start + n_times:decim]
+            power += analytic.real ** 2 + analytic.imag ** 2
+        out[first:first + block] = power / len(bands)
+    return out.reshape(data.shape[:-1] + (n_out,)), decim
+
+
+def epochs_band_power(epochs, bands: dict = BANDS, picks=None, **kwargs) -> dict:
+    """Return ``band -> (single-trial power (n_epochs, n_channels, n_out), times)``."""
+    data = epochs.get_data(picks=picks)
+    out = {}
+    for name, spec in bands.items():
+        power, decim = band_power(data, epochs.info["sfreq"], **spec, **kwargs)
+        out[name] = (power, epochs.times[::decim])
+    return out
+
+
+def side_means(power, epochs, conditions: dict, combined: str = "both") -> dict:
+    """Mean power per condition (``name -> event``), with all trials first."""
+    codes = epochs.events[:, 2]
+    out = {combined: power.mean(axis=0)}
+    for name, event in conditions.items():
+        out[name] = power[codes == epochs.event_id[event]].mean(axis=0)
+    return out
+
+
+def percent_change(power, times, baseline) -> np.ndarray:
+    """Power relative to its mean in ``baseline``, in percent."""
+    in_baseline = (times >= baseline[0]) & (times <= baseline[1])
+    reference = power[..., in_baseline].mean(axis=-1, keepdims=True)
+    return 100 * (power - reference) / reference
+
+
+def write_band_power(fname, ch_names, courses: dict) -> Path:
+    """Write ``band -> (side -> (n_channels, n_times) power, times)`` to ``.npz``.
+
+    Each band is stored as ``<band>_power`` ``(n_sides, n_channels, n_times)``
+    in float32 and ``<band>_times``.
+    """
+    fname = Path(fname)
+    arrays = {
+        "bands": np.array(list(courses), dtype=str),
+        "ch_names": np.array(ch_names, dtype=str),
+    }
+    for band, (by_side, times) in courses.items():
+        arrays["sides"] = np.array(list(by_side), dtype=str)
+        arrays[f"{band}_power"] = np.stack(list(by_side.values())).astype(np.float32)
+        arrays[f"{band}_times"] = np.asarray(times)
+    return save_npz(fname, **arrays)
+
+
+def read_band_power(fname) -> dict:
+    """Read a band-power file: ``band -> (side -> power, times)``."""
+    with np.load(fname) as stored:
+        sides = [str(side) for side in stored["sides"]]
+        return {
+            str(band): (
+                dict(zip(sides, stored[f"{band}_power"].astype(float))),
+                stored[f"{band}_times"],
+            )
+            for band in stored["bands"]
+        }
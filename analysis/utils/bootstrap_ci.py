@@ -0,0 +1,120 @@
+"""Vectorised bootstrap confidence intervals for the ERP figures.
+
+The ERP comparisons in A01, G01 and G02 were drawn with ``ci=False``. The
+bands added now come from a percentile bootstrap of the mean:
+
+    subject level (A01)      resample trials
+    concatenated (G01)       resample trials of the concatenated epochs
+    grand average (G02)      resample subjects
+
+The resamples are drawn in blocks of rows as an index matrix, which is
+turned into a matrix of weights with a single ``np.bincount``; each weight
+is how often an observation was drawn, divided by ``n_obs``. The resampled
+means of a block are then one matrix product ``weights @ data``. Half of
+``max_memory_mb`` goes to the ``(n_boot, block)`` means over a block of
+columns (channels x times), the other half to the indices and weights of a
+block of resamples, so neither grows with the number of trials times
+``n_boot``. 10 000 resamples of a three-channel ERP from a few hundred
+trials take a fraction of a second.
+
+Every block of resamples has its own seed, spawned from ``random_state``, so
+the draws do not depend on the block sizes. The seed is fixed by default,
+so a figure is the same on every run.
+"""
+from __future__ import annotations
+
+import numpy as np
+
+
+N_BOOT = 10_000
+CI_LEVEL = 0.95
+# plot_compare_evokeds shows EEG in microvolts.
+EEG_SCALE = 1e6
+
+
+# Bytes per (resample, observation) while a block of weights is drawn:
+# int64 indices, int64 counts and the float32 weights.
+_WEIGHT_BYTES = 8 + 8 + 4
+# Resamples per seed; fixes the draws whatever the memory budget.
+_SEED_BLOCK = 256
+
+
+def resample_weights(n_obs: int, n_boot: int = N_BOOT, random_state=0,
+                     dtype=np.float32) -> np.ndarray:
+    """``(n_boot, n_obs)`` weights; row ``b`` averages bootstrap sample ``b``."""
+    if n_obs < 1:
+        raise ValueError("At least one observation is needed for a bootstrap.")
+    rng = np.random.default_rng(random_state)
+    idx = rng.integers(0, n_obs, size=(n_boot, n_obs))
+    idx += np.arange(n_boot)[:, np.newaxis] * n_obs
+    counts = np.bincount(idx.ravel(), minlength=n_boot * n_obs).reshape(n_boot, n_obs)
+    weights = counts.astype(dtype)
+    weights /= n_obs
+    return weights
+
+
+def iter_resample_weights(n_obs: int, n_boot: int = N_BOOT, random_state=0,
+                          max_memory_mb: float = 128, dtype=np.float32):
+    """Yield ``(first resample, weights)`` blocks of ``resample_weights``.
+
+    Every ``_SEED_BLOCK`` resamples have their own spawned seed; a block
+    holds as many of these as fit in ``max_memory_mb``.
+    """
+    seeds = np.random.SeedSequence(random_state).spawn(-(-n_boot // _SEED_BLOCK))
+    per_seed = _SEED_BLOCK * max(n_obs, 1) * _WEIGHT_BYTES
+    seeds_per_block = max(1, int(max_memory_mb * 2 ** 20 // per_seed))
+    for first in range(0, len(seeds), seeds_per_block):
+        start = first * _SEED_BLOCK
+        blocks = [resample_weights(n_obs, min(_SEED_BLOCK, n_boot - (first + k) * _SEED_BLOCK),
+                                   seed, dtype)
+                  for k, seed in enumerate(seeds[first:first + seeds_per_block])]
+        yield start, np.concatenate(blocks)
+
+
+def bootstrap_ci(data, ci: float = CI_LEVEL, n_boot: int = N_BOOT,
+                 random_state=0, max_memory_mb: float = 256) -> np.ndarray:
+    """Percentile bootstrap CI of the mean over the first axis of ``data``.
+
+    ``data`` is ``(n_obs, ...)``, for example trials x channels x times.
+    Returns ``(2, ...)`` with the lower and upper bounds.
+    """
+    data = np.asarray(data)
+    n_obs = data.shape[0]
+    columns = data.reshape(n_obs, -1).astype(np.float32)
+    percentiles = 50 * np.array([1 - ci, 1 + ci])
+
+    out = np.empty((2, columns.shape[1]))
+    block = max(1, int(max_memory_mb / 2 * 2 ** 20 // (n_boot * 4)))
+    for start in range(0, columns.shape[1], block):
+        part = columns[:, start:start + block]
+        means = np.empty((n_boot, part.shape[1]), dtype=np.float32)
+        for first, weights in iter_resample_weights(n_obs, n_boot, random_state,
+                                                    max_memory_mb / 2):
+            np.matmul(weights, part, out=means[first:first + len(weights)])
+        out[:, start:start + block] = np.percentile(means, percentiles, axis=0)
+    return out.reshape((2,) + data.shape[1:])
+
+
+def condition_colors(conditions) -> dict:
+    """Default matplotlib cycle colours per condition, as plot_compare_evokeds uses.
+
+    Passing these to ``plot_compare_evokeds(colors=...)`` keeps the lines and
+    their bands in the same colour.
+    """
+    return {condition: f"C{idx}" for idx, condition in enumerate(conditions)}
+
+
+def plot_ci_band(ax, times, ci, color, scale: float = EEG_SCALE,
+                 alpha: float = 0.2):
+    """Shade a ``(2, n_times)`` interval on an ERP axis."""
+    return ax.fill_between(times, ci[0] * scale, ci[1] * scale,
+                           color=color, alpha=alpha, linewidth=0, zorder=1)
+
+
+def add_ci_bands(ax, evoked_dict: dict, bands: dict, colors: dict) -> None:
+    """Shade ``condition -> (2, n_times)`` bands under the plotted evokeds."""
+    for condition, band in bands.items():
+        evoked = evoked_dict[condition]
+        if isinstance(evoked, (list, tuple)):
+            evoked = evoked[0]
+        plot_ci_band(ax, evoked.times, band, colors[condition])
@@ -0,0 +1,125 @@
+"""Storage policy for the FIF derivatives written by the STN EEG scripts.
+
+The segmented raw files (P02), the cue epochs (P03) and the concatenated group
+epochs (G01) are read again by every later stage, so their on-disk precision
+is set in one place instead of relying on each ``save()`` default:
+
+    single   float32 samples (half the size of double, the pipeline default)
+    double   float64 samples, bit-identical to the data in memory
+
+``save_derivative`` writes the file with the chosen policy and records it in
+a JSON sidecar next to the file (``*_raw.fif`` -> ``*_raw.json``).
+``storage_error`` reports the largest error that single precision introduces
+relative to double, so the choice can be checked for a given dataset.
+"""
+from __future__ import annotations
+
+import json
+from datetime import datetime
+from pathlib import Path
+
+import numpy as np
+
+
+STORAGE_POLICIES = {
+    "single": np.float32,
+    "double": np.float64,
+}
+
+DEFAULT_STORAGE_POLICY = "single"
+
+# Rows (channels or epochs x channels) compared per block in storage_error().
+_BLOCK_ROWS = 64
+
+
+def _check_policy(policy: str) -> str:
+    if policy not in STORAGE_POLICIES:
+        raise ValueError(
+            f"storage policy must be one of {sorted(STORAGE_POLICIES)}, got {policy!r}"
+        )
+    return policy
+
+
+def sidecar_fname(fname: str | Path) -> Path:
+    """Return the JSON sidecar path for a derivative file."""
+    fname = Path(fname)
+    return fname.with_name(fname.name.removesuffix(".fif") + ".json")
+
+
+def storage_error(inst, policy: str = "single") -> dict:
+    """Maximum absolute and relative error of storing ``inst`` with ``policy``.
+
+    ``inst`` is a preloaded Raw/Epochs object or a data array. The error is
+    measured against the double-precision data in memory, one block of rows
+    at a time so that long raw recordings are not copied at once.
+    """
+    dtype = STORAGE_POLICIES[_check_policy(policy)]
+    data = inst if isinstance(inst, np.ndarray) else inst._data
+    rows = data.reshape(-1, data.shape[-1])
+
+    max_abs_error = 0.0
+    max_abs_value = 0.0
+    for first in range(0, rows.shape[0], _BLOCK_ROWS):
+        block = rows[first:first + _BLOCK_ROWS]
+        stored = block.astype(dtype).astype(np.float64)
+        max_abs_error = max(max_abs_error, float(np.max(np.abs(stored - block))))
+        max_abs_value = max(max_abs_value, float(np.max(np.abs(block))))
+
+    return {
+        "max_abs_error": max_abs_error,
+        "max_rel_error": max_abs_error / max_abs_value if max_abs_value else 0.0,
+    }
+
+
+def write_sidecar(fname: str | Path, values: dict) -> Path:
+    """Merge ``values`` into the JSON sidecar of ``fname``."""
+    sidecar = sidecar_fname(fname)
+    payload = {}
+    if sidecar.exists():
+        payload = json.loads(sidecar.read_text(encoding="utf-8"))
+    payload.update(values)
+    sidecar.write_text(json.dumps(payload, indent=2), encoding="utf-8")
+    return sidecar
+
+
+def read_storage_policy(fname: str | Path) -> str | None:
+    """Return the storage policy recorded for ``fname``, if any."""
+    sidecar = sidecar_fname(fname)
+    if not sidecar.exists():
+        return None
+    payload = json.loads(sidecar.read_text(encoding="utf-8"))
+    return payload.get("storage", {}).get("policy")
+
+
+def save_derivative(inst, fname: str | Path,
+                    policy: str = DEFAULT_STORAGE_POLICY,
+                    verify: bool = True) -> dict:
+    """Save a Raw or Epochs derivative with ``policy`` and record it.
+
+    Returns the storage record written to the sidecar. With ``verify=True``
+    the record includes the error against double precision.
+    """
+    policy = _check_policy(policy)
+    fname = str(fname)
+    inst.save(fname, fmt=policy, overwrite=True)
+
+    record = {
+        "policy": policy,
+        "dtype": np.dtype(STORAGE_POLICIES[policy]).name,
+        "written": datetime.now().isoformat(timespec="seconds"),
+    }
+    if verify:
+        record.update(storage_error(inst, policy))
+    write_sidecar(fname, {"storage": record})
+    return record
+
+
+def format_storage_record(record: dict) -> str:
+    """One-line summary of a storage record for the PDF report."""
+    text = f"Stored as {record['policy']} ({record['dtype']})"
+    if "max_abs_error" in record:
+        text += (
+            f"; max error vs double {record['max_abs_error']:.3g} "
+            f"(relative {record['max_rel_error']:.3g})"
+        )
+    return text
@@ -0,0 +1,101 @@
+"""Automatic pre-screen of the cue epochs before the manual P03 browser.
+
+For every epoch and channel, ``epoch_features`` computes four features in one
+pass over the ``(n_epochs, n_channels, n_times)`` array:
+
+    ptp           peak-to-peak amplitude
+    variance      signal variance
+    kurtosis      excess kurtosis (spiky, non-Gaussian segments)
+    max_gradient  largest sample-to-sample jump
+
+Each feature is turned into a robust z-score across the epochs of the
+subject (median / MAD per channel). An epoch is a candidate when any feature
+exceeds ``threshold`` on any channel. ``plot_with_candidates`` then opens the
+usual browser with the candidates already marked, so the review is a
+confirmation rather than a search. All decisions stay with the user:
+candidates can be unmarked before the browser is closed.
+"""
+from __future__ import annotations
+
+import matplotlib.pyplot as plt
+import mne
+import numpy as np
+
+
+MAD_TO_SD = 1.4826
+FEATURES = ("ptp", "variance", "kurtosis", "max_gradient")
+CANDIDATE_COLOR = "tab:red"
+
+
+def epoch_features(data: np.ndarray) -> dict:
+    """Per-epoch, per-channel features of ``(n_epochs, n_channels, n_times)``."""
+    centred = data - data.mean(axis=-1, keepdims=True)
+    squared = centred * centred
+    variance = squared.mean(axis=-1)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        kurtosis = (squared * squared).mean(axis=-1) / variance ** 2 - 3.0
+    return {
+        "ptp": np.ptp(data, axis=-1),
+        "variance": variance,
+        "kurtosis": np.nan_to_num(kurtosis),
+        "max_gradient": np.abs(np.diff(data, axis=-1)).max(axis=-1),
+    }
+
+
+def robust_z(values: np.ndarray) -> np.ndarray:
+    """Robust z-score of ``(n_epochs, n_channels)`` values across epochs."""
+    median = np.median(values, axis=0, keepdims=True)
+    mad = np.median(np.abs(values - median), axis=0, keepdims=True) * MAD_TO_SD
+    mad[mad == 0] = np.inf
+    return (values - median) / mad
+
+
+def find_candidate_epochs(epochs, picks=None, threshold: float = 3.5):
+    """Return candidate epoch indices and ``index -> feature names``.
+
+    Only large values count as artefacts (a quiet epoch is not a candidate).
+    """
+    data = epochs.get_data(picks=picks)
+    reasons = {}
+    for name, values in epoch_features(data).items():
+        flagged = (robust_z(values) > threshold).any(axis=1)
+        for idx in np.flatnonzero(flagged):
+            reasons.setdefault(int(idx), []).append(name)
+    return sorted(reasons), reasons
+
+
+def _epoch_colors(epochs, n_channels: int, candidates) -> list:
+    candidates = set(candidates)
+    return [
+        [CANDIDATE_COLOR if idx in candidates else "k"] * n_channels
+        for idx in range(len(epochs))
+    ]
+
+
+def plot_with_candidates(epochs, candidates, picks, **kwargs) -> None:
+    """Open the epochs browser with ``candidates`` pre-marked, and block.
+
+    The matplotlib browser is used because it lets the candidates be marked
+    as bad before it is shown. Epochs still marked when the browser is closed
+    are dropped from ``epochs`` as usual. Marking relies on the browser's
+    private ``_toggle_bad_epoch``; if that is missing or fails, the browser
+    opens with the candidates drawn in red instead.
+    """
+    fig = None
+    try:
+        with mne.viz.use_browser_backend("matplotlib"):
+            fig = epochs.plot(picks=picks, block=False, **kwargs)
+        if not hasattr(fig, "_toggle_bad_epoch"):
+            raise AttributeError("this MNE browser cannot mark epochs before showing")
+        boundaries = fig.mne.boundary_times
+        for idx in candidates:
+            fig._toggle_bad_epoch((boundaries[idx] + boundaries[idx + 1]) / 2)
+    except Exception as exc:
+        print(f"Could not pre-mark candidate epochs ({exc}); highlighting them instead.")
+        if fig is not None:
+            plt.close(fig)
+        epochs.plot(picks=picks, block=True,
+                    epoch_colors=_epoch_colors(epochs, len(picks), candidates),
+                    **kwargs)
+        return
+    plt.show(block=True)
@@ -0,0 +1,162 @@
+"""Compact epochs products written by P03 and read by the later stages.
+
+Posterior-ROI epochs
+--------------------
+A01, A02, G01 and G02 only use a few posterior channels, but the cleaned
+``*_epo-cue.fif`` holds every channel. P03 therefore also writes
+``*_epo-cue-roi.fif`` with only the ROI channels (``roi_channels`` in P03).
+``read_epochs_for_channels`` reads it whenever it contains the channels that
+a caller needs, and the full file otherwise. It checks this with
+``mne.io.read_info`` only, so no data is read twice.
+
+Group-analysis delta
+--------------------
+P03 used to write two nearly identical files per label: the cleaned
+``*_epo-cue.fif`` and ``*_epo-cue-group.fif``, a copy in which only the
+rejected posterior channels were interpolated. The group variant is now
+stored as ``*_epo-cue-group.npz``, which holds only
+
+    channels        names of the interpolated channels
+    data            their interpolated data, (n_epochs, n_channels, n_times)
+    event_samples   cue-event sample of every epoch, to check alignment
+    bads            info['bads'] of the group epochs after interpolation
+
+``read_group_epochs`` rebuilds the group epochs from the cleaned file and the
+delta. A legacy ``*_epo-cue-group.fif`` (for example from
+``old/interpolate_sub119_for_group.py``) is still read when there is no
+delta.
+"""
+from __future__ import annotations
+
+from pathlib import Path
+
+import mne
+import numpy as np
+
+from derivative_storage import (DEFAULT_STORAGE_POLICY, STORAGE_POLICIES,
+                                save_derivative)
+from pipeline_state import save_npz
+
+
+def roi_epochs_fname(epochs_fname: str | Path) -> Path:
+    """``*_epo-cue.fif`` -> ``*_epo-cue-roi.fif``."""
+    epochs_fname = Path(epochs_fname)
+    return epochs_fname.with_name(
+        epochs_fname.name.removesuffix(".fif") + "-roi.fif"
+    )
+
+
+def save_roi_epochs(epochs, epochs_fname: str | Path, channels,
+                    policy: str = DEFAULT_STORAGE_POLICY):
+    """Write the ``channels`` of ``epochs`` (bads included) next to ``epochs_fname``.
+
+    Returns the file name and the storage record.
+    """
+    present = [ch for ch in channels if ch in epochs.ch_names]
+    fname = roi_epochs_fname(epochs_fname)
+    record = save_derivative(epochs.copy().pick(present), fname,
+                             policy=policy, verify=False)
+    return fname, record
+
+
+def epochs_fname_for_channels(epochs_fname: str | Path, channels) -> Path:
+    """The ROI file if it holds every requested channel of ``epochs_fname``."""
+    epochs_fname = Path(epochs_fname)
+    roi_fname = roi_epochs_fname(epochs_fname)
+    if channels is None or not roi_fname.exists():
+        return epochs_fname
+
+    # A channel missing from the full file cannot be in the ROI file either.
+    available = set(mne.io.read_info(epochs_fname, verbose=False).ch_names)
+    needed = {ch for ch in channels if ch in available}
+    roi_channels = set(mne.io.read_info(roi_fname, verbose=False).ch_names)
+    return roi_fname if needed <= roi_channels else epochs_fname
+
+
+def read_epochs_for_channels(epochs_fname: str | Path, channels, verbose=None):
+    """Read the smallest P03 epochs file that contains ``channels``."""
+    fname = epochs_fname_for_channels(epochs_fname, channels)
+    return mne.read_epochs(fname, preload=True, verbose=verbose)
+
+
+def group_delta_fname(epochs_fname: str | Path) -> Path:
+    """``*_epo-cue.fif`` -> ``*_epo-cue-group.npz``."""
+    epochs_fname = Path(epochs_fname)
+    return epochs_fname.with_name(
+        epochs_fname.name.removesuffix(".fif") + "-group.npz"
+    )
+
+
+def legacy_group_fname(epochs_fname: str | Path) -> Path:
+    """``*_epo-cue.fif`` -> ``*_epo-cue-group.fif``."""
+    epochs_fname = Path(epochs_fname)
+    return epochs_fname.with_name(
+        epochs_fname.name.removesuffix(".fif") + "-group.fif"
+    )
+
+
+def save_group_delta(epochs_fname: str | Path, group_epochs, channels,
+                     policy: str = DEFAULT_STORAGE_POLICY) -> Path:
+    """Write the interpolated ``channels`` of ``group_epochs`` as a delta.
+
+    ``epochs_fname`` is the cleaned epochs file the delta applies to. A legacy
+    full group file next to it is removed, because it would be stale.
+    """
+    channels = [str(ch) for ch in channels]
+    picks = [group_epochs.ch_names.index(ch) for ch in channels]
+    data = group_epochs.get_data(picks=picks) if picks else np.empty(
+        (len(group_epochs), 0, len(group_epochs.times))
+    )
+
+    fname = group_delta_fname(epochs_fname)
+    save_npz(
+        fname,
+        channels=np.array(channels, dtype=str),
+        data=data.astype(STORAGE_POLICIES[policy]),
+        event_samples=group_epochs.events[:, 0],
+        bads=np.array(group_epochs.info["bads"], dtype=str),
+    )
+
+    legacy = legacy_group_fname(epochs_fname)
+    if legacy.exists():
+        legacy.unlink()
+        print(f"Removed superseded group epochs file: {legacy}")
+    return fname
+
+
+def read_group_epochs(epochs_fname: str | Path, verbose=None):
+    """Read the group-analysis version of the cleaned epochs in ``epochs_fname``.
+
+    A full ``*_epo-cue-group.fif`` that is newer than the delta is used
+    instead of it. Such files are written by hand-made fixes, for example
+    ``old/interpolate_sub119_for_group.py``, after P03; re-running P03
+    removes them again.
+    """
+    delta_fname = group_delta_fname(epochs_fname)
+    legacy = legacy_group_fname(epochs_fname)
+    if legacy.exists() and (not delta_fname.exists()
+                            or legacy.stat().st_mtime > delta_fname.stat().st_mtime):
+        print(f"Using full group epochs file: {legacy}")
+        return mne.read_epochs(legacy, preload=True, verbose=verbose)
+    if not delta_fname.exists():
+        raise FileNotFoundError(
+            f"No group epochs for {epochs_fname}: expected {delta_fname}"
+        )
+
+    epochs = mne.read_epochs(epochs_fname, preload=True, verbose=verbose)
+    with np.load(delta_fname) as delta:
+        channels = [str(ch) for ch in delta["channels"]]
+        if not np.array_equal(delta["event_samples"], epochs.events[:, 0]):
+            raise RuntimeError(
+                f"{delta_fname} does not match the epochs in {epochs_fname}; "
+                "re-run P03 for this subject."
+            )
+        if channels:
+            picks = [epochs.ch_names.index(ch) for ch in channels]
+            epochs._data[:, picks] = delta["data"]
+        epochs.info["bads"] = [str(ch) for ch in delta["bads"]]
+
+    # P03 sets the standard montage before interpolating.
+    if epochs.get_montage() is None:
+        epochs.set_montage("standard_1020", on_missing="warn")
+    return epochs
@@ -0,0 +1,110 @@
+"""Single-trial P1/N1 peak features of the cue and grating ERPs.
+
+A01 only wrote averaged evokeds, so any trial-level model of stim vs no-stim
+had to re-read and re-filter the epochs. A01 now also writes one long-format
+table per subject, ``*_erp-features.tsv``, with one row per label, window,
+component, channel and trial:
+
+    stim          'no-stim' or 'stim'
+    window        'cue' or 'grating' (times relative to that onset)
+    component     'P1', 'N1', ...
+    channel       posterior channel
+    epoch         index of the epoch within the label
+    event_sample  sample of the cue event, to match epochs across stages
+    condition     'cue_onset_right' or 'cue_onset_left'
+    amplitude     peak amplitude in V
+    latency       peak latency in s
+
+The features are taken from the same 30 Hz low-passed, baseline-corrected
+single trials as the A01 evokeds (``evoked_engine.window_trials``).
+``peak_features`` works on the whole ``(n_epochs, n_channels, n_times)``
+array at once. ``group_utils.read_cohort_erp_features`` stacks the subject
+tables into one cohort table with a ``subject`` column, ready for
+mixed-effects models.
+"""
+from __future__ import annotations
+
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+
+# Search windows (s, relative to the onset of each window) and peak polarity.
+ERP_COMPONENTS = {
+    "cue": {
+        "P1": dict(tmin=0.08, tmax=0.13, polarity=1),
+        "N1": dict(tmin=0.13, tmax=0.20, polarity=-1),
+    },
+    "grating": {
+        "P1": dict(tmin=0.08, tmax=0.13, polarity=1),
+        "N1": dict(tmin=0.13, tmax=0.20, polarity=-1),
+    },
+}
+
+COLUMNS = ("stim", "window", "component", "channel", "epoch", "event_sample",
+           "condition", "amplitude", "latency")
+CATEGORICAL = ("subject", "stim", "window", "component", "channel", "condition")
+
+
+def peak_features(data: np.ndarray, times: np.ndarray, tmin: float, tmax: float,
+                  polarity: int = 1):
+    """Peak amplitude and latency of every trace of ``(..., n_times)``.
+
+    A positive ``polarity`` looks for the maximum, a negative one for the
+    minimum. Both outputs have the shape of ``data`` without the time axis.
+    """
+    mask = (times >= tmin) & (times <= tmax)
+    if not mask.any():
+        raise ValueError(f"No samples between {tmin} and {tmax} s.")
+    segment = data[..., mask]
+    peak = np.argmax(np.sign(polarity) * segment, axis=-1)
+    amplitude = np.take_along_axis(segment, peak[..., np.newaxis], axis=-1)[..., 0]
+    return amplitude, times[mask][peak]
+
+
+def trial_features(trials: dict, times: dict, ch_names, events, event_id: dict,
+                   stim: str, components: dict = ERP_COMPONENTS) -> pd.DataFrame:
+    """Long-format feature table of one label.
+
+    ``trials`` and ``times`` map each window name to its
+    ``(n_epochs, n_channels, n_times)`` trials and their times.
+    """
+    names_by_code = {code: name for name, code in event_id.items()}
+    rows = []
+    for window, window_components in components.items():
+        n_epochs, n_channels = trials[window].shape[:2]
+        epoch = np.repeat(np.arange(n_epochs), n_channels)
+        base = {
+            "channel": np.tile(np.asarray(ch_names), n_epochs),
+            "epoch": epoch,
+            "event_sample": events[epoch, 0],
+            "condition": [names_by_code[code] for code in events[epoch, 2]],
+        }
+        for component, spec in window_components.items():
+            amplitude, latency = peak_features(trials[window], times[window], **spec)
+            rows.append(pd.DataFrame({
+                "stim": stim,
+                "window": window,
+                "component": component,
+                **base,
+                "amplitude": amplitude.ravel(),
+                "latency": latency.ravel(),
+            }, columns=list(COLUMNS)))
+    return pd.concat(rows, ignore_index=True)
+
+
+def write_features(fname: str | Path, table: pd.DataFrame) -> Path:
+    """Write a feature table as tab-separated values."""
+    fname = Path(fname)
+    table.to_csv(fname, sep="\t", index=False, float_format="%.6g")
+    return fname
+
+
+def read_features(fname: str | Path) -> pd.DataFrame:
+    """Read a feature table, with the label columns as categoricals."""
+    table = pd.read_csv(fname, sep="\t", dtype={"subject": str})
+    for column in CATEGORICAL:
+        if column in table:
+            table[column] = table[column].astype("category")
+    return table
@@ -0,0 +1,127 @@
+"""Average once, filter once, cut any number of evoked windows.
+
+A01 used to average and low-pass filter all cue epochs twice per label, once
+for the cue window and once for the grating window, and to copy the full
+evoked before cropping. ``evoked_windows`` averages the epochs and applies
+the cached 30 Hz FIR low-pass a single time. It then cuts each named window
+out of that average. Only the samples of the window are copied, because the
+baseline is subtracted in place.
+
+A window is a dict with ``tmin``, ``tmax``, ``baseline`` and an optional
+``shift``; the steps are the same as ``crop`` -> ``apply_baseline`` ->
+``shift_time`` on the filtered average, for example::
+
+    EVOKED_WINDOWS = {
+        'cue': dict(tmin=-0.1, tmax=0.5, baseline=(-0.1, 0)),
+        'grating': dict(tmin=1.1, tmax=1.6, baseline=(1.1, 1.2), shift=-1.2),
+    }
+
+``window_trials`` returns the single trials behind those evokeds, for the
+bootstrap bands in ``bootstrap_ci``. The trials are filtered with the same
+kernel, cut to the same windows and baseline-corrected. Both steps are
+linear, so the mean of these trials is the evoked from ``evoked_windows``.
+"""
+from __future__ import annotations
+
+import mne
+import numpy as np
+
+from filter_cache import apply_kernel, filter_inst, filter_kernel
+
+
+def _crop_mask(times: np.ndarray, tmin: float, tmax: float, sfreq: float) -> np.ndarray:
+    # Same sample rounding as Evoked.crop().
+    tmin = int(round(tmin * sfreq)) / sfreq - 0.5 / sfreq
+    tmax = int(round(tmax * sfreq)) / sfreq + 0.5 / sfreq
+    return (times >= tmin) & (times <= tmax)
+
+
+def _baseline_mask(times: np.ndarray, baseline) -> np.ndarray:
+    bmin = times[0] if baseline[0] is None else baseline[0]
+    bmax = times[-1] if baseline[1] is None else baseline[1]
+    return (times >= bmin) & (times <= bmax)
+
+
+def filtered_average(epochs, picks=None, l_freq: float | None = None,
+                     h_freq: float | None = 30.0, method: str = "mean"):
+    """Average ``epochs`` and filter the average once with a cached kernel."""
+    return filter_inst(epochs.average(picks=picks, method=method),
+                       l_freq=l_freq, h_freq=h_freq)
+
+
+def cut_window(evoked, tmin: float, tmax: float, baseline=None,
+               shift: float | None = None):
+    """One window of ``evoked`` as a new Evoked, baseline-corrected and shifted."""
+    mask = _crop_mask(evoked.times, tmin, tmax, evoked.info["sfreq"])
+    window = mne.EvokedArray(
+        evoked.data[:, mask].copy(),
+        evoked.info.copy(),
+        tmin=evoked.times[mask][0],
+        comment=evoked.comment,
+        nave=evoked.nave,
+        kind=evoked.kind,
+        baseline=baseline,
+        verbose=False,
+    )
+    if shift is not None:
+        window.shift_time(shift, relative=True)
+    return window
+
+
+def evoked_windows(epochs, windows: dict, picks=None,
+                   l_freq: float | None = None, h_freq: float | None = 30.0,
+                   method: str = "mean") -> dict:
+    """Return ``name -> Evoked`` for every window in ``windows``."""
+    average = filtered_average(epochs, picks=picks, l_freq=l_freq,
+                               h_freq=h_freq, method=method)
+    return {name: cut_window(average, **window) for name, window in windows.items()}
+
+
+def window_trials(epochs, windows: dict, picks=None,
+                  l_freq: float | None = None,
+                  h_freq: float | None = 30.0) -> dict:
+    """Return ``name -> (n_epochs, n_channels, n_times)`` trials per window."""
+    data = epochs.get_data(picks=picks)
+    kernel = filter_kernel(epochs.info["sfreq"], l_freq, h_freq)
+    # Evoked filtering pads with the edge value; that is linear as well.
+    data = apply_kernel(data, kernel, pad="edge")
+
+    trials = {}
+    for name, window in windows.items():
+        mask = _crop_mask(epochs.times, window["tmin"], window["tmax"],
+                          epochs.info["sfreq"])
+        window_data = data[..., mask]
+        if window.get("baseline") is not None:
+            in_baseline = _baseline_mask(epochs.times[mask], window["baseline"])
+            window_data -= window_data[..., in_baseline].mean(axis=-1, keepdims=True)
+        trials[name] = window_data
+    return trials
+
+
+def condition_windows(epochs, windows: dict, conditions: dict,
+                      combined: str = "both", **kwargs) -> dict:
+    """Return ``condition -> name -> Evoked``, with ``combined`` first.
+
+    ``conditions`` maps a condition name to an epochs selector, for example
+    ``{'right': 'cue_onset_right', 'left': 'cue_onset_left'}``. Each
+    condition is averaged once. The combined condition is the nave-weighted
+    mean of the others. Filtering and baseline correction are linear, so this
+    is the same as averaging all their epochs together.
+    """
+    by_condition = {
+        condition: evoked_windows(epochs[selector], windows, **kwargs)
+        for condition, selector in conditions.items()
+    }
+    out = {combined: {}}
+    for name in windows:
+        evoked = mne.combine_evoked(
+            [by_condition[condition][name] for condition in conditions],
+            weights="nave",
+        )
+        evoked.comment = combined
+        out[combined][name] = evoked
+    for condition, evokeds in by_condition.items():
+        for evoked in evokeds.values():
+            evoked.comment = condition
+        out[condition] = evokeds
+    return out
@@ -0,0 +1,202 @@
+"""Cached FIR filtering for the STN EEG scripts.
+
+``inst.filter()`` designs a new FIR kernel on every call, although the
+pipeline only ever uses a handful of filters (0.1-100 Hz in P02, the 30 Hz
+ERP low-pass in A01, G01 and G02) at one sampling rate. The group scripts
+apply the same 30 Hz low-pass hundreds of times per run.
+
+Kernels are designed once with ``mne.filter.create_filter`` and kept in a
+process-wide dictionary. They are also written to the pipeline state
+directory, so later runs and other stages load them instead of designing them
+again. ``filter_inst`` applies a cached kernel with the same zero-phase FIR
+behaviour as MNE's default ``filter()`` for Raw, Epochs and Evoked objects.
+"""
+from __future__ import annotations
+
+import threading
+
+import mne
+import numpy as np
+from scipy import signal
+
+from pipeline_state import save_array, stable_hash, state_dir
+
+
+_KERNELS: dict[str, np.ndarray] = {}
+_LOCK = threading.Lock()
+
+# Raw.filter() skips across these annotations, so each piece is filtered alone.
+_SKIP_ANNOTATIONS = ("edge", "bad_acq_skip")
+
+# Number of channels (or epoch x channel rows) filtered in one convolution.
+_BLOCK_ROWS = 16
+
+
+def kernel_key(
+    sfreq: float,
+    l_freq: float | None,
+    h_freq: float | None,
+    l_trans_bandwidth="auto",
+    h_trans_bandwidth="auto",
+    filter_length="auto",
+    fir_window: str = "hamming",
+    fir_design: str = "firwin",
+) -> str:
+    """Return the cache key for one FIR design."""
+    return stable_hash({
+        "sfreq": float(sfreq),
+        "l_freq": None if l_freq is None else float(l_freq),
+        "h_freq": None if h_freq is None else float(h_freq),
+        "l_trans_bandwidth": l_trans_bandwidth,
+        "h_trans_bandwidth": h_trans_bandwidth,
+        "filter_length": filter_length,
+        "fir_window": fir_window,
+        "fir_design": fir_design,
+        "phase": "zero",
+        # The state directory may be shared by machines with other MNE versions.
+        "mne": mne.__version__,
+    })
+
+
+def filter_kernel(
+    sfreq: float,
+    l_freq: float | None,
+    h_freq: float | None,
+    l_trans_bandwidth="auto",
+    h_trans_bandwidth="auto",
+    filter_length="auto",
+    fir_window: str = "hamming",
+    fir_design: str = "firwin",
+) -> np.ndarray:
+    """Return a zero-phase FIR kernel, designing it only if it is not cached."""
+    key = kernel_key(sfreq, l_freq, h_freq, l_trans_bandwidth,
+                     h_trans_bandwidth, filter_length, fir_window, fir_design)
+    with _LOCK:
+        if key in _KERNELS:
+            return _KERNELS[key]
+
+        fname = state_dir("filter_kernels") / f"{key}.npy"
+        if fname.exists():
+            kernel = np.load(fname)
+        else:
+            kernel = mne.filter.create_filter(
+                None,
+                float(sfreq),
+                l_freq,
+                h_freq,
+                filter_length=filter_length,
+                l_trans_bandwidth=l_trans_bandwidth,
+                h_trans_bandwidth=h_trans_bandwidth,
+                method="fir",
+                phase="zero",
+                fir_window=fir_window,
+                fir_design=fir_design,
+                verbose=False,
+            )
+            save_array(fname, kernel)
+        _KERNELS[key] = kernel
+        return kernel
+
+
+def _pad(x: np.ndarray, n_pad: int, pad: str) -> np.ndarray:
+    if n_pad == 0:
+        return x
+    if pad != "reflect_limited":
+        widths = [(0, 0)] * (x.ndim - 1) + [(n_pad, n_pad)]
+        return np.pad(x, widths, mode=pad)
+    # Same odd reflection as MNE's "reflect_limited": reflect up to the signal
+    # length and fill anything beyond that with zeros.
+    n_zeros = max(n_pad - x.shape[-1] + 1, 0)
+    zeros = np.zeros(x.shape[:-1] + (n_zeros,), dtype=x.dtype)
+    left = 2 * x[..., :1] - x[..., n_pad:0:-1]
+    right = 2 * x[..., -1:] - x[..., -2:-n_pad - 2:-1]
+    return np.concatenate([zeros, left, x, right, zeros], axis=-1)
+
+
+def apply_kernel(data, kernel: np.ndarray, pad: str = "reflect_limited") -> np.ndarray:
+    """Zero-phase FIR filter the last axis of ``data`` with ``kernel``."""
+    data = np.asarray(data, dtype=float)
+    n_times = data.shape[-1]
+    n_h = len(kernel)
+    n_edge = max(min(n_h, n_times) - 1, 0)
+    start = n_edge + (n_h - 1) // 2
+
+    rows = data.reshape(-1, n_times)
+    out = np.empty_like(rows)
+    kernel_2d = kernel[np.newaxis, :]
+    for first in range(0, rows.shape[0], _BLOCK_ROWS):
+        block = _pad(rows[first:first + _BLOCK_ROWS], n_edge, pad)
+        filtered = signal.oaconvolve(block, kernel_2d, mode="full", axes=-1)
+        out[first:first + _BLOCK_ROWS] = filtered[:, start:start + n_times]
+    return out.reshape(data.shape)
+
+
+def _raw_segments(raw) -> list[tuple[int, int]]:
+    """Sample ranges between edge/skip annotations, as filtered by MNE."""
+    offset = raw.first_time if raw.annotations.orig_time is not None else 0.0
+    regions = []
+    for annot in raw.annotations:
+        if not annot["description"].lower().startswith(_SKIP_ANNOTATIONS):
+            continue
+        start = int(np.round((annot["onset"] - offset) * raw.info["sfreq"]))
+        stop = start + int(np.round(annot["duration"] * raw.info["sfreq"]))
+        regions.append((max(start, 0), min(stop, raw.n_times)))
+
+    segments = []
+    position = 0
+    for start, stop in sorted(regions):
+        if start > position:
+            segments.append((position, start))
+        position = max(position, stop)
+    if position < raw.n_times:
+        segments.append((position, raw.n_times))
+    return segments
+
+
+def filter_inst(
+    inst,
+    l_freq: float | None,
+    h_freq: float | None,
+    picks=None,
+    l_trans_bandwidth="auto",
+    h_trans_bandwidth="auto",
+    filter_length="auto",
+):
+    """Filter a preloaded Raw, Epochs or Evoked in place with a cached kernel.
+
+    Equivalent to ``inst.filter(l_freq, h_freq)`` with MNE's FIR defaults;
+    returns ``inst`` so calls can be chained in the same way.
+    """
+    if not getattr(inst, "preload", True):
+        raise RuntimeError("filter_inst() requires preloaded data.")
+
+    sfreq = inst.info["sfreq"]
+    kernel = filter_kernel(sfreq, l_freq, h_freq, l_trans_bandwidth,
+                           h_trans_bandwidth, filter_length)
+    if picks is None:
+        picks = mne.pick_types(inst.info, meg=True, eeg=True, seeg=True,
+                               ecog=True, dbs=True, fnirs=True, csd=True,
+                               exclude=[])
+    else:
+        picks = [inst.ch_names.index(ch) if isinstance(ch, str) else ch
+                 for ch in picks]
+
+    if isinstance(inst, mne.io.BaseRaw):
+        data = inst._data
+        for start, stop in _raw_segments(inst):
+            data[picks, start:stop] = apply_kernel(
+                data[picks, start:stop], kernel, pad="reflect_limited"
+            )
+    elif isinstance(inst, mne.Evoked):
+        inst.data[picks] = apply_kernel(inst.data[picks], kernel, pad="edge")
+    else:
+        inst._data[:, picks] = apply_kernel(inst._data[:, picks], kernel, pad="edge")
+
+    with inst.info._unlock():
+        if h_freq is not None and (inst.info["lowpass"] is None
+                                   or h_freq < inst.info["lowpass"]):
+            inst.info["lowpass"] = float(h_freq)
+        if l_freq is not None and (inst.info["highpass"] is None
+                                   or l_freq > inst.info["highpass"]):
+            inst.info["highpass"] = float(l_freq)
+    return inst
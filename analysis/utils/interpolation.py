@@ -0,0 +1,136 @@
+"""Spherical-spline interpolation matrices for the STN EEG scripts.
+
+This is the same computation as MNE's ``_make_interpolation_matrix`` (and so
+PyPREP's RANSAC). It uses Legendre terms with stiffness 4 and seven terms, a
+regularisation of 1e-5 and the pseudo-inverse of the bordered system
+``[[G, 1], [1, 0]]``. Keeping it here means the matrices can be reused and
+cached without depending on MNE internals.
+
+``interpolate_bads`` is a cached replacement for ``inst.interpolate_bads()``
+on EEG channels. The matrix depends only on the sensor positions, the
+head-sphere origin and the good and bad channel sets. It is therefore kept
+in the pipeline state directory and shared by every subject with the same
+montage and bad set (typically one of PO3/PO4/POz). It is applied to all
+epochs with a single matmul.
+"""
+from __future__ import annotations
+
+import threading
+
+import mne
+import numpy as np
+from numpy.polynomial.legendre import legval
+
+from pipeline_state import save_array, stable_hash, state_dir
+
+
+# MNE's fallback origin when no sphere can be fitted to the digitisation.
+DEFAULT_ORIGIN = (0.0, 0.0, 0.04)
+
+_MATRICES: dict[str, np.ndarray] = {}
+_LOCK = threading.Lock()
+
+
+def _calc_g(cosang: np.ndarray, stiffness: int = 4,
+            n_legendre_terms: int = 7) -> np.ndarray:
+    """Spherical-spline G function evaluated at the cosine angles."""
+    factors = [
+        (2 * n + 1) / (n ** stiffness * (n + 1) ** stiffness * 4 * np.pi)
+        for n in range(1, n_legendre_terms + 1)
+    ]
+    return legval(cosang, [0] + factors)
+
+
+def _normalize(pos: np.ndarray) -> np.ndarray:
+    pos = np.array(pos, dtype=float)
+    norms = np.linalg.norm(pos, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return pos / norms
+
+
+def make_interpolation_matrix(pos_from: np.ndarray, pos_to: np.ndarray,
+                              alpha: float = 1e-5) -> np.ndarray:
+    """Matrix mapping signals at ``pos_from`` to signals at ``pos_to``.
+
+    Positions are ``(n, 3)`` arrays (subtract the head-sphere origin first if
+    needed); they are projected onto the unit sphere. Returns
+    ``(n_to, n_from)``.
+    """
+    pos_from = _normalize(pos_from)
+    pos_to = _normalize(pos_to)
+    n_from = len(pos_from)
+
+    g_from = _calc_g(pos_from @ pos_from.T)
+    g_to_from = _calc_g(pos_to @ pos_from.T)
+    if alpha is not None:
+        g_from.flat[::n_from + 1] += alpha
+
+    system = np.block([
+        [g_from, np.ones((n_from, 1))],
+        [np.ones((1, n_from)), np.zeros((1, 1))],
+    ])
+    system_inv = np.linalg.pinv(system)
+    return np.hstack([g_to_from, np.ones((len(pos_to), 1))]) @ system_inv[:, :-1]
+
+
+def head_origin(info) -> np.ndarray:
+    """Head-sphere origin in metres, as used by ``interpolate_bads``."""
+    try:
+        _, origin, _ = mne.bem.fit_sphere_to_headshape(info, units="m",
+                                                       verbose=False)
+    except Exception:
+        origin = DEFAULT_ORIGIN
+    return np.asarray(origin, dtype=float)
+
+
+def eeg_interpolation_matrix(info, bads=None):
+    """Cached matrix from the good to the bad EEG channels of ``info``.
+
+    Returns ``(matrix, good_picks, bad_picks)``. As in MNE, all EEG channels
+    that are not in ``bads`` (default ``info['bads']``) are used as goods.
+    """
+    bads = set(info["bads"] if bads is None else bads)
+    picks = mne.pick_types(info, meg=False, eeg=True, exclude=[])
+    bad_picks = np.array([idx for idx in picks if info.ch_names[idx] in bads], dtype=int)
+    good_picks = np.array([idx for idx in picks if info.ch_names[idx] not in bads], dtype=int)
+
+    pos = np.array([info["chs"][idx]["loc"][:3] for idx in picks])
+    origin = head_origin(info)
+    key = stable_hash({
+        "pos": np.round(pos, 6),
+        "origin": np.round(origin, 6),
+        "goods": [info.ch_names[idx] for idx in good_picks],
+        "bads": [info.ch_names[idx] for idx in bad_picks],
+    })
+    with _LOCK:
+        if key not in _MATRICES:
+            fname = state_dir("interpolation", "eeg") / f"{key}.npy"
+            if fname.exists():
+                matrix = np.load(fname)
+            else:
+                is_bad = np.isin(picks, bad_picks)
+                matrix = make_interpolation_matrix(pos[~is_bad] - origin,
+                                                   pos[is_bad] - origin)
+                save_array(fname, matrix)
+            _MATRICES[key] = matrix
+    return _MATRICES[key], good_picks, bad_picks
+
+
+def interpolate_bads(inst, reset_bads: bool = True):
+    """Interpolate the bad EEG channels of a preloaded Raw, Epochs or Evoked.
+
+    Same result as ``inst.interpolate_bads(reset_bads=reset_bads)`` for EEG,
+    using a cached matrix. Works in place and returns ``inst``.
+    """
+    matrix, good_picks, bad_picks = eeg_interpolation_matrix(inst.info)
+    if len(bad_picks) == 0:
+        return inst
+
+    data = inst.data if isinstance(inst, mne.Evoked) else inst._data
+    # (..., n_good, n_times) -> (..., n_bad, n_times) for every epoch at once.
+    data[..., bad_picks, :] = np.matmul(matrix, data[..., good_picks, :])
+
+    if reset_bads:
+        interpolated = {inst.ch_names[idx] for idx in bad_picks}
+        inst.info["bads"] = [ch for ch in inst.info["bads"] if ch not in interpolated]
+    return inst
@@ -0,0 +1,93 @@
+"""Run the no-stim and stim steps of a subject script concurrently.
+
+P02, P03, A01 and A02 all loop over ``['no-stim', 'stim']`` and the two
+labels are independent until the stim-minus-no-stim contrasts at the end.
+``run_by_label`` runs one function per label serially, in a thread pool or
+in a process pool and always returns the results in label order.
+
+Workers never write to the participant PDF directly. They receive a
+``ReportBuffer`` that records report entries, and the calling script flushes
+the buffers into the real report in label order. The PDF is therefore the
+same whichever mode was used.
+
+Thread mode suits the scripts executed by ``run_subject_pipeline.py``: the
+heavy MNE/NumPy work releases the GIL, and functions defined inside those
+scripts cannot be pickled for a process pool. Create Matplotlib figures in
+the main thread; pyplot is not thread safe.
+"""
+from __future__ import annotations
+
+import os
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from pathlib import Path
+from typing import Callable, Dict, Sequence, Tuple
+
+
+LABELS = ("no-stim", "stim")
+PARALLEL_MODES = ("serial", "thread", "process")
+
+
+class ReportBuffer:
+    """Collect ParticipantPDF entries so they can be added later, in order."""
+
+    def __init__(self):
+        self.items = []
+
+    def add_text(self, title: str, text: str, section: str = "General") -> None:
+        self.items.append(("add_text", (title, str(text), section)))
+
+    def add_key_values(self, title: str, values: dict,
+                       section: str = "General") -> None:
+        self.items.append(("add_key_values", (title, dict(values), section)))
+
+    def add_image(self, image_fname: str, title: str,
+                  caption: str = "", section: str = "General") -> None:
+        self.items.append(("add_image", (str(image_fname), title, caption, section)))
+
+    def add_figure(self, fig, image_fname: str, title: str,
+                   caption: str = "", section: str = "General",
+                   dpi: int = 180) -> None:
+        # Only the saved image travels back to the main process.
+        Path(image_fname).parent.mkdir(parents=True, exist_ok=True)
+        if isinstance(fig, (list, tuple)):
+            fig = fig[0]
+        fig.savefig(image_fname, dpi=dpi, bbox_inches="tight")
+        self.add_image(image_fname, title, caption, section)
+
+    def flush(self, report) -> None:
+        """Replay the collected entries into ``report`` and empty the buffer."""
+        for method, args in self.items:
+            getattr(report, method)(*args)
+        self.items = []
+
+
+def _call_with_buffer(func: Callable, label: str):
+    buffer = ReportBuffer()
+    return func(label, buffer), buffer
+
+
+def run_by_label(
+    func: Callable,
+    labels: Sequence[str] = LABELS,
+    mode: str = "serial",
+    max_workers: int | None = None,
+) -> Dict[str, Tuple[object, ReportBuffer]]:
+    """Call ``func(label, buffer)`` for every label.
+
+    Returns a dict ``label -> (result, ReportBuffer)`` in the order of
+    ``labels``. In process mode ``func`` and its result must be picklable.
+    """
+    if mode not in PARALLEL_MODES:
+        raise ValueError(f"mode must be one of {PARALLEL_MODES}, got {mode!r}")
+
+    labels = list(labels)
+    if mode == "serial" or len(labels) < 2:
+        return {label: _call_with_buffer(func, label) for label in labels}
+
+    max_workers = max_workers or min(len(labels), os.cpu_count() or 1)
+    executor_cls = ThreadPoolExecutor if mode == "thread" else ProcessPoolExecutor
+    with executor_cls(max_workers=max_workers) as executor:
+        futures = {label: executor.submit(_call_with_buffer, func, label)
+                   for label in labels}
+        # Collect in label order; an exception in any label is raised here.
+        return {label: futures[label].result() for label in labels}
@@ -0,0 +1,125 @@
+"""Attention modulation index and single-trial hemispheric lateralization.
+
+The old ``A04_group_tfrs_MI.py`` computed the modulation index only on the
+group grand averages. A03 now computes it per subject and label from the
+single-trial power that A02 keeps (``tfr_accumulator``):
+
+    MI  = (P_right - P_left) / (P_right + P_left)
+
+where ``P_right`` / ``P_left`` are the average TFRs of attend-right and
+attend-left trials. MI has the shape ``(n_channels, n_freqs, n_times)`` and
+is computed in one array expression. The hemispheric lateralization index
+of every trial is
+
+    LI  = (P_rh - P_lh) / (P_rh + P_lh)
+
+from the band-mean power (8-14 Hz by default) of a right- and left-
+hemisphere channel pair, e.g. PO4 / PO3. It has the shape
+``(n_trials, n_pairs, n_times)``.
+
+Both are written per subject to ``*_mi.npz`` (``write_mi``), together with
+the event samples and codes of the trials. The group scripts stack these
+files (``group_utils.read_cohort_mi``) without recomputing any TFR.
+"""
+from __future__ import annotations
+
+import re
+from pathlib import Path
+
+import numpy as np
+
+from pipeline_state import save_npz
+
+
+MI_BAND = dict(fmin=8.0, fmax=14.0)
+
+_CHANNEL_RE = re.compile(r"^([A-Za-z]+)(\d+)$")
+
+
+def hemisphere_pairs(ch_names) -> list[tuple[str, str]]:
+    """Homologous ``(left, right)`` pairs present in ``ch_names``.
+
+    In the 10-20 system odd numbers are over the left hemisphere and the
+    following even number is its right homologue (PO3 / PO4). Midline
+    channels (POz) have no pair.
+    """
+    pairs = []
+    for ch in ch_names:
+        match = _CHANNEL_RE.match(ch)
+        if match is None or int(match.group(2)) % 2 == 0:
+            continue
+        right = f"{match.group(1)}{int(match.group(2)) + 1}"
+        if right in ch_names:
+            pairs.append((ch, right))
+    return pairs
+
+
+def modulation_index(right, left) -> np.ndarray:
+    """``(right - left) / (right + left)``; zero where both are zero."""
+    right = np.asarray(right, dtype=float)
+    left = np.asarray(left, dtype=float)
+    total = right + left
+    return np.divide(right - left, total, out=np.zeros_like(total), where=total != 0)
+
+
+def band_mask(freqs, fmin: float, fmax: float) -> np.ndarray:
+    """Frequencies within ``fmin``-``fmax`` Hz."""
+    mask = (freqs >= fmin) & (freqs <= fmax)
+    if not mask.any():
+        raise ValueError(f"No frequencies between {fmin} and {fmax} Hz.")
+    return mask
+
+
+def trial_lateralization(blocks, freqs, ch_names, pairs, fmin: float, fmax: float):
+    """Single-trial LI ``(n_trials, n_pairs, n_times)`` from blocks of power.
+
+    ``blocks`` yields ``(first trial, (n_block, n_channels, n_freqs, n_times))``
+    power, as ``TFRAccumulator.iter_power`` and ``tfr_engine.iter_power`` do.
+    Only the band mean of each block is kept.
+    """
+    mask = band_mask(np.asarray(freqs), fmin, fmax)
+    left = [ch_names.index(lh) for lh, _ in pairs]
+    right = [ch_names.index(rh) for _, rh in pairs]
+    li = [modulation_index(power[:, right][:, :, mask].mean(axis=2),
+                           power[:, left][:, :, mask].mean(axis=2))
+          for _, power in blocks]
+    return np.concatenate(li)
+
+
+def write_mi(fname, ch_names, freqs, times, pairs, band: dict, results: dict) -> Path:
+    """Write ``label -> dict(mi=..., li=..., events=...)`` to ``.npz``.
+
+    Each label is stored as ``<label>_mi`` (float32), ``<label>_li``
+    (float32) and ``<label>_events``.
+    """
+    fname = Path(fname)
+    arrays = {
+        "labels": np.array(list(results), dtype=str),
+        "ch_names": np.array(ch_names, dtype=str),
+        "freqs": np.asarray(freqs, dtype=float),
+        "times": np.asarray(times, dtype=float),
+        "pairs": np.array(pairs, dtype=str).reshape(-1, 2),
+        "band": np.array([band["fmin"], band["fmax"]], dtype=float),
+    }
+    for label, result in results.items():
+        arrays[f"{label}_mi"] = result["mi"].astype(np.float32)
+        arrays[f"{label}_li"] = result["li"].astype(np.float32)
+        arrays[f"{label}_events"] = np.asarray(result["events"], dtype=int)
+    return save_npz(fname, **arrays)
+
+
+def read_mi(fname) -> dict:
+    """Read an MI file; the label arrays are under ``"mi"``, ``"li"`` and ``"events"``."""
+    with np.load(fname) as stored:
+        labels = [str(label) for label in stored["labels"]]
+        return {
+            "labels": labels,
+            "ch_names": [str(ch) for ch in stored["ch_names"]],
+            "freqs": stored["freqs"],
+            "times": stored["times"],
+            "pairs": [tuple(str(ch) for ch in pair) for pair in stored["pairs"]],
+            "band": tuple(float(f) for f in stored["band"]),
+            "mi": {label: stored[f"{label}_mi"].astype(float) for label in labels},
+            "li": {label: stored[f"{label}_li"].astype(float) for label in labels},
+            "events": {label: stored[f"{label}_events"] for label in labels},
+        }
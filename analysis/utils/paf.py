@@ -0,0 +1,154 @@
+"""Peak alpha frequency (PAF) after removing the aperiodic 1/f component.
+
+The old ``A04`` picked the PAF from the group grand-average TFR with a plain
+argmax over 8-14 Hz. With a 1/f spectrum, that argmax is pulled towards
+8 Hz. Here the PAF is estimated for every subject, label and channel from
+the P03 epoch spectra (``*_psd-cue.npz``):
+
+    1. the aperiodic component  log10 P = offset - exponent * log10 f  is
+       fitted over 2-40 Hz with the alpha range left out;
+    2. it is subtracted, leaving the periodic ("flattened") spectrum;
+    3. the PAF is the maximum of the flattened spectrum within 7-14 Hz,
+       refined by a parabola through the three bins around it.
+
+All spectra share the same frequencies, so one design matrix serves all of
+them. The whole cohort, ``(n_subjects, n_labels, n_channels, n_freqs)``, is
+fitted with a single ``np.linalg.lstsq`` call. No PAF (NaN) is given when the
+maximum is on the edge of the range or less than ``MIN_PEAK`` above the
+aperiodic fit.
+
+``alpha_band`` turns a PAF into an individual band (PAF +/- 2 Hz) for the MI
+and band-power stages. G03 writes the cohort table, ``group_paf.tsv``;
+``subject_alpha_band`` reads one subject's band from it.
+"""
+from __future__ import annotations
+
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+
+PAF_RANGE = (7.0, 14.0)
+APERIODIC_RANGE = (2.0, 40.0)
+MIN_PEAK = 0.05  # log10 units above the aperiodic fit, about +12 % power
+PAF_HALF_WIDTH = 2.0
+DEFAULT_ALPHA = (8.0, 14.0)
+PAF_FNAME = "group_paf.tsv"
+
+COLUMNS = ("subject", "stim", "channel", "paf", "peak_power", "offset",
+           "exponent", "r2")
+
+
+def fit_aperiodic(freqs, psd, fmin: float = APERIODIC_RANGE[0],
+                  fmax: float = APERIODIC_RANGE[1], exclude=PAF_RANGE):
+    """``offset``, ``exponent`` and ``r2`` of the 1/f fit of every spectrum.
+
+    ``psd`` has frequencies on the last axis; all spectra are solved in one
+    least-squares call. Spectra with missing values (e.g. a rejected
+    channel, stored as NaN) give NaN.
+    """
+    freqs = np.asarray(freqs, dtype=float)
+    psd = np.asarray(psd, dtype=float)
+    keep = (freqs >= fmin) & (freqs <= fmax)
+    if exclude is not None:
+        keep &= ~((freqs >= exclude[0]) & (freqs <= exclude[1]))
+    design = np.column_stack([np.ones(keep.sum()), -np.log10(freqs[keep])])
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        y = np.log10(psd[..., keep]).reshape(-1, keep.sum())
+    valid = np.isfinite(y).all(axis=1)
+    coefs = np.full((len(y), 2), np.nan)
+    r2 = np.full(len(y), np.nan)
+    if valid.any():
+        solution = np.linalg.lstsq(design, y[valid].T, rcond=None)[0]
+        coefs[valid] = solution.T
+        total = ((y[valid] - y[valid].mean(axis=1, keepdims=True)) ** 2).sum(axis=1)
+        fitted = y[valid] - solution.T @ design.T
+        r2[valid] = 1 - (fitted ** 2).sum(axis=1) / total
+    shape = psd.shape[:-1]
+    return coefs[:, 0].reshape(shape), coefs[:, 1].reshape(shape), r2.reshape(shape)
+
+
+def flattened_spectrum(freqs, psd, offset, exponent) -> np.ndarray:
+    """log10 power minus the aperiodic fit, for every spectrum."""
+    freqs = np.asarray(freqs, dtype=float)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        return (np.log10(np.asarray(psd, dtype=float))
+                - (offset[..., np.newaxis] - exponent[..., np.newaxis] * np.log10(freqs)))
+
+
+def peak_alpha(freqs, psd, paf_range=PAF_RANGE, aperiodic_range=APERIODIC_RANGE,
+               min_peak: float = MIN_PEAK) -> dict:
+    """PAF of every spectrum of ``psd`` ``(..., n_freqs)``.
+
+    Returns a dict of arrays with the shape of ``psd`` without the frequency
+    axis: ``paf``, ``peak_power`` (log10 units above the 1/f fit),
+    ``offset``, ``exponent`` and ``r2``.
+    """
+    freqs = np.asarray(freqs, dtype=float)
+    offset, exponent, r2 = fit_aperiodic(freqs, psd, *aperiodic_range, exclude=paf_range)
+    flat = flattened_spectrum(freqs, psd, offset, exponent)
+
+    in_range = (freqs >= paf_range[0]) & (freqs <= paf_range[1])
+    band_freqs = freqs[in_range]
+    segment = flat[..., in_range]
+    finite = np.isfinite(segment).all(axis=-1)
+    peak = np.argmax(np.where(np.isfinite(segment), segment, -np.inf), axis=-1)
+    peak_power = np.take_along_axis(segment, peak[..., np.newaxis], axis=-1)[..., 0]
+
+    # Parabolic interpolation through the peak bin and its two neighbours.
+    inner = np.clip(peak, 1, len(band_freqs) - 2)
+    y0, y1, y2 = (np.take_along_axis(segment, (inner + k)[..., np.newaxis], axis=-1)[..., 0]
+                  for k in (-1, 0, 1))
+    curvature = y0 - 2 * y1 + y2
+    with np.errstate(divide="ignore", invalid="ignore"):
+        delta = np.where(curvature < 0, 0.5 * (y0 - y2) / curvature, 0.0)
+    step = np.gradient(band_freqs)[inner]
+    paf = band_freqs[inner] + np.clip(delta, -0.5, 0.5) * step
+
+    on_edge = (peak == 0) | (peak == len(band_freqs) - 1)
+    paf = np.where(finite & ~on_edge & (peak_power >= min_peak), paf, np.nan)
+    return dict(paf=paf, peak_power=np.where(finite, peak_power, np.nan),
+                offset=offset, exponent=exponent, r2=r2)
+
+
+def paf_table(subjects, labels, channels, result: dict) -> pd.DataFrame:
+    """Long table of a ``peak_alpha`` result of shape (subjects, labels, channels)."""
+    index = pd.MultiIndex.from_product([list(subjects), list(labels), list(channels)],
+                                       names=["subject", "stim", "channel"])
+    table = pd.DataFrame({key: np.asarray(result[key]).ravel() for key in COLUMNS[3:]},
+                         index=index).reset_index()
+    return table[list(COLUMNS)]
+
+
+def alpha_band(paf: float, half_width: float = PAF_HALF_WIDTH,
+               default=DEFAULT_ALPHA) -> dict:
+    """Individual alpha band PAF +/- ``half_width``; ``default`` without a PAF."""
+    if paf is None or not np.isfinite(paf):
+        return dict(fmin=float(default[0]), fmax=float(default[1]))
+    return dict(fmin=float(paf - half_width), fmax=float(paf + half_width))
+
+
+def subject_alpha_band(table: pd.DataFrame, subject: str, stim: str | None = None,
+                       channels=None, **kwargs) -> dict:
+    """Alpha band of one subject from the mean PAF over labels and channels."""
+    rows = table[table["subject"].astype(str) == str(subject)]
+    if stim is not None:
+        rows = rows[rows["stim"] == stim]
+    if channels is not None:
+        rows = rows[rows["channel"].isin(list(channels))]
+    paf = rows["paf"].mean() if len(rows) else np.nan
+    return alpha_band(paf, **kwargs)
+
+
+def write_paf(fname: str | Path, table: pd.DataFrame) -> Path:
+    """Write a PAF table as tab-separated values."""
+    fname = Path(fname)
+    table.to_csv(fname, sep="\t", index=False, float_format="%.6g")
+    return fname
+
+
+def read_paf(fname: str | Path) -> pd.DataFrame:
+    """Read a PAF table written by ``write_paf``."""
+    return pd.read_csv(fname, sep="\t", dtype={"subject": str})
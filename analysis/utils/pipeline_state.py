@@ -0,0 +1,76 @@
+"""On-disk pipeline state shared by the STN EEG scripts.
+
+Results that are expensive to rebuild but independent of any one participant
+(designed filter kernels, interpolation matrices, ...) are kept in a single
+state directory so that every subject, stage and later run can reuse them.
+
+The directory defaults to ``~/.cache/stn-stimulation-oscillation``. Set the
+``STN_PIPELINE_STATE`` environment variable to move it, for example to a
+folder on RDS that is shared by Mac and Bluebear runs.
+"""
+from __future__ import annotations
+
+import hashlib
+import json
+import os
+from pathlib import Path
+
+import numpy as np
+
+
+STATE_ENV_VAR = "STN_PIPELINE_STATE"
+DEFAULT_STATE_DIR = Path.home() / ".cache" / "stn-stimulation-oscillation"
+
+
+def state_dir(*parts: str) -> Path:
+    """Return (and create) a folder inside the pipeline state directory."""
+    root = Path(os.environ.get(STATE_ENV_VAR, DEFAULT_STATE_DIR)).expanduser()
+    path = root.joinpath(*parts)
+    path.mkdir(parents=True, exist_ok=True)
+    return path
+
+
+def _json_default(value):
+    if isinstance(value, np.ndarray):
+        return value.tolist()
+    if isinstance(value, np.generic):
+        return value.item()
+    if isinstance(value, (set, frozenset)):
+        return sorted(value)
+    if isinstance(value, Path):
+        return str(value)
+    raise TypeError(f"Cannot hash value of type {type(value).__name__}")
+
+
+def stable_hash(payload) -> str:
+    """Short hash of a JSON-serialisable payload, stable across runs."""
+    text = json.dumps(payload, sort_keys=True, default=_json_default)
+    return hashlib.sha1(text.encode("utf-8")).hexdigest()[:16]
+
+
+def data_hash(data: np.ndarray) -> str:
+    """blake2b digest of an array's shape, dtype and contents."""
+    data = np.ascontiguousarray(data)
+    digest = hashlib.blake2b(digest_size=16)
+    digest.update(f"{data.shape}{data.dtype}".encode("utf-8"))
+    digest.update(memoryview(data).cast("B"))
+    return digest.hexdigest()
+
+
+def save_array(fname: str | Path, array) -> None:
+    """Write a .npy file atomically so parallel runs never read half a file."""
+    fname = Path(fname)
+    fname.parent.mkdir(parents=True, exist_ok=True)
+    tmp = fname.with_name(f"{fname.stem}.{os.getpid()}.tmp.npy")
+    np.save(tmp, np.asarray(array))
+    os.replace(tmp, fname)
+
+
+def save_npz(fname: str | Path, **arrays) -> Path:
+    """Write a .npz file atomically, as ``save_array`` does for .npy."""
+    fname = Path(fname)
+    fname.parent.mkdir(parents=True, exist_ok=True)
+    tmp = fname.with_name(f"{fname.stem}.{os.getpid()}.tmp.npz")
+    np.savez(tmp, **arrays)
+    os.replace(tmp, fname)
+    return fname
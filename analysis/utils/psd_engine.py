@@ -0,0 +1,146 @@
+"""Welch PSD of the cue epochs, computed once for both labels and kept.
+
+P03 used to call ``epochs.compute_psd()`` per label only to draw the PSD
+figure. ``compute_label_psds`` stacks the no-stim and stim epochs and runs a
+single ``psd_array_welch`` call, with the same settings as
+``compute_psd(method='welch', n_fft=...)``. It keeps the spectra up to
+150 Hz, so that residual stimulation (130 Hz) and line-noise (50 Hz) peaks
+can be checked.
+
+Per subject, the epoch-averaged spectra of both labels are written to one
+compact ``*_psd-cue.npz``:
+
+    freqs       (n_freqs,)
+    ch_names    (n_channels,)   good data channels
+    labels      ('no-stim', 'stim')
+    psd         (n_labels, n_channels, n_freqs), float32, V**2/Hz
+    n_epochs    (n_labels,)
+
+``read_psd`` reads it back. ``aperiodic_slope`` and ``line_ratio_db`` are
+vectorised QC measures that work on any ``(..., n_freqs)`` array, so a whole
+cohort is handled in one call.
+"""
+from __future__ import annotations
+
+from pathlib import Path
+
+import mne
+import numpy as np
+
+from pipeline_state import save_npz
+
+
+STORE_FMAX = 150.0
+LINE_FREQS = {"line noise": 50.0, "stimulation": 130.0}
+
+
+def data_picks(info):
+    """Good data channels, as used by ``compute_psd()`` by default."""
+    return mne.pick_types(info, meg=True, eeg=True, seeg=True, ecog=True,
+                          dbs=True, fnirs=True, exclude="bads")
+
+
+def compute_label_psds(epochs_by_label: dict, fmin: float = 0.1,
+                       fmax: float = STORE_FMAX, n_fft: int | None = None):
+    """Welch PSD of every epoch of every label in one call.
+
+    All labels must share the same good channels. Returns ``freqs``, the
+    picked channel names and ``label -> (n_epochs, n_channels, n_freqs)``.
+    """
+    labels = list(epochs_by_label)
+    first = epochs_by_label[labels[0]]
+    picks = data_picks(first.info)
+    ch_names = [first.ch_names[idx] for idx in picks]
+    for label in labels[1:]:
+        other = epochs_by_label[label]
+        if [other.ch_names[idx] for idx in data_picks(other.info)] != ch_names:
+            raise ValueError(f"{label} epochs do not have the same good channels.")
+
+    sfreq = first.info["sfreq"]
+    if n_fft is None:
+        n_fft = min(int(2 * sfreq), len(first.times))
+    fmax = min(fmax, sfreq / 2)
+
+    data = np.concatenate(
+        [epochs_by_label[label].get_data(picks=picks) for label in labels]
+    )
+    psds, freqs = mne.time_frequency.psd_array_welch(
+        data, sfreq, fmin=fmin, fmax=fmax, n_fft=n_fft, verbose=False
+    )
+
+    bounds = np.cumsum([0] + [len(epochs_by_label[label]) for label in labels])
+    by_label = {label: psds[start:stop]
+                for label, start, stop in zip(labels, bounds[:-1], bounds[1:])}
+    return freqs, ch_names, by_label
+
+
+def spectrum_for_plot(epochs, freqs, psds, fmax: float = 100.0):
+    """``EpochsSpectrumArray`` up to ``fmax``, for the usual ``.plot()``."""
+    keep = freqs <= fmax
+    info = mne.pick_info(epochs.info, data_picks(epochs.info))
+    return mne.time_frequency.EpochsSpectrumArray(
+        psds[..., keep], info, freqs[keep],
+        events=epochs.events, event_id=epochs.event_id,
+    )
+
+
+def write_psd(fname: str | Path, freqs, ch_names, psds_by_label: dict) -> Path:
+    """Write the epoch-averaged spectra of all labels to one ``.npz`` file."""
+    fname = Path(fname)
+    labels = list(psds_by_label)
+    save_npz(
+        fname,
+        freqs=np.asarray(freqs),
+        ch_names=np.array(ch_names, dtype=str),
+        labels=np.array(labels, dtype=str),
+        psd=np.stack([psds_by_label[label].mean(axis=0)
+                      for label in labels]).astype(np.float32),
+        n_epochs=np.array([len(psds_by_label[label]) for label in labels]),
+    )
+    return fname
+
+
+def read_psd(fname: str | Path) -> dict:
+    """Read a ``*_psd-cue.npz`` file into a dict of arrays and lists."""
+    with np.load(fname) as stored:
+        return {
+            "freqs": stored["freqs"],
+            "ch_names": [str(ch) for ch in stored["ch_names"]],
+            "labels": [str(label) for label in stored["labels"]],
+            "psd": stored["psd"].astype(float),
+            "n_epochs": stored["n_epochs"],
+        }
+
+
+def aperiodic_slope(freqs, psd, fmin: float = 2.0, fmax: float = 40.0,
+                    exclude=(7.0, 14.0)) -> np.ndarray:
+    """Slope of log10(power) against log10(frequency), for every spectrum.
+
+    The alpha band in ``exclude`` is left out of the fit. ``psd`` has
+    frequencies on the last axis; the result has the other axes.
+    """
+    freqs = np.asarray(freqs)
+    keep = (freqs >= fmin) & (freqs <= fmax)
+    if exclude is not None:
+        keep &= ~((freqs >= exclude[0]) & (freqs <= exclude[1]))
+    x = np.log10(freqs[keep])
+    y = np.log10(np.asarray(psd)[..., keep])
+    x = x - x.mean()
+    return (y - y.mean(axis=-1, keepdims=True)) @ x / (x @ x)
+
+
+def line_ratio_db(freqs, psd, line_freq: float, width: float = 1.0,
+                  flank=(2.0, 5.0)) -> np.ndarray:
+    """Power at ``line_freq`` relative to its flanks, in dB.
+
+    Near 0 dB means there is no peak. The peak band is ``line_freq +/- width``
+    and the flanks are 2-5 Hz away on both sides.
+    """
+    freqs = np.asarray(freqs)
+    distance = np.abs(freqs - line_freq)
+    peak = distance <= width
+    flanks = (distance >= flank[0]) & (distance <= flank[1])
+    if not peak.any() or not flanks.any():
+        raise ValueError(f"{line_freq} Hz is outside the stored spectrum.")
+    psd = np.asarray(psd)
+    return 10 * np.log10(psd[..., peak].mean(axis=-1) / psd[..., flanks].mean(axis=-1))
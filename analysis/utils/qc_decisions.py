@@ -0,0 +1,118 @@
+"""Replayable log of the manual QC decisions made in P03.
+
+P03 asks the user three things per label (no-stim / stim):
+
+    1. additional bad channels, each with a reason;
+    2. whether to continue when a posterior analysis channel was rejected;
+    3. which epochs to drop in the posterior-channel browser.
+
+The answers are stored, together with the suggested bad channels, in
+``derivatives/sub-XXX/qc/sub-XXX_p03_decisions.json``:
+
+    {
+      "subject": "115",
+      "written": "...",
+      "labels": {
+        "no-stim": {
+          "suggested_bad_channels": {"Fp1": ["deviation", ...]},
+          "added_bad_channels": {"T7": "muscle"},
+          "posterior_continue": null,
+          "prescreen_event_samples": [123456, ...],
+          "dropped_event_samples": [123456, ...]
+        },
+        ...
+      }
+    }
+
+``prescreen_event_samples`` are the epochs pre-marked by the automatic
+pre-screen, so they can be compared with what was finally dropped.
+Dropped epochs are identified by the sample of their cue event, not by their
+index, so the log still applies after the epoch window or filter changes.
+With ``qc_mode = 'replay'``, P03 reads the log instead of asking, so it can
+run headlessly and several subjects can be re-epoched in parallel.
+"""
+from __future__ import annotations
+
+import json
+import os
+import warnings
+from datetime import datetime
+from pathlib import Path
+
+import numpy as np
+
+
+QC_MODES = ("interactive", "replay")
+
+
+def decisions_fname(bids_root: str | Path, subject: str) -> Path:
+    """Path of the P03 decision log for ``subject``."""
+    return (Path(bids_root) / "derivatives" / f"sub-{subject}" / "qc"
+            / f"sub-{subject}_p03_decisions.json")
+
+
+def new_decisions(subject: str) -> dict:
+    return {"subject": str(subject), "written": None, "labels": {}}
+
+
+def label_decisions(decisions: dict, label: str) -> dict:
+    """Return (and create) the entry for one label."""
+    return decisions["labels"].setdefault(label, {
+        "suggested_bad_channels": {},
+        "added_bad_channels": {},
+        "posterior_continue": None,
+        "prescreen_event_samples": [],
+        "dropped_event_samples": [],
+    })
+
+
+def read_decisions(fname: str | Path) -> dict:
+    fname = Path(fname)
+    if not fname.exists():
+        raise FileNotFoundError(
+            f"No QC decision log at {fname}. Run P03 interactively first "
+            "(qc_mode = 'interactive') to create it."
+        )
+    return json.loads(fname.read_text(encoding="utf-8"))
+
+
+def write_decisions(fname: str | Path, decisions: dict) -> Path:
+    """Write the log atomically, so an interrupted run never leaves half a file."""
+    fname = Path(fname)
+    fname.parent.mkdir(parents=True, exist_ok=True)
+    decisions["written"] = datetime.now().isoformat(timespec="seconds")
+    tmp = fname.with_name(f"{fname.name}.{os.getpid()}.tmp")
+    tmp.write_text(json.dumps(decisions, indent=2), encoding="utf-8")
+    os.replace(tmp, fname)
+    return fname
+
+
+def event_samples(epochs) -> list[int]:
+    """Cue-event sample of every epoch currently in ``epochs``."""
+    return [int(sample) for sample in epochs.events[:, 0]]
+
+
+def dropped_event_samples(samples_before, epochs) -> list[int]:
+    """Event samples present before the browser but no longer in ``epochs``."""
+    remaining = set(event_samples(epochs))
+    return [int(sample) for sample in samples_before if sample not in remaining]
+
+
+def drop_by_event_sample(epochs, samples, reason: str = "QC replay") -> int:
+    """Drop the epochs whose cue event is at one of ``samples``, in place.
+
+    Returns the number of epochs dropped. Logged samples that no longer match
+    an epoch are reported with a warning.
+    """
+    samples = np.asarray(list(samples), dtype=int)
+    drop = np.isin(epochs.events[:, 0], samples)
+    missing = np.setdiff1d(samples, epochs.events[:, 0])
+    if len(missing):
+        warnings.warn(
+            f"{len(missing)} logged epoch(s) not found in the epochs "
+            f"(event samples {missing.tolist()}).",
+            RuntimeWarning,
+        )
+    if drop.any():
+        epochs.drop(np.flatnonzero(drop), reason=reason)
+    return int(drop.sum())
@@ -0,0 +1,181 @@
+"""Parallel, cached RANSAC bad-channel prediction for P03.
+
+Same criterion as PyPREP's ``find_bad_by_ransac`` (window-wise). Every good
+channel is predicted from ``n_samples`` random subsets of the good channels
+by spherical-spline interpolation. The prediction is the median over
+subsets. A channel is bad when its correlation with the prediction is below
+``corr_thresh`` in more than ``frac_bad`` of the 5-s windows.
+
+Compared with PyPREP:
+
+    - the interpolation matrices of all random subsets are built once per
+      montage and subset draw, and cached in the pipeline state directory;
+    - the windows are split over a process (or thread) pool, and each worker
+      predicts channels in blocks that fit in its share of ``max_memory_mb``;
+    - the result is memoised by a blake2b hash of the data together with the
+      parameters and ``random_state``, so running P03 again for the same
+      segment returns immediately.
+
+Process workers import the main script again when the ``spawn`` start
+method is used. Only use ``parallel="process"`` when the main script is
+guarded by ``if __name__ == "__main__"``, as ``run_subject_pipeline.py`` is.
+"""
+from __future__ import annotations
+
+import json
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+import numpy as np
+
+from interpolation import make_interpolation_matrix
+from pipeline_state import data_hash, save_array, stable_hash, state_dir
+
+
+RANSAC_PARALLEL_MODES = ("serial", "thread", "process")
+
+_MATRICES: dict[str, np.ndarray] = {}
+_LOCK = threading.Lock()
+
+
+def random_channel_picks(n_good: int, n_pred: int, n_samples: int,
+                         random_state: int) -> np.ndarray:
+    """Random channel subsets, drawn in the same way as PyPREP."""
+    rng = np.random.RandomState(random_state)
+    return np.array([rng.choice(n_good, n_pred, replace=False)
+                     for _ in range(n_samples)])
+
+
+def subset_matrices(pos_good: np.ndarray, picks: np.ndarray) -> np.ndarray:
+    """Interpolation matrices ``(n_samples, n_good, n_pred)`` for all subsets."""
+    key = stable_hash({"pos": np.round(pos_good, 6), "picks": picks})
+    with _LOCK:
+        if key in _MATRICES:
+            return _MATRICES[key]
+        fname = state_dir("interpolation", "ransac") / f"{key}.npy"
+        if fname.exists():
+            matrices = np.load(fname)
+        else:
+            matrices = np.stack([
+                make_interpolation_matrix(pos_good[subset], pos_good)
+                for subset in picks
+            ])
+            save_array(fname, matrices)
+        _MATRICES[key] = matrices
+        return matrices
+
+
+def _correlate_rows(a: np.ndarray, b: np.ndarray) -> np.ndarray:
+    a = a - a.mean(axis=-1, keepdims=True)
+    b = b - b.mean(axis=-1, keepdims=True)
+    denom = np.sqrt(np.sum(a * a, axis=-1) * np.sum(b * b, axis=-1))
+    with np.errstate(invalid="ignore", divide="ignore"):
+        return np.sum(a * b, axis=-1) / denom
+
+
+def _predict_windows(windows: np.ndarray, matrices: np.ndarray,
+                     picks: np.ndarray, max_bytes: float) -> np.ndarray:
+    """Correlation of each channel with its RANSAC prediction, per window."""
+    n_samples, n_good, _ = matrices.shape
+    win_size = windows.shape[-1]
+    rows = max(1, int(max_bytes // (2 * n_samples * win_size * 8)))
+    correlations = np.empty(windows.shape[:2])
+    for k, window in enumerate(windows):
+        sampled = window[picks]  # (n_samples, n_pred, n_times)
+        for first in range(0, n_good, rows):
+            block = slice(first, first + rows)
+            predicted = np.median(np.matmul(matrices[:, block], sampled), axis=0)
+            correlations[k, block] = _correlate_rows(window[block], predicted)
+    return correlations
+
+
+def find_bad_by_ransac(
+    data: np.ndarray,
+    sfreq: float,
+    ch_names,
+    pos: np.ndarray,
+    exclude=(),
+    n_samples: int = 50,
+    sample_prop: float = 0.25,
+    corr_thresh: float = 0.75,
+    frac_bad: float = 0.4,
+    corr_window_secs: float = 5.0,
+    random_state: int = 42,
+    parallel: str = "process",
+    n_jobs: int | None = None,
+    max_memory_mb: float = 1024.0,
+) -> list[str]:
+    """Return the channels flagged by RANSAC.
+
+    ``data`` is ``(n_channels, n_times)`` low-passed EEG and ``pos`` holds the
+    matching ``(n_channels, 3)`` sensor positions. Channels in ``exclude`` are
+    neither used for prediction nor tested.
+    """
+    if parallel not in RANSAC_PARALLEL_MODES:
+        raise ValueError(
+            f"parallel must be one of {RANSAC_PARALLEL_MODES}, got {parallel!r}"
+        )
+    ch_names = np.asarray(ch_names)
+    good = ~np.isin(ch_names, list(exclude))
+    n_good = int(good.sum())
+    n_pred = int(np.around(sample_prop * n_good))
+    if n_pred < 3 or n_good - n_pred < 1:
+        raise ValueError(
+            f"Too few good channels for RANSAC ({n_good} good, {n_pred} per sample)."
+        )
+
+    params = {
+        "data": data_hash(data),
+        "sfreq": float(sfreq),
+        "ch_names": ch_names,
+        "exclude": sorted(map(str, exclude)),
+        "n_samples": n_samples,
+        "sample_prop": sample_prop,
+        "corr_thresh": corr_thresh,
+        "frac_bad": frac_bad,
+        "corr_window_secs": corr_window_secs,
+        "random_state": random_state,
+    }
+    result_fname = state_dir("ransac") / f"{stable_hash(params)}.json"
+    if result_fname.exists():
+        return json.loads(result_fname.read_text(encoding="utf-8"))["bad_by_ransac"]
+
+    picks = random_channel_picks(n_good, n_pred, n_samples, random_state)
+    matrices = subset_matrices(np.asarray(pos)[good], picks)
+
+    win_size = int(corr_window_secs * sfreq)
+    n_windows = len(np.arange(0, data.shape[1] - win_size, win_size))
+    windows = data[good][:, :n_windows * win_size]
+    windows = windows.reshape(n_good, n_windows, win_size).transpose(1, 0, 2)
+
+    n_jobs = 1 if parallel == "serial" else (n_jobs or os.cpu_count() or 1)
+    n_jobs = max(1, min(n_jobs, n_windows))
+    max_bytes = max_memory_mb * 1e6 / n_jobs
+    bounds = np.linspace(0, n_windows, min(n_windows, 4 * n_jobs) + 1).astype(int)
+    chunks = [np.ascontiguousarray(windows[a:b]) for a, b in zip(bounds[:-1], bounds[1:])]
+
+    if n_jobs == 1:
+        results = [_predict_windows(chunk, matrices, picks, max_bytes) for chunk in chunks]
+    else:
+        executor_cls = ThreadPoolExecutor if parallel == "thread" else ProcessPoolExecutor
+        with executor_cls(max_workers=n_jobs) as executor:
+            results = list(executor.map(
+                _predict_windows, chunks,
+                [matrices] * len(chunks), [picks] * len(chunks),
+                [max_bytes] * len(chunks),
+            ))
+
+    correlations = np.ones((n_windows, len(ch_names)))
+    if results:
+        correlations[:, good] = np.concatenate(results)
+    fraction_bad = np.mean(correlations < corr_thresh, axis=0)
+    bad = [str(ch) for ch in ch_names[fraction_bad > frac_bad]]
+
+    tmp = result_fname.with_suffix(f".{os.getpid()}.tmp")
+    tmp.write_text(json.dumps({
+        "bad_by_ransac": bad,
+        "fraction_bad_windows": dict(zip(map(str, ch_names), fraction_bad.tolist())),
+    }, indent=2), encoding="utf-8")
+    os.replace(tmp, result_fname)
+    return bad
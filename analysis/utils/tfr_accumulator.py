@@ -0,0 +1,191 @@
+"""Average TFRs kept as running sums, updated only for changed trials.
+
+Dropping a few more epochs in P03 used to make A02 transform every remaining
+trial again. ``TFRAccumulator`` keeps, per label, the power sum and trial
+count of every event code, along with the single-trial power of each trial
+keyed by its event sample. The folder ``*_{label}_tfr-accum`` has one
+subfolder per parameter key (see ``accumulator_key``), which holds:
+
+    state.npz          parameter key, event samples, codes and data hashes
+                       of the trials in the sums, and the float64 sum per code
+    trials/<sample>-<hash>.npy
+                       float32 power (n_channels, n_freqs, n_times) of a trial
+
+``update(epochs)`` compares the epochs with the state:
+
+    removed trials   their stored power is subtracted from the sum of their
+                     code and the file is deleted;
+    new trials       only these are transformed (``tfr_engine.iter_power``),
+                     added to the sums and stored;
+    changed trials   (same sample, different data or code) are removed and
+                     added again.
+
+The sums are built from the float32 power that is stored, so subtracting a
+trial removes exactly what was added. Trial files are named by sample and
+data hash, so the new power of a changed trial never overwrites the file
+that the saved state still counts; files that the state no longer refers to
+are deleted only after the new state is saved. A run stopped at any point
+leaves the previous state and its trial files consistent. The averages
+therefore match a fresh transform to float32 precision.
+
+A change of channels, frequencies, method, sampling rate or epoch length
+changes the parameter key, and the accumulator starts from an empty
+subfolder. The subfolders of other keys are left alone, so stages that
+open the same folder never delete each other's stored power.
+"""
+from __future__ import annotations
+
+import shutil
+from pathlib import Path
+
+import numpy as np
+
+from pipeline_state import data_hash, save_array, save_npz, stable_hash
+from tfr_engine import iter_power
+
+
+ACCUM_SUFFIX = "_tfr-accum"
+STATE_FNAME = "state.npz"
+TRIAL_DTYPE = np.float32
+
+
+def accumulator_key(sfreq, ch_names, n_times, freqs, n_cycles,
+                    method="multitaper", time_bandwidth=4.0, zero_mean=True,
+                    decim=1) -> str:
+    """Return the key of everything that changes the power of a trial."""
+    return stable_hash({
+        "sfreq": float(sfreq),
+        "ch_names": list(ch_names),
+        "n_times": int(n_times),
+        "freqs": np.asarray(freqs, dtype=float),
+        "n_cycles": np.atleast_1d(np.asarray(n_cycles, dtype=float)),
+        "method": method,
+        "time_bandwidth": None if method == "morlet" else float(time_bandwidth),
+        "zero_mean": bool(zero_mean),
+        "decim": int(decim),
+    })
+
+
+class TFRAccumulator:
+    """Per-code power sums and counts of one label, kept up to date on disk."""
+
+    def __init__(self, path: str | Path, sfreq, ch_names, n_times, **tfr_params):
+        self.root = Path(path)
+        self.sfreq = float(sfreq)
+        self.tfr_params = tfr_params
+        self.key = accumulator_key(sfreq, ch_names, n_times, **tfr_params)
+        self.path = self.root / self.key
+        self.samples = np.empty(0, dtype=int)
+        self.codes = np.empty(0, dtype=int)
+        self.hashes = np.empty(0, dtype=str)
+        self.sums: dict[int, np.ndarray] = {}
+        self._load()
+
+    @property
+    def _trial_dir(self) -> Path:
+        return self.path / "trials"
+
+    def _trial_fname(self, sample, digest) -> Path:
+        return self._trial_dir / f"{int(sample)}-{digest}.npy"
+
+    def _prune(self) -> None:
+        """Delete trial files that the saved state does not refer to."""
+        keep = {self._trial_fname(sample, digest).name
+                for sample, digest in zip(self.samples.tolist(), self.hashes.tolist())}
+        for fname in self._trial_dir.glob("*.npy"):
+            if fname.name not in keep:
+                fname.unlink(missing_ok=True)
+
+    def _load(self) -> None:
+        # Single-folder layout of earlier versions, without a key subfolder.
+        (self.root / STATE_FNAME).unlink(missing_ok=True)
+        shutil.rmtree(self.root / "trials", ignore_errors=True)
+
+        fname = self.path / STATE_FNAME
+        if fname.exists():
+            with np.load(fname) as state:
+                if str(state["key"]) != self.key:
+                    raise RuntimeError(f"{fname} belongs to key {state['key']}, "
+                                       f"not {self.key}.")
+                self.samples = state["samples"]
+                self.codes = state["codes"]
+                self.hashes = state["hashes"]
+                self.sums = {int(code): state[f"sum_{code}"]
+                             for code in state["sum_codes"]}
+                return
+        # Trial files without a state cannot be trusted: start from empty.
+        if self.path.exists():
+            shutil.rmtree(self.path)
+
+    def _save(self) -> None:
+        arrays = {
+            "key": np.array(self.key),
+            "samples": self.samples,
+            "codes": self.codes,
+            "hashes": self.hashes,
+            "sum_codes": np.array(sorted(self.sums), dtype=int),
+        }
+        arrays.update({f"sum_{code}": total for code, total in self.sums.items()})
+        save_npz(self.path / STATE_FNAME, **arrays)
+
+    def _add(self, code: int, power: np.ndarray, sign: int = 1) -> None:
+        power = power.astype(float)
+        if code in self.sums:
+            self.sums[code] += sign * power
+        else:
+            self.sums[code] = sign * power
+
+    def counts(self) -> dict[int, int]:
+        """Number of trials in the sum of each code."""
+        return {int(code): int((self.codes == code).sum()) for code in self.sums}
+
+    def update(self, epochs, max_memory_mb: float = 256) -> tuple[int, int]:
+        """Bring the sums in line with ``epochs``; return ``(n_added, n_removed)``."""
+        data = epochs.get_data()
+        samples = epochs.events[:, 0].astype(int)
+        codes = epochs.events[:, 2].astype(int)
+        hashes = np.array([data_hash(trial) for trial in data])
+
+        known = dict(zip(self.samples.tolist(), zip(self.codes.tolist(),
+                                                    self.hashes.tolist())))
+        current = dict(zip(samples.tolist(), zip(codes.tolist(), hashes.tolist())))
+        removed = [s for s, entry in known.items() if current.get(s) != entry]
+        added = np.array([i for i, s in enumerate(samples.tolist())
+                          if known.get(s) != current[s]], dtype=int)
+
+        for sample in removed:
+            fname = self._trial_fname(sample, known[sample][1])
+            if not fname.exists():
+                # The power needed to take this trial out is gone: rebuild.
+                shutil.rmtree(self.path, ignore_errors=True)
+                self.samples = np.empty(0, dtype=int)
+                self.codes = np.empty(0, dtype=int)
+                self.hashes = np.empty(0, dtype=str)
+                self.sums = {}
+                return self.update(epochs, max_memory_mb=max_memory_mb)
+            self._add(known[sample][0], np.load(fname), sign=-1)
+
+        self._trial_dir.mkdir(parents=True, exist_ok=True)
+        if len(added):
+            for start, power in iter_power(data[added], self.sfreq,
+                                           max_memory_mb=max_memory_mb,
+                                           **self.tfr_params):
+                power = power.astype(TRIAL_DTYPE)
+                for idx, trial_power in zip(added[start:start + len(power)], power):
+                    save_array(self._trial_fname(samples[idx], hashes[idx]), trial_power)
+                    self._add(int(codes[idx]), trial_power)
+
+        self.samples, self.codes, self.hashes = samples, codes, hashes
+        self.sums = {code: total for code, total in self.sums.items()
+                     if code in set(codes.tolist())}
+        self._save()
+        self._prune()
+        return len(added), len(removed)
+
+    def iter_power(self, samples, block: int = 64):
+        """Yield ``(first trial, stored power)`` blocks for ``samples`` in order."""
+        samples = np.asarray(samples, dtype=int)
+        digests = dict(zip(self.samples.tolist(), self.hashes.tolist()))
+        for start in range(0, len(samples), block):
+            yield start, np.stack([np.load(self._trial_fname(sample, digests[sample]))
+                                   for sample in samples[start:start + block].tolist()])
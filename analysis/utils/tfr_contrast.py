@@ -0,0 +1,63 @@
+"""Stim vs no-stim TFR contrasts computed into a single output array.
+
+A02, G01 and G02 built every contrast as ``a.copy()`` followed by
+``.data = a.data - b.data``. That holds a full copy of the TFR plus the
+temporary result. The ratio also needed a separate denominator array and
+an epsilon add. Here every contrast is written with numpy ``out=``
+arithmetic into one output array (preallocated by the caller or created
+once):
+
+    difference   a - b
+    ratio        (a - b) / (a + b), computed as 1 - 2 b / (a + b)
+    logratio     log10(a / b)
+
+The ratio is 0 wherever a + b is 0, without an epsilon bias elsewhere.
+``tfr_contrast`` wraps the result in a new ``AverageTFRArray`` with its own
+copy of the info of ``a``, so channel edits on the result never reach ``a``
+(which may be a cached ``TFRVariants`` entry).
+"""
+from __future__ import annotations
+
+import mne
+import numpy as np
+
+
+CONTRASTS = ("difference", "ratio", "logratio")
+
+
+def contrast_data(a, b, kind: str = "difference", out=None) -> np.ndarray:
+    """Write the ``kind`` contrast of arrays ``a`` and ``b`` into ``out``."""
+    if kind not in CONTRASTS:
+        raise ValueError(f"kind must be one of {CONTRASTS}, got {kind!r}")
+    a = np.asarray(a)
+    b = np.asarray(b)
+    if out is None:
+        out = np.empty(np.broadcast_shapes(a.shape, b.shape),
+                       dtype=np.result_type(a, b, float))
+
+    if kind == "difference":
+        return np.subtract(a, b, out=out)
+    if kind == "logratio":
+        np.divide(a, b, out=out)
+        return np.log10(out, out=out)
+
+    np.add(a, b, out=out)
+    zero = out == 0
+    np.divide(b, out, out=out, where=~zero)
+    out *= -2
+    out += 1
+    out[zero] = 0
+    return out
+
+
+def tfr_contrast(a, b, kind: str = "difference", out=None, comment: str | None = None):
+    """Contrast of two average TFRs with the metadata of ``a``.
+
+    ``a`` and ``b`` are not changed. Only the info, times and frequencies
+    of ``a`` are copied; pass ``out`` to reuse an existing data array.
+    """
+    return mne.time_frequency.AverageTFRArray(
+        a.info.copy(), contrast_data(a.data, b.data, kind, out=out), a.times,
+        a.freqs, nave=a.nave, comment=comment if comment is not None else kind,
+        method=a.method,
+    )
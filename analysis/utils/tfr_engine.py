@@ -0,0 +1,254 @@
+"""Multitaper / Morlet power with cached kernel FFTs.
+
+``epochs.compute_tfr()`` builds the DPSS tapers (or Morlet wavelets) and
+their FFTs again on every call. A02 calls it per label, and G01/G02 per
+channel and per subject, always with the same sampling rate, frequencies and
+epoch length. Here the kernel FFTs are computed once per
+
+    method, sfreq, freqs, n_cycles, time_bandwidth, zero_mean, n_times
+
+They are kept in a process-wide dictionary and written to the pipeline state
+directory (``tfr_kernels``), so later subjects, stages and runs only load
+them.
+
+The transform follows MNE's ``use_fft=True`` path: FFT length
+``next_fast_len(n_times + longest kernel - 1)``, convolution mode ``'same'``
+and power averaged over tapers. The result is therefore the same as
+``compute_tfr`` / ``tfr_array_multitaper``. All signals of a block of epochs
+are transformed in one batched FFT. The blocks are sized to
+``max_memory_mb``.
+
+The DPSS tapers come from MNE's private ``_make_dpss``, the function
+``compute_tfr`` itself uses. If an MNE version lacks it or changes its
+signature, ``iter_power`` warns once and falls back to MNE's public
+``tfr_array_multitaper`` (same result, without the kernel cache).
+
+``iter_power`` yields the single-trial power block by block. ``tfr_power``
+returns it averaged or per trial, and ``compute_tfr`` is a drop-in for
+``epochs.compute_tfr(**TFR_PARAMS)`` that returns an ``AverageTFRArray``.
+"""
+from __future__ import annotations
+
+import threading
+import warnings
+
+import mne
+import numpy as np
+from scipy import fft as sp_fft
+
+from pipeline_state import save_array, stable_hash, state_dir
+
+
+TFR_METHODS = ("multitaper", "morlet")
+
+# Subject-level TFR of A02 and A03. Both open the same _tfr-accum store, so
+# they must share these settings; edit them here only.
+SUBJECT_TFR_FREQS = np.arange(2, 31, 1)
+SUBJECT_TFR_PARAMS = dict(freqs=SUBJECT_TFR_FREQS, n_cycles=SUBJECT_TFR_FREQS / 2,
+                          method="multitaper", time_bandwidth=2.0, decim=2)
+
+_KERNELS: dict[str, tuple[np.ndarray, np.ndarray]] = {}
+_LOCK = threading.Lock()
+_WARNED = False
+
+
+class KernelsUnavailable(RuntimeError):
+    """The installed MNE does not provide the DPSS tapers in the known form."""
+
+
+def _make_wavelets(method, sfreq, freqs, n_cycles, time_bandwidth, zero_mean):
+    """Kernels as ``n_tapers`` lists of one wavelet per frequency (as MNE)."""
+    if method == "multitaper":
+        # Same tapers as compute_tfr(method='multitaper'), from a private
+        # MNE function; any failure here is handled by falling back to MNE.
+        try:
+            from mne.time_frequency.tfr import _make_dpss
+            return _make_dpss(sfreq, freqs, n_cycles=n_cycles,
+                              time_bandwidth=time_bandwidth, zero_mean=zero_mean)
+        except Exception as exc:
+            raise KernelsUnavailable(
+                f"mne {mne.__version__}: _make_dpss is not usable ({exc})"
+            ) from exc
+    return [mne.time_frequency.morlet(sfreq, freqs, n_cycles=n_cycles,
+                                      zero_mean=zero_mean)]
+
+
+def kernel_key(method, sfreq, freqs, n_cycles, time_bandwidth, zero_mean,
+               n_times) -> str:
+    """Return the cache key for one kernel set."""
+    return stable_hash({
+        "method": method,
+        "sfreq": float(sfreq),
+        "freqs": np.asarray(freqs, dtype=float),
+        "n_cycles": np.atleast_1d(np.asarray(n_cycles, dtype=float)),
+        "time_bandwidth": None if method == "morlet" else float(time_bandwidth),
+        "zero_mean": bool(zero_mean),
+        "n_times": int(n_times),
+        # The state directory may be shared by machines with other MNE versions.
+        "mne": mne.__version__,
+    })
+
+
+def tfr_kernels(method, sfreq, freqs, n_cycles, time_bandwidth=4.0,
+                zero_mean=True, n_times=None):
+    """Return ``(kernel FFTs (n_tapers, n_freqs, n_fft), kernel lengths)``.
+
+    The FFTs are built only if they are not cached in memory or on disk.
+    """
+    if method not in TFR_METHODS:
+        raise ValueError(f"method must be one of {TFR_METHODS}, got {method!r}")
+    key = kernel_key(method, sfreq, freqs, n_cycles, time_bandwidth,
+                     zero_mean, n_times)
+    with _LOCK:
+        if key in _KERNELS:
+            return _KERNELS[key]
+
+        folder = state_dir("tfr_kernels")
+        fft_fname = folder / f"{key}.npy"
+        size_fname = folder / f"{key}-sizes.npy"
+        if fft_fname.exists() and size_fname.exists():
+            kernels = (np.load(fft_fname), np.load(size_fname))
+        else:
+            wavelets = _make_wavelets(method, sfreq, freqs, n_cycles,
+                                      time_bandwidth, zero_mean)
+            sizes = np.array([w.size for w in wavelets[0]])
+            if sizes.max() > n_times:
+                raise ValueError(
+                    f"The longest kernel ({sizes.max()} samples) is longer "
+                    f"than the signal ({n_times} samples); lower n_cycles."
+                )
+            n_fft = sp_fft.next_fast_len(int(n_times + sizes.max() - 1))
+            kernel_fft = np.stack([
+                np.stack([sp_fft.fft(w, n_fft) for w in taper])
+                for taper in wavelets
+            ])
+            save_array(fft_fname, kernel_fft)
+            save_array(size_fname, sizes)
+            kernels = (kernel_fft, sizes)
+        _KERNELS[key] = kernels
+        return kernels
+
+
+def _decim_slice(decim) -> slice:
+    return decim if isinstance(decim, slice) else slice(None, None, int(decim))
+
+
+def iter_power(data, sfreq, freqs, n_cycles, method="multitaper",
+               time_bandwidth=4.0, zero_mean=True, decim=1,
+               max_memory_mb: float = 256):
+    """Yield ``(first epoch, power)`` blocks of single-trial power.
+
+    ``data`` is ``(n_epochs, n_channels, n_times)``; each ``power`` block is
+    ``(n_block, n_channels, n_freqs, n_times_out)``.
+    """
+    data = np.asarray(data)
+    n_epochs, n_channels, n_times = data.shape
+    try:
+        kernel_fft, sizes = tfr_kernels(method, sfreq, freqs, n_cycles,
+                                        time_bandwidth, zero_mean, n_times)
+    except KernelsUnavailable as exc:
+        yield from _mne_power(data, sfreq, freqs, n_cycles, time_bandwidth,
+                              zero_mean, decim, max_memory_mb, exc)
+        return
+    n_tapers, n_freqs, n_fft = kernel_fft.shape
+
+    # 'same' mode: kernel f starts (size - 1) // 2 samples into the output.
+    keep = np.arange(n_times)[_decim_slice(decim)]
+    take = ((sizes - 1) // 2)[:, np.newaxis] + keep[np.newaxis, :]
+
+    # Per epoch: the signal FFT, the product buffer and the inverse FFT of
+    # every frequency (complex), and the kept coefficients and power.
+    signal_bytes = n_channels * (n_fft * 16 + 2 * n_freqs * n_fft * 16
+                                 + n_freqs * len(keep) * (16 + 8))
+    block = max(1, int(max_memory_mb * 2 ** 20 // signal_bytes))
+    product = None
+    for start in range(0, n_epochs, block):
+        signals = data[start:start + block].reshape(-1, n_times)
+        signal_fft = sp_fft.fft(signals, n_fft, axis=-1)[:, np.newaxis, :]
+        if product is None or len(product) != len(signals):
+            product = np.empty((len(signals), n_freqs, n_fft), dtype=np.complex128)
+        power = np.zeros((len(signals), n_freqs, len(keep)))
+        for taper_fft in kernel_fft:
+            np.multiply(signal_fft, taper_fft[np.newaxis], out=product)
+            coefs = sp_fft.ifft(product, axis=-1, overwrite_x=True)
+            coefs = np.take_along_axis(coefs, take[np.newaxis], axis=-1)
+            power += coefs.real ** 2 + coefs.imag ** 2
+        if n_tapers > 1:
+            power /= n_tapers
+        yield start, power.reshape(-1, n_channels, n_freqs, len(keep))
+
+
+def _mne_power(data, sfreq, freqs, n_cycles, time_bandwidth, zero_mean, decim,
+               max_memory_mb, reason):
+    """``iter_power`` blocks from MNE's public multitaper transform."""
+    global _WARNED
+    if not _WARNED:
+        warnings.warn(f"{reason}; using mne.time_frequency.tfr_array_multitaper.")
+        _WARNED = True
+    n_epochs, n_channels, n_times = data.shape
+    n_freqs = len(np.atleast_1d(freqs))
+    # MNE holds the complex coefficients of every taper and frequency.
+    block = max(1, int(max_memory_mb * 2 ** 20 // (n_channels * n_freqs * n_times * 16 * 3)))
+    for start in range(0, n_epochs, block):
+        yield start, mne.time_frequency.tfr_array_multitaper(
+            data[start:start + block], sfreq, freqs, n_cycles=n_cycles,
+            zero_mean=zero_mean, time_bandwidth=time_bandwidth, use_fft=True,
+            decim=decim, output="power", verbose=False,
+        )
+
+
+def tfr_power(data, sfreq, freqs, n_cycles, method="multitaper",
+              time_bandwidth=4.0, zero_mean=True, decim=1, average=False,
+              max_memory_mb: float = 256) -> np.ndarray:
+    """Single-trial power ``(n_epochs, ...)``, or its mean if ``average``."""
+    blocks = iter_power(data, sfreq, freqs, n_cycles, method=method,
+                        time_bandwidth=time_bandwidth, zero_mean=zero_mean,
+                        decim=decim, max_memory_mb=max_memory_mb)
+    if average:
+        total = sum(power.sum(axis=0) for _, power in blocks)
+        return total / len(data)
+    return np.concatenate([power for _, power in blocks])
+
+
+def data_picks(info):
+    """Good data channels, as picked by ``compute_tfr()`` by default."""
+    return mne.pick_types(info, meg=True, eeg=True, seeg=True, ecog=True,
+                          dbs=True, fnirs=True, exclude="bads")
+
+
+def compute_tfr(epochs, method, freqs, n_cycles, time_bandwidth=4.0,
+                use_fft=True, zero_mean=True, decim=1, average=True,
+                return_itc=False, picks=None, max_memory_mb: float = 256,
+                **kwargs):
+    """Cached-kernel version of ``epochs.compute_tfr(...)`` for power.
+
+    Arguments that only affect MNE's own computation (``n_jobs``,
+    ``verbose``) are accepted and ignored. Anything this engine does not
+    cover (inter-trial coherence, ``use_fft=False``) is passed on to MNE.
+    """
+    if return_itc or not use_fft or method not in TFR_METHODS:
+        return epochs.compute_tfr(
+            method=method, freqs=freqs, n_cycles=n_cycles,
+            time_bandwidth=time_bandwidth, use_fft=use_fft,
+            zero_mean=zero_mean, decim=decim, average=average,
+            return_itc=return_itc, picks=picks, **kwargs
+        )
+    if picks is None:
+        picks = data_picks(epochs.info)
+    else:
+        picks = [epochs.ch_names.index(ch) if isinstance(ch, str) else ch
+                 for ch in picks]
+    info = mne.pick_info(epochs.info, picks)
+    times = epochs.times[_decim_slice(decim)]
+    power = tfr_power(epochs.get_data(picks=picks), epochs.info["sfreq"], freqs,
+                      n_cycles, method=method, time_bandwidth=time_bandwidth,
+                      zero_mean=zero_mean, decim=decim, average=average,
+                      max_memory_mb=max_memory_mb)
+    if average:
+        return mne.time_frequency.AverageTFRArray(
+            info, power, times, freqs, nave=len(epochs), method=method
+        )
+    return mne.time_frequency.EpochsTFRArray(
+        info, power, times, freqs, events=epochs.events,
+        event_id=epochs.event_id, method=method
+    )
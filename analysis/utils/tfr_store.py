@@ -0,0 +1,178 @@
+"""Chunked, memory-mappable store of single-trial TFR power.
+
+All TFRs in the pipeline are averaged over trials. A02 can also keep the
+single-trial power ``(n_epochs, n_channels, n_freqs, n_times)`` for
+statistics and trial-wise analyses (``single_trial_tfr = 'yes'``). The store
+is a folder, ``*_{label}_tfr-trials``:
+
+    meta.json                    shape, chunk sizes, ch_names, freqs, times,
+                                 event samples / codes and event_id
+    power_e0000_f000.npy         float32 chunk: trials 0..trial_chunk-1,
+    power_e0000_f001.npy         frequencies 0..freq_chunk-1, ...
+    ...
+
+Each chunk is a plain ``.npy`` file. ``TFRStore.read`` memory-maps only the
+chunks that overlap the requested trials, frequencies and times, and copies
+only that slice. So an alpha band or a post-cue window is read without
+loading the whole array. The store is written to a temporary folder and
+renamed into place when it is complete.
+"""
+from __future__ import annotations
+
+import json
+import os
+import shutil
+from pathlib import Path
+
+import numpy as np
+
+
+STORE_SUFFIX = "_tfr-trials"
+META_FNAME = "meta.json"
+STORE_DTYPE = np.float32
+
+
+def _chunk_fname(trial_chunk_idx: int, freq_chunk_idx: int) -> str:
+    return f"power_e{trial_chunk_idx:04d}_f{freq_chunk_idx:03d}.npy"
+
+
+def _range_slice(values: np.ndarray, vmin, vmax) -> slice:
+    """Contiguous index range of sorted ``values`` within [vmin, vmax]."""
+    start = 0 if vmin is None else int(np.searchsorted(values, vmin, side="left"))
+    stop = len(values) if vmax is None else int(np.searchsorted(values, vmax, side="right"))
+    if stop <= start:
+        raise ValueError(f"No values between {vmin} and {vmax}.")
+    return slice(start, stop)
+
+
+class TFRStore:
+    """Single-trial power on disk, chunked by trial and by frequency.
+
+    Create with ``TFRStore.create(...)`` and use it as a context manager while
+    writing. Open an existing store with ``TFRStore(path)``.
+    """
+
+    def __init__(self, path: str | Path):
+        self.path = Path(path)
+        self.meta = json.loads((self.path / META_FNAME).read_text(encoding="utf-8"))
+        self.freqs = np.asarray(self.meta["freqs"])
+        self.times = np.asarray(self.meta["times"])
+        self.ch_names = list(self.meta["ch_names"])
+        self.event_samples = np.asarray(self.meta["event_samples"], dtype=int)
+        self.event_codes = np.asarray(self.meta["event_codes"], dtype=int)
+        self.event_id = dict(self.meta["event_id"])
+        self.shape = tuple(self.meta["shape"])
+        self.trial_chunk = int(self.meta["trial_chunk"])
+        self.freq_chunk = int(self.meta["freq_chunk"])
+        self._final_path = None
+
+    @classmethod
+    def create(cls, path: str | Path, ch_names, freqs, times, events, event_id: dict,
+               trial_chunk: int = 64, freq_chunk: int = 8):
+        """Create an empty store for ``len(events)`` trials, ready for ``write``."""
+        path = Path(path)
+        tmp = path.with_name(f"{path.name}.{os.getpid()}.tmp")
+        if tmp.exists():
+            shutil.rmtree(tmp)
+        tmp.mkdir(parents=True)
+
+        events = np.asarray(events)
+        shape = (len(events), len(ch_names), len(freqs), len(times))
+        meta = {
+            "shape": shape,
+            "dtype": np.dtype(STORE_DTYPE).name,
+            "trial_chunk": int(trial_chunk),
+            "freq_chunk": int(freq_chunk),
+            "ch_names": list(ch_names),
+            "freqs": np.asarray(freqs, dtype=float).tolist(),
+            "times": np.asarray(times, dtype=float).tolist(),
+            "event_samples": events[:, 0].astype(int).tolist(),
+            "event_codes": events[:, 2].astype(int).tolist(),
+            "event_id": {name: int(code) for name, code in event_id.items()},
+        }
+        (tmp / META_FNAME).write_text(json.dumps(meta), encoding="utf-8")
+
+        for ti, t_start in enumerate(range(0, shape[0], trial_chunk)):
+            for fi, f_start in enumerate(range(0, shape[2], freq_chunk)):
+                chunk_shape = (min(trial_chunk, shape[0] - t_start), shape[1],
+                               min(freq_chunk, shape[2] - f_start), shape[3])
+                np.lib.format.open_memmap(
+                    tmp / _chunk_fname(ti, fi), mode="w+",
+                    dtype=STORE_DTYPE, shape=chunk_shape,
+                ).flush()
+
+        store = cls(tmp)
+        store._final_path = path
+        return store
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if self._final_path is None:
+            return False
+        if exc_type is not None:
+            shutil.rmtree(self.path, ignore_errors=True)
+            return False
+        if self._final_path.exists():
+            shutil.rmtree(self._final_path)
+        os.replace(self.path, self._final_path)
+        self.path, self._final_path = self._final_path, None
+        return False
+
+    def _chunks(self, epoch_range: slice, freq_range: slice):
+        """Yield ``(fname, local epochs, local freqs, out epochs, out freqs)``."""
+        for t_start in range(0, self.shape[0], self.trial_chunk):
+            t_stop = min(t_start + self.trial_chunk, self.shape[0])
+            e0, e1 = max(epoch_range.start, t_start), min(epoch_range.stop, t_stop)
+            if e0 >= e1:
+                continue
+            for f_start in range(0, self.shape[2], self.freq_chunk):
+                f_stop = min(f_start + self.freq_chunk, self.shape[2])
+                f0, f1 = max(freq_range.start, f_start), min(freq_range.stop, f_stop)
+                if f0 >= f1:
+                    continue
+                fname = self.path / _chunk_fname(t_start // self.trial_chunk,
+                                                 f_start // self.freq_chunk)
+                yield (fname, slice(e0 - t_start, e1 - t_start), slice(f0 - f_start, f1 - f_start),
+                       slice(e0 - epoch_range.start, e1 - epoch_range.start),
+                       slice(f0 - freq_range.start, f1 - freq_range.start))
+
+    def write(self, start: int, power: np.ndarray) -> None:
+        """Write ``power`` for the trials ``start .. start + len(power)``."""
+        if self._final_path is None:
+            raise RuntimeError(f"{self.path} is not open for writing.")
+        epoch_range = slice(start, start + len(power))
+        for fname, local_e, local_f, out_e, out_f in self._chunks(
+                epoch_range, slice(0, self.shape[2])):
+            chunk = np.load(fname, mmap_mode="r+")
+            chunk[local_e, :, local_f] = power[out_e, :, out_f]
+            chunk.flush()
+
+    def read(self, fmin=None, fmax=None, tmin=None, tmax=None, epochs=None,
+             channels=None):
+        """Return ``(power, freqs, times)`` for a band, a window and trials.
+
+        ``epochs`` is a slice of trial indices (all trials by default) and
+        ``channels`` a list of names. Only the overlapping chunks are
+        memory-mapped, and only the requested slice is copied.
+        """
+        freq_range = _range_slice(self.freqs, fmin, fmax)
+        time_range = _range_slice(self.times, tmin, tmax)
+        epoch_range = slice(*(epochs or slice(None)).indices(self.shape[0])[:2])
+        ch_idx = (slice(None) if channels is None
+                  else [self.ch_names.index(ch) for ch in channels])
+
+        n_channels = self.shape[1] if channels is None else len(channels)
+        out = np.empty((epoch_range.stop - epoch_range.start, n_channels,
+                        freq_range.stop - freq_range.start,
+                        time_range.stop - time_range.start), dtype=STORE_DTYPE)
+        for fname, local_e, local_f, out_e, out_f in self._chunks(epoch_range, freq_range):
+            chunk = np.load(fname, mmap_mode="r")
+            out[out_e, :, out_f] = chunk[local_e, :, local_f, time_range][:, ch_idx]
+        return out, self.freqs[freq_range], self.times[time_range]
+
+    def band_mean(self, fmin, fmax, tmin=None, tmax=None, epochs=None, channels=None):
+        """Single-trial power averaged over ``fmin``-``fmax`` Hz: ``(trials, channels, times)``."""
+        power, _, times = self.read(fmin, fmax, tmin, tmax, epochs, channels)
+        return power.mean(axis=2), times
@@ -0,0 +1,67 @@
+"""Raw average TFR with lazily computed, cached baseline-normalized variants.
+
+A02 copied every label TFR and then baseline-corrected the copy for display.
+G01 and G02 did the same for each channel and condition, and again for the
+difference TFR when the difference is baseline corrected, so the same
+percent-change array was built twice. ``TFRVariants`` keeps the raw TFR and
+builds a normalized variant only when it is first asked for:
+
+    variants = TFRVariants(tfr)
+    variants.raw                              # the TFR itself, never modified
+    variants.normalized((-0.3, -0.1))         # percent change, built once
+    variants.normalized((-0.3, -0.1), "zscore")
+
+A variant is computed straight from the raw data with
+``mne.baseline.rescale(copy=True)``: no copy of the TFR object comes first.
+Variants are cached by baseline window and mode, so every later plot or
+contrast shares the same object. They must be treated as read-only; take a
+``.copy()`` before changing one.
+"""
+from __future__ import annotations
+
+import threading
+
+import mne
+
+
+BASELINE_MODES = ("percent", "logratio", "zscore", "ratio", "mean", "zlogratio")
+
+
+def baseline_key(baseline, mode: str) -> tuple:
+    """Cache key of one variant: the baseline window in seconds and the mode."""
+    if mode not in BASELINE_MODES:
+        raise ValueError(f"mode must be one of {BASELINE_MODES}, got {mode!r}")
+    window = tuple(None if t is None else round(float(t), 9) for t in baseline)
+    return window, mode
+
+
+class TFRVariants:
+    """An average TFR and its baseline-normalized variants, built on demand."""
+
+    def __init__(self, tfr):
+        self.raw = tfr
+        self._variants = {}
+        self._lock = threading.Lock()
+
+    def normalized(self, baseline, mode: str = "percent"):
+        """Return the ``mode`` variant for ``baseline``, computing it once."""
+        key = baseline_key(baseline, mode)
+        with self._lock:
+            if key not in self._variants:
+                data = mne.baseline.rescale(self.raw.data, self.raw.times, key[0],
+                                            mode=mode, copy=True, verbose=False)
+                self._variants[key] = mne.time_frequency.AverageTFRArray(
+                    self.raw.info, data, self.raw.times, self.raw.freqs,
+                    nave=self.raw.nave, comment=self.raw.comment,
+                    method=self.raw.method,
+                )
+            return self._variants[key]
+
+    def cached(self) -> list[tuple]:
+        """Keys of the variants computed so far."""
+        return list(self._variants)
+
+    def clear(self) -> None:
+        """Drop all cached variants, e.g. after the raw data changed."""
+        with self._lock:
+            self._variants.clear()